@@ -2,6 +2,7 @@ from datetime import datetime
 import torch
 import cv2
 import numpy as np
+from scaling import resize, fit_scale, remap_boxes
 
 # Path to the YOLOv5 model file
 yolo_model_path = 'F:/FYP/yolov5/runs/train/exp3/weights/best.pt'  # Update this to the correct path
@@ -9,15 +10,28 @@ yolo_model_path = 'F:/FYP/yolov5/runs/train/exp3/weights/best.pt'  # Update this
 # Load the YOLOv5 model
 yolo_model = torch.hub.load('ultralytics/yolov5', 'custom', path=yolo_model_path, force_reload=True)
 
-def detect_behavior(frame):
+def detect_behavior_batch(frames, size=640, render=True):
     if yolo_model is None:
-        return []
+        return [[] for _ in frames]
 
-    results = yolo_model(frame)
-    results.render()
-    behavior_results = results.pandas().xyxy[0].to_dict(orient="records")
+    # Without rendering, frames are shrunk to the inference size up front (AutoShape would letterbox them
+    # anyway) and the boxes mapped back to full resolution. Rendering draws YOLO's own boxes onto the
+    # frames, so those are passed at full resolution as before. The list runs as one batch.
+    frame_scales = [1.0 if render else fit_scale(frame, size) for frame in frames]
+    results = yolo_model([resize(frame, scale) for frame, scale in zip(frames, frame_scales)], size=size)
+    if render:
+        results.render()
+    behavior_results = []
+    for detections, scale in zip(results.pandas().xyxy, frame_scales):
+        if scale != 1 and len(detections):
+            columns = ['xmin', 'ymin', 'xmax', 'ymax']
+            detections[columns] = remap_boxes(detections[columns].to_numpy(), scale)
+        behavior_results.append(detections.to_dict(orient="records"))
     return behavior_results
 
+def detect_behavior(frame):
+    return detect_behavior_batch([frame])[0]
+
 def save_behavior_to_db(db, student_id, behavior):
     behavior_history_collection = db['behavior_history']
     behavior_collection = db['behavior']
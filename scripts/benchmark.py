@@ -0,0 +1,365 @@
+import os
+import io
+import sys
+import json
+import time
+import glob
+import argparse
+import tempfile
+import platform
+import subprocess
+from contextlib import redirect_stdout
+from datetime import datetime
+from types import SimpleNamespace
+import cv2
+import numpy as np
+from bson import ObjectId
+import conn
+
+# Reproducible pipeline benchmark on synthetic classrooms, without a webcam or the Atlas cluster.
+#   python benchmark.py --out bench_baseline.json
+#   python benchmark.py --faces path/to/faces --compare bench_baseline.json
+#   python benchmark.py --replay lecture.rec --out scales.json   (detector input-scale speed/recall sweep)
+
+CLASS_SIZES = (10, 30, 60)
+FRAME_SIZE = (1920, 1080)
+DATABASE_NAME = 'FYP_db'
+
+
+def use_local_db(mongo_uri=None):
+    # Must run before any pipeline module is imported, since they call get_db() at import time
+    if mongo_uri:
+        import pymongo
+        client = pymongo.MongoClient(mongo_uri)
+        client.drop_database(f"{DATABASE_NAME}_bench")
+        bench_db = client[f"{DATABASE_NAME}_bench"]
+    else:
+        import mongomock
+        import mongomock.gridfs
+        mongomock.gridfs.enable_gridfs_integration()
+        bench_db = mongomock.MongoClient()[DATABASE_NAME]
+    conn.get_db = lambda: bench_db
+    return bench_db
+
+
+def generate_face(rng, size=160):
+    # Cartoon face used when no real face photos are supplied
+    face = np.full((size, size, 3), rng.integers(170, 230, 3), np.uint8)
+    skin = tuple(int(c) for c in rng.integers(90, 220, 3))
+    center = (size // 2, size // 2)
+    cv2.ellipse(face, center, (int(size * 0.34), int(size * 0.44)), 0, 0, 360, skin, -1)
+    eye_y = int(size * 0.42)
+    for eye_x in (int(size * 0.36), int(size * 0.64)):
+        cv2.circle(face, (eye_x, eye_y), max(2, size // 20), (40, 30, 30), -1)
+    cv2.ellipse(face, (size // 2, int(size * 0.55)), (size // 30, size // 12), 0, 0, 360, tuple(c - 30 for c in skin), -1)
+    cv2.ellipse(face, (size // 2, int(size * 0.7)), (size // 7, size // 18), 0, 0, 180, (60, 40, 120), -1)
+    return face
+
+
+def load_faces(faces_dir, count, rng):
+    faces = []
+    if faces_dir:
+        paths = sorted(p for ext in ('*.jpg', '*.jpeg', '*.png') for p in glob.glob(os.path.join(faces_dir, ext)))
+        for path in paths[:count]:
+            image = cv2.imread(path)
+            if image is not None:
+                faces.append(image)
+        if not faces:
+            print(f"No face images found in {faces_dir}, generating faces instead")
+    real = len(faces)
+    while len(faces) < count:
+        # Reuse real photos round-robin when there are fewer photos than students
+        faces.append(faces[len(faces) % real] if real else generate_face(rng))
+    return faces
+
+
+def tile_classroom(faces, n_students, rng):
+    # Lay students out in rows like a lecture hall, smaller towards the back
+    width, height = FRAME_SIZE
+    frame = np.empty((height, width, 3), np.uint8)
+    frame[:] = np.linspace(90, 160, height, dtype=np.uint8)[:, None, None]
+    cols = int(np.ceil(np.sqrt(n_students * width / height)))
+    rows = int(np.ceil(n_students / cols))
+    cell_w, cell_h = width // cols, height // rows
+    for i in range(n_students):
+        row, col = divmod(i, cols)
+        scale = 0.55 + 0.35 * (row + 1) / rows
+        side = int(min(cell_w, cell_h) * scale)
+        face = cv2.resize(faces[i % len(faces)], (side, side))
+        x = col * cell_w + (cell_w - side) // 2 + int(rng.integers(-4, 5))
+        y = row * cell_h + (cell_h - side) // 2
+        x, y = max(0, min(width - side, x)), max(0, min(height - side, y))
+        frame[y:y + side, x:x + side] = face
+    return frame
+
+
+def seed_db(bench_db, faces):
+    import gridfs
+    fs = gridfs.GridFS(bench_db)
+    class_id = bench_db['classes'].insert_one({
+        "name": "Benchmark", "type": "Lecture", "weekday": "Monday", "time": "08:00 - 10:00",
+        "status": "Active", "summary": len(faces), "createdBy": "benchmark",
+    }).inserted_id
+    for i, face in enumerate(faces):
+        ok, buffer = cv2.imencode('.jpg', cv2.copyMakeBorder(face, 80, 80, 80, 80, cv2.BORDER_CONSTANT, value=(200, 200, 200)))
+        image_id = fs.put(buffer.tobytes(), filename=f"bench_{i}_profile_image")
+        bench_db['students'].insert_one({
+            "name": f"Student {i}", "TPNumber": f"TP{i:06d}", "class_id": [class_id], "profile_image_id": image_id,
+        })
+    for behavior, weight in (('focus', 20), ('writing', 18), ('reading', 16), ('hand-raising', 20),
+                             ('distraction', 5), ('phone', 2), ('sleep', 0)):
+        bench_db['behavior'].insert_one({"behavior": behavior, "weight": weight})
+    return str(class_id)
+
+
+def measure(fn, repeats, warmup=1, items=1):
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        for _ in range(warmup):
+            fn()
+        latencies = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            fn()
+            latencies.append(time.perf_counter() - start)
+    latencies = np.array(latencies) * 1000
+    return {
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "mean_ms": float(latencies.mean()),
+        "throughput_per_s": float(items * 1000 / latencies.mean()),
+        "repeats": repeats,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+
+def run(opt):
+    rng = np.random.default_rng(opt.seed)
+    bench_db = use_local_db(opt.mongo_uri)
+    faces = load_faces(opt.faces, max(opt.sizes), rng)
+    class_id = seed_db(bench_db, faces)
+
+    # Pipeline modules connect to the database and load their models on import
+    import detect
+    from face_recognition import detect_and_encode, load_gallery_index
+    from emotions import detect_emotion
+    from behavior_detection import detect_behavior
+    from event_journal import EventJournal, connect, ship_pending
+    from label_durations import LabelDurations
+
+    with redirect_stdout(io.StringIO()):
+        face_gallery, gallery_students = load_gallery_index(bench_db, os.path.join(tempfile.mkdtemp(), 'gallery.npz'))
+    gallery = SimpleNamespace(gallery=face_gallery, gallery_students=gallery_students)
+    print(f"Gallery: {len(face_gallery)} of {len(faces)} synthetic students encoded")
+
+    results = {}
+    for n in opt.sizes:
+        frame = tile_classroom(faces, n, rng)
+        frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        with redirect_stdout(io.StringIO()):
+            encodings = detect_and_encode(frame_rgb) or [np.zeros((512,), np.float32)]
+        # No sync thread: shipping is timed as part of db_flush instead of competing with the other stages
+        journal = EventJournal(bench_db, os.path.join(tempfile.mkdtemp(), 'events.sqlite3'), sync=False)
+        shipper = connect(journal.path)
+        session = SimpleNamespace(
+            class_id=class_id,
+            journal=journal,
+            record_id=journal.create_record(class_id, 'benchmark'),
+            durations=LabelDurations(students=n),
+        )
+        for student_id in [ObjectId() for _ in range(n)]:
+            for t in (0, 1):
+                for kind, label in (('emotion', 'Happy'), ('emotion', 'Neutral'), ('behavior', 'focus'), ('behavior', 'writing')):
+                    session.durations.add(t, student_id, kind, label)
+
+        def flush():
+            detect.CombinedApp.save_all_to_db(session)
+            ship_pending(bench_db, shipper)
+
+        stages = {
+            'detect_and_encode': (lambda: detect_and_encode(frame_rgb), 1),
+            'detect_emotion': (lambda: detect_emotion(frame), 1),
+            'detect_behavior': (lambda: detect_behavior(frame.copy()), 1),
+            'gallery_matching': (lambda: [detect.CombinedApp.match_student(gallery, e) for e in encodings], len(encodings)),
+            # The session end through to the database, and as the frame loop sees it (local journal only)
+            'db_flush': (flush, 1),
+            'journal_append': (lambda: detect.CombinedApp.save_all_to_db(session), 1),
+        }
+        try:
+            for name, (fn, items) in stages.items():
+                if opt.stages and name not in opt.stages:
+                    continue
+                stats = measure(fn, opt.repeats, opt.warmup, items)
+                results.setdefault(name, {})[str(n)] = stats
+                print(f"{name:<18} {n:>3} students  p50 {stats['p50_ms']:8.1f} ms  p95 {stats['p95_ms']:8.1f} ms  "
+                      f"{stats['throughput_per_s']:8.2f}/s")
+        finally:
+            shipper.close()
+            with redirect_stdout(io.StringIO()):
+                journal.close()
+
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "date": datetime.now().isoformat(timespec='seconds'),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "faces": opt.faces or 'generated',
+            "database": opt.mongo_uri or 'mongomock',
+            "seed": opt.seed,
+        },
+        "results": results,
+    }
+
+
+def matched_fraction(reference, candidate, same=lambda a, b: True, iou=0.5):
+    # Share of reference boxes that some candidate box overlaps by at least iou
+    from scaling import box_iou
+    if not reference:
+        return None
+    hits = sum(any(same(r, c) and box_iou(r, c) >= iou for c in candidate) for r in reference)
+    return hits / len(reference)
+
+
+def summarize_sweep(name, setting, latencies, recalls):
+    recalls = [r for r in recalls if r is not None]
+    entry = {
+        "setting": setting,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "recall": float(np.mean(recalls)) if recalls else None,
+    }
+    recall = f"{entry['recall']:.3f}" if entry['recall'] is not None else '  n/a'
+    print(f"{name:<8} {str(setting):>6}  p50 {entry['p50_ms']:8.1f} ms  p95 {entry['p95_ms']:8.1f} ms  recall {recall}")
+    return entry
+
+
+def run_scale_sweep(opt):
+    # Speed and recall of each detector at reduced input scales, against its full-resolution output,
+    # on the frames of a session recording
+    from recording import read_recording
+    from scaling import InputScales, resize, remap_boxes
+    use_local_db(opt.mongo_uri)
+    from mtcnn_init import mtcnn
+    from face_recognition import detect_faces_batch
+    from emotions import detect_emotion_batch
+    from behavior_detection import detect_behavior_batch
+
+    frames = []
+    for i, (timestamp, data) in enumerate(read_recording(opt.replay)):
+        if i % opt.frame_stride == 0:
+            frames.append(cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR))
+        if len(frames) >= opt.max_frames:
+            break
+    print(f"Scale sweep on {len(frames)} frames of {opt.replay}")
+
+    def timed(fn):
+        with redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = fn()
+        return result, (time.perf_counter() - start) * 1000
+
+    report = {"mtcnn": [], "yolo": [], "mesh": []}
+
+    mtcnn_reference = []
+    for scale in [1.0] + [s for s in opt.mtcnn_scales if s != 1.0]:
+        mtcnn.min_face_size = InputScales(mtcnn_scale=scale, min_face_px=opt.min_face_px).mtcnn_min_face_size()
+        latencies, recalls = [], []
+        for i, frame in enumerate(frames):
+            rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            boxes, ms = timed(lambda: detect_faces_batch([resize(rgb, scale)])[0])
+            boxes = [] if boxes is None else list(remap_boxes(boxes, scale))
+            latencies.append(ms)
+            if scale == 1.0:
+                mtcnn_reference.append(boxes)
+            else:
+                recalls.append(matched_fraction(mtcnn_reference[i], boxes))
+        report["mtcnn"].append(summarize_sweep('mtcnn', scale, latencies, recalls))
+
+    yolo_reference = []
+    for size in [opt.yolo_reference] + [s for s in opt.yolo_sizes if s != opt.yolo_reference]:
+        latencies, recalls = [], []
+        for i, frame in enumerate(frames):
+            detections, ms = timed(lambda: detect_behavior_batch([frame], size, render=False)[0])
+            boxes = [(d['xmin'], d['ymin'], d['xmax'], d['ymax'], d['name']) for d in detections]
+            latencies.append(ms)
+            if size == opt.yolo_reference:
+                yolo_reference.append(boxes)
+            else:
+                recalls.append(matched_fraction(yolo_reference[i], boxes, same=lambda a, b: a[4] == b[4]))
+        report["yolo"].append(summarize_sweep('yolo', size, latencies, recalls))
+
+    mesh_reference = []
+    for scale in [1.0] + [s for s in opt.mesh_scales if s != 1.0]:
+        latencies, recalls = [], []
+        for i, frame in enumerate(frames):
+            emotions, ms = timed(lambda: detect_emotion_batch([frame], scale)[0])
+            boxes = [(lm[:, 0].min(), lm[:, 1].min(), lm[:, 0].max(), lm[:, 1].max()) for _, lm, _ in emotions]
+            latencies.append(ms)
+            if scale == 1.0:
+                mesh_reference.append(boxes)
+            else:
+                recalls.append(matched_fraction(mesh_reference[i], boxes))
+        report["mesh"].append(summarize_sweep('mesh', scale, latencies, recalls))
+
+    return {
+        "meta": {"commit": git_commit(), "date": datetime.now().isoformat(timespec='seconds'),
+                 "replay": opt.replay, "frames": len(frames), "min_face_px": opt.min_face_px},
+        "scale_sweep": report,
+    }
+
+
+def compare(report, baseline_path, tolerance):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\nCompared with {baseline_path} (commit {baseline['meta'].get('commit')}):")
+    regressions = 0
+    for name, by_size in report['results'].items():
+        for n, stats in by_size.items():
+            old = baseline['results'].get(name, {}).get(n)
+            if not old:
+                continue
+            change = stats['p50_ms'] / old['p50_ms'] - 1 if old['p50_ms'] else 0.0
+            flag = 'REGRESSION' if change > tolerance else ''
+            regressions += bool(flag)
+            print(f"{name:<18} {n:>3} students  p50 {old['p50_ms']:8.1f} -> {stats['p50_ms']:8.1f} ms ({change:+.1%}) {flag}")
+    return regressions
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--faces', help='directory of real face photos to tile (default: generated faces)')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(CLASS_SIZES), help='students per synthetic frame')
+    parser.add_argument('--stages', nargs='+', help='only run these stages')
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--mongo-uri', help='local mongod to use instead of mongomock, e.g. mongodb://localhost:27017')
+    parser.add_argument('--out', default='bench_baseline.json', help='where to save the JSON report')
+    parser.add_argument('--compare', help='baseline JSON to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='p50 slowdown reported as a regression')
+    parser.add_argument('--replay', help='session recording to run the detector input-scale sweep on instead')
+    parser.add_argument('--max-frames', type=int, default=200)
+    parser.add_argument('--frame-stride', type=int, default=5, help='use every n-th frame of the recording')
+    parser.add_argument('--mtcnn-scales', type=float, nargs='+', default=[0.75, 0.5, 0.35])
+    parser.add_argument('--mesh-scales', type=float, nargs='+', default=[0.75, 0.5])
+    parser.add_argument('--yolo-sizes', type=int, nargs='+', default=[960, 640, 480])
+    parser.add_argument('--yolo-reference', type=int, default=1280, help='YOLO size treated as ground truth')
+    parser.add_argument('--min-face-px', type=int, default=20)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    opt = parse_opt()
+    report = run_scale_sweep(opt) if opt.replay else run(opt)
+    with open(opt.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved benchmark report to {opt.out}")
+    if opt.compare and not opt.replay:
+        sys.exit(1 if compare(report, opt.compare, opt.tolerance) else 0)
@@ -0,0 +1,206 @@
+import os
+import re
+import csv
+import sys
+import zipfile
+import argparse
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import cv2
+import numpy as np
+from pymongo import UpdateOne
+
+# Bulk enrollment from a folder or zip of student photos named by TP number (TP012345.jpg, and
+# TP012345_2.jpg etc. for extra photos of the same student, which become extra enrollment samples).
+# Photos are decoded and face-checked in a process pool, the single face of each valid photo is embedded
+# in batches, and images, students and embeddings are written to the database in bulk. Every file ends up in the report with its outcome.
+#   python bulk_enroll.py photos.zip --report enrollment.csv
+#   python bulk_enroll.py photos/ --dry-run
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+TP_PATTERN = re.compile(r'^(TP\d+)(?:[_\-\s].*)?$', re.IGNORECASE)
+
+
+def list_photos(source):
+    # Returns [(file name, path or zip member)] for every image in the directory or archive
+    if zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            names = [name for name in archive.namelist() if not name.endswith('/')]
+    else:
+        names = [os.path.relpath(os.path.join(root, name), source) for root, _, files in os.walk(source) for name in files]
+    return sorted(name for name in names if name.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def tp_number(name):
+    match = TP_PATTERN.match(os.path.splitext(os.path.basename(name))[0])
+    return match.group(1).upper() if match else None
+
+
+def init_worker(threads):
+    import torch
+    torch.set_num_threads(threads)
+
+
+def check_photo(task):
+    # Runs in the pool: decode, find faces and cut out the face of a photo that has exactly one, together
+    # with the encoded thumbnail and face crop stored next to the photo (profile_images.py)
+    import profile_images
+    name, data, min_face_px = task
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        return name, 'unreadable', 'not a valid image', None, None
+    from embedding_service import detect_faces
+    image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    boxes = detect_faces([image_rgb])[0]
+    faces = 0 if boxes is None else len(boxes)
+    if faces == 0:
+        return name, 'no_face', 'no face found', None, None
+    if faces > 1:
+        return name, 'multiple_faces', f'{faces} faces found', None, None
+    x1, y1, x2, y2 = (int(v) for v in boxes[0])
+    if min(x2 - x1, y2 - y1) < min_face_px:
+        return name, 'face_too_small', f'face is {x2 - x1}x{y2 - y1}px', None, None
+    crop = profile_images.face_crop(image_rgb, boxes[0])
+    return name, 'ok', '', crop, (profile_images.thumbnail_bytes(image), profile_images.face_bytes(crop))
+
+
+def read_photos(source, names):
+    if zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            for name in names:
+                yield name, archive.read(name)
+    else:
+        for name in names:
+            with open(os.path.join(source, name), 'rb') as f:
+                yield name, f.read()
+
+
+def enroll(db, source, workers=None, batch_size=64, min_face_px=40, replace=False, dry_run=False):
+    import gridfs
+    import embedding_store
+    from embedding_service import encode_faces
+    fs = gridfs.GridFS(db)
+    embedder = os.environ.get('FYP_EMBEDDER', 'fp32')
+    names = list_photos(source)
+    report = {name: {"file": name, "tp_number": tp_number(name), "status": "", "detail": ""} for name in names}
+
+    # Match file names to students with a single query
+    numbers = {row["tp_number"] for row in report.values() if row["tp_number"]}
+    students = {s["TPNumber"].upper(): s for s in db["students"].find({"TPNumber": {"$in": list(numbers)}},
+                                                                       {"name": 1, "TPNumber": 1, "profile_image_id": 1,
+                                                                        "profile_thumbnail_id": 1, "profile_face_id": 1})}
+    candidates = []
+    for name, row in report.items():
+        if not row["tp_number"]:
+            row["status"], row["detail"] = 'bad_name', 'file name does not start with a TP number'
+        elif row["tp_number"] not in students:
+            row["status"], row["detail"] = 'unknown_tp', 'no student with this TP number'
+        elif students[row["tp_number"]].get("profile_image_id") and not replace:
+            row["status"], row["detail"] = 'already_enrolled', 'student has a photo, use --replace to overwrite'
+        else:
+            candidates.append(name)
+
+    # Decode and detect in worker processes
+    workers = workers or max(1, (os.cpu_count() or 1) - 1)
+    photos = dict(read_photos(source, candidates))
+    tasks = [(name, photos[name], min_face_px) for name in candidates]
+    crops, derivatives = {}, {}
+    with ProcessPoolExecutor(workers, mp_context=mp.get_context('spawn'), initializer=init_worker, initargs=(1,)) as pool:
+        for done, (name, status, detail, crop, encoded) in enumerate(pool.map(check_photo, tasks, chunksize=4), 1):
+            report[name]["status"], report[name]["detail"] = status, detail
+            if crop is not None:
+                crops[name], derivatives[name] = crop, encoded
+            if done % 50 == 0:
+                print(f"Checked {done}/{len(tasks)} photos")
+
+    # Every valid photo of a student is an enrollment sample; the first one becomes the profile photo
+    from face_index import TemplateGallery
+    by_student = {}
+    for name in crops:
+        tp = report[name]["tp_number"]
+        by_student.setdefault(tp, [])
+        if len(by_student[tp]) >= TemplateGallery.MAX_SAMPLES:
+            report[name]["status"], report[name]["detail"] = 'extra_sample', f'{tp} already has {TemplateGallery.MAX_SAMPLES} samples'
+        else:
+            by_student[tp].append(name)
+    valid = [name for names in by_student.values() for name in names]
+
+    # Embed the faces in batches
+    embeddings, model = {}, {}
+    for i in range(0, len(valid), batch_size):
+        batch = valid[i:i + batch_size]
+        for name, vector in zip(batch, encode_faces([crops[name] for name in batch], model)):
+            embeddings[name] = vector
+    for names in by_student.values():
+        for i, name in enumerate(names):
+            report[name]["status"] = ('enrolled' if i == 0 else 'sample') if not dry_run else 'valid'
+            report[name]["detail"] = f'sample {i + 1} of {len(names)}'
+
+    if dry_run or not by_student:
+        return list(report.values())
+
+    # Upload the profile photos with their thumbnails and face crops concurrently, then update students
+    # and store embeddings in one bulk write each
+    profiles = {tp: names[0] for tp, names in by_student.items()}
+
+    def upload(tp):
+        name, student_id = profiles[tp], students[tp]['_id']
+        thumbnail, face = derivatives[name]
+        return {"profile_image_id": fs.put(photos[name], filename=f"{student_id}_profile_image"),
+                "profile_thumbnail_id": fs.put(thumbnail, filename=f"{student_id}_profile_thumbnail"),
+                "profile_face_id": fs.put(face, filename=f"{student_id}_profile_face")}
+
+    with ThreadPoolExecutor(8) as uploader:
+        uploaded = dict(zip(profiles, uploader.map(upload, profiles)))
+    image_ids = {tp: files["profile_image_id"] for tp, files in uploaded.items()}
+    old_images = [students[tp].get("profile_image_id") for tp in profiles]
+    old_files = [students[tp].get(field) for tp in profiles for field in ("profile_thumbnail_id", "profile_face_id")]
+    db["students"].bulk_write([
+        UpdateOne({"_id": students[tp]["_id"]}, {"$set": uploaded[tp]})
+        for tp in profiles], ordered=False)
+    embedding_store.store_enrollments(
+        db, [(students[tp]["_id"], image_ids[tp], [embeddings[name] for name in names], None)
+             for tp, names in by_student.items()], embedder, model.get("model_version"))
+    for old_image in old_images:
+        if old_image:
+            fs.delete(old_image)
+            db[embedding_store.COLLECTION].delete_many({"image_id": old_image})
+    for old_file in old_files:
+        if old_file:
+            fs.delete(old_file)
+    return list(report.values())
+
+
+def print_report(rows):
+    counts = {}
+    for row in rows:
+        counts[row["status"]] = counts.get(row["status"], 0) + 1
+        if row["status"] not in ('enrolled', 'sample', 'valid'):
+            print(f"{row['file']:<40} {row['status']:<16} {row['detail']}")
+    print("\n" + ", ".join(f"{count} {status}" for status, count in sorted(counts.items())) + f" ({len(rows)} files)")
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('source', help='directory or zip of photos named by TP number')
+    parser.add_argument('--workers', type=int, help='decode/detect processes (default: cores - 1)')
+    parser.add_argument('--batch-size', type=int, default=64, help='faces per embedding batch')
+    parser.add_argument('--min-face-px', type=int, default=40, help='reject photos whose face is smaller than this')
+    parser.add_argument('--replace', action='store_true', help='replace the photo of students who already have one')
+    parser.add_argument('--dry-run', action='store_true', help='only check the photos, write nothing')
+    parser.add_argument('--report', help='save the per-file report as CSV')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    opt = parse_opt()
+    from conn import get_db
+    rows = enroll(get_db(), opt.source, opt.workers, opt.batch_size, opt.min_face_px, opt.replace, opt.dry_run)
+    print_report(rows)
+    if opt.report:
+        with open(opt.report, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=["file", "tp_number", "status", "detail"])
+            writer.writeheader()
+            writer.writerows(rows)
+        print(f"Saved report to {opt.report}")
+    sys.exit(0 if all(row["status"] in ('enrolled', 'sample', 'valid') for row in rows) else 1)
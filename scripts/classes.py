@@ -6,6 +6,7 @@ from PySide6.QtGui import QFont
 from PySide6.QtCore import Qt
 import subprocess
 from conn import get_db
+from intake_cache import intakes
 from bson.objectid import ObjectId
 from datetime import datetime
 
@@ -112,9 +113,7 @@ class ModernClassesTable(QMainWindow):
 
         for row, class_ in enumerate(cursor):
             self.table.insertRow(row)
-            intake_id = class_["intake"]
-            intake = intake_collection.find_one({"_id": intake_id})
-            intake_name = intake["intake"] if intake else "Unknown"
+            intake_name = intakes.name(db, class_["intake"])
             
             self.table.setItem(row, 0, QTableWidgetItem(class_["name"]))
             self.table.setItem(row, 1, QTableWidgetItem(class_["type"]))
@@ -208,8 +207,7 @@ class EditClassDialog(QDialog):
             start_time, end_time = class_data["time"].split(" - ")
             self.start_time_combo.setCurrentText(start_time)
             self.end_time_combo.setCurrentText(end_time)
-            intake = intake_collection.find_one({"_id": class_data["intake"]})
-            self.intake_input.setText(intake["intake"] if intake else "")
+            self.intake_input.setText(intakes.name(db, class_data["intake"], ""))
             self.status_combo.setCurrentText(class_data["status"])
 
     def update_end_time_options(self):
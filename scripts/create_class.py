@@ -3,11 +3,13 @@ from PySide6.QtWidgets import (QApplication, QWidget, QVBoxLayout, QHBoxLayout,
                                QPushButton, QComboBox, QTreeWidget, QTreeWidgetItem, QFileDialog,
                                QMessageBox, QScrollArea)
 from PySide6.QtGui import QFont
-from PySide6.QtCore import Qt
+from PySide6.QtCore import Qt, QObject, Signal
 import pandas as pd
 import subprocess
+import threading
 from datetime import datetime
 from bson import ObjectId
+from pymongo import UpdateOne
 from conn import get_db
 
 # Connect to MongoDB
@@ -16,10 +18,52 @@ class_collection = db["classes"]
 student_collection = db["students"]
 intake_collection = db["intake"]
 
+def save_class(new_class, roster):
+    # Inserts the class, then adds every (name, TP number) of the roster to it with one bulk upsert and
+    # sets its summary to the number of students the write touched. A TP number listed twice counts once.
+    # If the roster write fails, the class and the students' links to it are removed again. Returns the
+    # summary, or None if a class with the same name, type and weekday already exists.
+    if class_collection.find_one({"name": new_class["name"], "type": new_class["type"], "weekday": new_class["weekday"]}):
+        return None
+    first = {}
+    for student_name, tp_number in roster:
+        first.setdefault(tp_number, (student_name, tp_number))
+    roster = list(first.values())
+    class_id = class_collection.insert_one({**new_class, "summary": 0}).inserted_id
+    if not roster:
+        return 0
+    try:
+        result = student_collection.bulk_write([
+            UpdateOne({"TPNumber": tp_number},
+                      {"$addToSet": {"class_id": class_id},
+                       "$setOnInsert": {"name": student_name, "intake": new_class["intake"]}},
+                      upsert=True)
+            for student_name, tp_number in roster], ordered=False)
+    except Exception as e:
+        upserted = [op["_id"] for op in getattr(e, "details", {}).get("upserted", [])]
+        if upserted:
+            student_collection.delete_many({"_id": {"$in": upserted}})
+        student_collection.update_many({"class_id": class_id}, {"$pull": {"class_id": class_id}})
+        class_collection.delete_one({"_id": class_id})
+        raise
+    summary = result.matched_count + result.upserted_count
+    class_collection.update_one({"_id": class_id}, {"$set": {"summary": summary}})
+    return summary
+
+class SaveSignals(QObject):
+    # Emitted from the save thread; Qt delivers them on the UI thread
+    saved = Signal(int)
+    exists = Signal()
+    failed = Signal(str)
+
 class CreateClassPage(QWidget):
     def __init__(self, username):
         super().__init__()
         self.username = username
+        self.signals = SaveSignals()
+        self.signals.saved.connect(self.on_saved)
+        self.signals.exists.connect(self.on_exists)
+        self.signals.failed.connect(self.on_failed)
         self.initUI()
 
     def initUI(self):
@@ -108,7 +152,7 @@ class CreateClassPage(QWidget):
 
         # Buttons
         button_layout = QHBoxLayout()
-        create_button = QPushButton("Create")
+        self.create_button = create_button = QPushButton("Create")
         create_button.clicked.connect(self.create_class)
         clear_button = QPushButton("Clear")
         clear_button.clicked.connect(self.clear_students)
@@ -165,7 +209,6 @@ class CreateClassPage(QWidget):
         end_time = self.end_time.currentText().strip()
         intake_id = self.intake_combo.currentData()
         status = self.status.currentText().strip()
-        summary = self.student_tree.topLevelItemCount()  # Summary as a numeric value
         created_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
         if intake_id is None:
@@ -176,12 +219,17 @@ class CreateClassPage(QWidget):
             QMessageBox.warning(self, "Input Error", "Please fill in all fields")
             return
 
-        # Check if class with the same name, type, and weekday already exists
-        if class_collection.find_one({"name": class_name, "type": class_type, "weekday": class_weekday}):
-            QMessageBox.warning(self, "Creation Error", "Class with the same name, type, and weekday already exists")
-            return
+        roster = []
+        for i in range(self.student_tree.topLevelItemCount()):
+            item = self.student_tree.topLevelItem(i)
+            student_name = item.text(0).strip()
+            tp_number = item.text(1).strip()
+
+            if not all([student_name, tp_number]):
+                QMessageBox.warning(self, "Input Error", "Student fields cannot contain only blank spaces")
+                return
+            roster.append((student_name, tp_number))
 
-        # Insert class into class collection
         new_class = {
             "name": class_name,
             "type": class_type,
@@ -189,55 +237,44 @@ class CreateClassPage(QWidget):
             "time": f"{start_time} - {end_time}",
             "intake": intake_id,
             "status": status,
-            "summary": summary,
             "createdBy": self.username,
             "created_at": created_at
         }
-        class_collection.insert_one(new_class)
-        class_id = new_class["_id"]
 
-        # Insert students into student collection
-        for i in range(self.student_tree.topLevelItemCount()):
-            item = self.student_tree.topLevelItem(i)
-            student_name = item.text(0).strip()
-            tp_number = item.text(1).strip()
-
-            if not all([student_name, tp_number]):
-                QMessageBox.warning(self, "Input Error", "Student fields cannot contain only blank spaces")
-                return
+        # Save off the UI thread so a large roster does not freeze the form
+        self.create_button.setEnabled(False)
+        self.create_button.setText("Saving...")
+        threading.Thread(target=self.run_save, args=(new_class, roster), daemon=True).start()
 
-            student_doc = {
-                "name": student_name,
-                "TPNumber": tp_number,
-                "intake": intake_id,
-                "class_id": [class_id]  # Store class_id as an array
-            }
-            
-            # Check if student already exists
-            existing_student = student_collection.find_one({
-                "name": student_doc["name"],
-                "TPNumber": student_doc["TPNumber"],
-                "intake": student_doc["intake"]
-            })
-
-            if existing_student:
-                # Ensure class_id is an array
-                if not isinstance(existing_student.get("class_id"), list):
-                    existing_student["class_id"] = [existing_student["class_id"]]
-
-                # Update the class_id array if the student already exists
-                student_collection.update_one(
-                    {"_id": existing_student["_id"]},
-                    {"$addToSet": {"class_id": class_id}}
-                )
-            else:
-                # Insert the new student document
-                student_collection.insert_one(student_doc)
+    def run_save(self, new_class, roster):
+        try:
+            summary = save_class(new_class, roster)
+        except Exception as e:
+            self.signals.failed.emit(str(e))
+            return
+        if summary is None:
+            self.signals.exists.emit()
+        else:
+            self.signals.saved.emit(summary)
 
+    def on_saved(self, summary):
+        self.summary.setText(str(summary))
         QMessageBox.information(self, "Success", "Class and student details saved successfully!")
         self.clear_form()
         self.go_back()  # Navigate back to the main page
 
+    def on_exists(self):
+        self.reset_create_button()
+        QMessageBox.warning(self, "Creation Error", "Class with the same name, type, and weekday already exists")
+
+    def on_failed(self, error):
+        self.reset_create_button()
+        QMessageBox.critical(self, "Error", f"Could not save the class: {error}")
+
+    def reset_create_button(self):
+        self.create_button.setEnabled(True)
+        self.create_button.setText("Create")
+
     def clear_students(self):
         self.student_tree.clear()
         self.summary.clear()
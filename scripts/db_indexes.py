@@ -0,0 +1,97 @@
+import sys
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING
+
+# Indexes behind the records page and the student lookups, and a check that the queries on those paths
+# are answered from an index. Creating an index that already exists is a no-op, so ensure_indexes is
+# safe to call at every startup.
+#   python db_indexes.py           create the indexes, then explain every query path
+#   python db_indexes.py --check   only explain
+
+INDEXES = {
+    # Records page: a user's records, newest first (fetch_record_page)
+    'records': [[("created_by", ASCENDING), ("date", DESCENDING), ("_id", DESCENDING)]],
+    # Record details: history rows of one record (fetch_record_details)
+    'behavior_history': [[("recordID", ASCENDING)]],
+    'emotion_history': [[("recordID", ASCENDING)]],
+    # Student lookups by TP number (intake import, class creation, search), by class, and an intake's
+    # students by name (students page)
+    'students': [[("TPNumber", ASCENDING)], [("class_id", ASCENDING)],
+                 [("intake", ASCENDING), ("name", ASCENDING), ("_id", ASCENDING)]],
+}
+# A TP number belongs to one student; inserts of a taken TP number fail instead of duplicating the student
+UNIQUE = {('students', 'TPNumber_1')}
+# Name ordering and prefix search on the students page are case-insensitive; queries must pass the same collation
+STUDENT_NAME_COLLATION = {'locale': 'en', 'strength': 2}
+COLLATIONS = {('students', 'intake_1_name_1__id_1'): STUDENT_NAME_COLLATION}
+
+
+def has_duplicates(collection, field):
+    return bool(list(collection.aggregate([
+        {'$group': {'_id': f'${field}', 'count': {'$sum': 1}}}, {'$match': {'count': {'$gt': 1}}}, {'$limit': 1}])))
+
+
+def ensure_indexes(db):
+    for collection, indexes in INDEXES.items():
+        existing = db[collection].index_information()
+        for keys in indexes:
+            name = '_'.join(f"{field}_{direction}" for field, direction in keys)
+            unique = (collection, name) in UNIQUE
+            if unique and not existing.get(name, {}).get('unique') and has_duplicates(db[collection], keys[0][0]):
+                # Existing duplicates block a unique index; keep a plain one so lookups stay indexed
+                print(f"Duplicate values in {collection}.{keys[0][0]}, index {name} is not unique")
+                unique = False
+            if name in existing and existing[name].get('unique', False) != unique:
+                db[collection].drop_index(name)  # created before it was made unique
+            options = {'collation': COLLATIONS[(collection, name)]} if (collection, name) in COLLATIONS else {}
+            db[collection].create_index(keys, unique=unique, **options)
+
+
+def query_paths(db):
+    # (name, explain document) for every indexed query path; the values queried do not need to exist
+    record_id, student_id = ObjectId(), ObjectId()
+    yield 'records by creator', db.records.find({'created_by': ''}).sort([('date', -1), ('_id', -1)]).limit(50).explain()
+    yield 'record by id', db.command('aggregate', 'records', pipeline=[{'$match': {'_id': record_id}}], explain=True)
+    yield 'behaviors of record', db.behavior_history.find({'recordID': record_id}).explain()
+    yield 'emotions of record', db.emotion_history.find({'recordID': record_id}).explain()
+    yield 'students by id', db.students.find({'_id': {'$in': [student_id]}}).explain()
+    yield 'students by TP number', db.students.find({'TPNumber': {'$in': ['TP000000']}}).explain()
+    yield 'students of class', db.students.find({'class_id': ObjectId()}).explain()
+    yield 'students of intake', db.students.find({'intake': ObjectId()}).collation(STUDENT_NAME_COLLATION) \
+        .sort([('name', 1), ('_id', 1)]).limit(200).explain()
+    yield 'students by name prefix', db.students.find({'intake': {'$in': [ObjectId()]}, 'name': {'$gte': 'ab', '$lt': 'ab\uffff'}}) \
+        .collation(STUDENT_NAME_COLLATION).explain()
+    yield 'students by TP prefix', db.students.find({'TPNumber': {'$regex': '^TP01'}}).explain()
+
+
+def plan_stages(plan):
+    # Every stage name in a (possibly nested) explain document
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan['stage']
+        for value in plan.values():
+            yield from plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from plan_stages(value)
+
+
+def check_plans(db):
+    # Returns the names of the query paths whose winning plan scans a whole collection
+    failures = []
+    for name, explain in query_paths(db):
+        planner = explain.get('queryPlanner') or explain
+        stages = set(plan_stages(planner.get('winningPlan', explain)))
+        scanned = 'COLLSCAN' in stages
+        print(f"{name:<24} {'COLLSCAN' if scanned else 'ok'}  ({', '.join(sorted(stages))})")
+        if scanned:
+            failures.append(name)
+    return failures
+
+
+if __name__ == "__main__":
+    from conn import get_db
+    db = get_db()
+    if '--check' not in sys.argv:
+        ensure_indexes(db)
+    sys.exit(1 if check_plans(db) else 0)
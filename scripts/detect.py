@@ -1,5 +1,7 @@
 import os
 import sys
+import argparse
+import json
 from bson import ObjectId
 import tkinter as tk
 from tkinter import Label, Frame
@@ -10,23 +12,29 @@ import time
 import numpy as np
 from datetime import datetime
 from conn import get_db
-from face_recognition import detect_and_encode, recognize_faces, load_known_faces
-from emotions import detect_emotion
-from behavior_detection import detect_behavior
-from mtcnn_init import mtcnn  # Import MTCNN from the new module
+from tracing import tracer
+from recording import FrameRecorder, ReplayCapture, CODECS
+from streams import MultiCapture, open_source
+from scaling import scales, face_size_at_distance, box_iou, box_inside
+from face_quality import gate
+from workers import LocalInference, ProcessInference
+from embedder import EMBEDDERS, select_embedder
+from event_journal import EventJournal
+from session_events import SessionEvents, EVENTS_DIR
+from label_durations import LabelDurations, checkpoint_path, load_checkpoints, resumable
+from observations import Observation, dedupe_observations, best_face
 import main_page  # Import main_page
 
 # MongoDB setup
 db = get_db()
 
-def save_record(db, class_id, created_by):
-    record = {
-        "classID": class_id,
-        "date": datetime.now(),
-        "created_by": created_by,
-        "overall_performance": 0  # Initialize overall_performance
-    }
-    return db['records'].insert_one(record).inserted_id
+CANVAS_SIZE = (1280, 720)
+# How often the frame loop applies gallery changes found by the watcher thread
+GALLERY_APPLY_MS = 500
+# How often the per-student label durations are checkpointed to disk during a session
+CHECKPOINT_MS = 60000
+# A session of the same class started this soon after a crash continues the crashed one
+RESUME_WITHIN_S = 30 * 60
 
 def get_behavior_weights():
     behavior_weights = {}
@@ -35,17 +43,39 @@ def get_behavior_weights():
         behavior_weights[behavior['behavior']] = behavior['weight']
     return behavior_weights
 
+def duration_events(record_id, durations):
+    # Journal events for every label each student showed, with its seconds and episodes
+    return [(kind, record_id, student_id, label, json.dumps({"seconds": round(seconds, 1), "episodes": episodes}))
+            for kind in ('emotion', 'behavior')
+            for student_id, labels in durations.seen(kind).items()
+            for label, (seconds, episodes) in labels.items()]
+
+def overall_performance(durations, behavior_weights):
+    # Weights of every behavior each student showed: seen counts per behavior dotted with the weights
+    total_weight, total_behaviors = durations.weighted_score('behavior', behavior_weights)
+    return (total_weight / (total_behaviors * 20)) * 100 if total_behaviors > 0 else 0
+
 class CombinedApp:
-    def __init__(self, window, window_title, class_id, username):
+    def __init__(self, window, window_title, class_id, username, captures=None, recorders=None, inference=None):
         self.window = window
         self.window.title(window_title)
 
         self.class_id = class_id
         self.created_by = username
         self.record_id = None
-
-        # Load known faces
-        self.known_face_encodings, self.known_face_names, self.known_face_ids = load_known_faces(db)
+        self.recorders = list(recorders or [])
+        self.inference = inference or LocalInference()
+        # Records and detections go to the local journal; its sync worker ships them to MongoDB
+        self.journal = EventJournal(db)
+
+        # Load the gallery index of known faces. Imported here rather than at the top because inference
+        # worker processes re-import this module and should not load the face models unless they run them.
+        from face_recognition import load_gallery_index
+        from gallery_watch import watch_gallery
+        loaded_at = datetime.now()
+        self.gallery, self.gallery_students = load_gallery_index(db)
+        # Students enrolled, re-photographed, renamed or deleted during the session are watched for in the background
+        self.gallery_watcher = watch_gallery(db, self.gallery_students, loaded_at)
 
         # Create a main frame
         self.main_frame = tk.Frame(window)
@@ -55,18 +85,14 @@ class CombinedApp:
         self.video_frame = tk.Frame(self.main_frame)
         self.video_frame.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
 
-        # Open the video source
-        self.cap = cv2.VideoCapture(0)
+        # Open the video sources, at 1920x1080 by default (a ReplayCapture stands in for a camera when replaying)
+        self.cap = MultiCapture(captures or [open_source(0)])
         if not self.cap.isOpened():
             print("Failed to open video source")
             return
 
-        # Set the resolution to a larger size
-        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 1920)
-        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 1080)
-
         # Create a canvas to display the video
-        self.canvas = tk.Canvas(self.video_frame, width=1280, height=720)
+        self.canvas = tk.Canvas(self.video_frame, width=CANVAS_SIZE[0], height=CANVAS_SIZE[1])
         self.canvas.pack()
 
         # Create a frame for the buttons
@@ -109,15 +135,53 @@ class CombinedApp:
         self.window.protocol("WM_DELETE_WINDOW", self.on_closing)
         self.running = False
         self.paused = False
+        self.frame_index = 0
+        self.next_update_at = None
 
-        # Track detection history
-        self.behavior_history = {}
-        self.emotion_history = {}
+        # Seconds, episodes and last sighting of every label per student (see label_durations.py)
+        self.durations = LabelDurations(students=len(self.gallery_students) + 16)
+        # Time-stamped detections of the session, saved with the record (see session_events.py)
+        self.events = None
 
         # Display class details
         self.display_class_details()
 
         self.update()
+        self.window.after(GALLERY_APPLY_MS, self.apply_gallery_changes)
+        self.window.after(CHECKPOINT_MS, self.checkpoint_durations)
+
+    def checkpoint_path(self):
+        return checkpoint_path(EVENTS_DIR, self.record_id)
+
+    def checkpoint_durations(self):
+        if self.running and self.record_id is not None:
+            with tracer.span('durations_checkpoint', 'io', students=len(self.durations.students)):
+                self.durations.save(self.checkpoint_path(), record_id=str(self.record_id),
+                                    class_id=str(self.class_id), created_by=self.created_by)
+        self.window.after(CHECKPOINT_MS, self.checkpoint_durations)
+
+    def restore_checkpoint(self):
+        # Continues this class's session if it crashed less than RESUME_WITHIN_S ago; checkpoints too old
+        # to resume (of any class) are flushed to the journal under their own record
+        checkpoints = load_checkpoints(EVENTS_DIR)
+        resumed = resumable(checkpoints, RESUME_WITHIN_S, class_id=str(self.class_id), created_by=self.created_by)
+        for durations in checkpoints:
+            if durations is not resumed and time.time() - durations.saved_at > RESUME_WITHIN_S:
+                record_id = ObjectId(durations.meta["record_id"])
+                self.journal.append_many(duration_events(record_id, durations))
+                self.journal.append('performance', record_id, value=str(overall_performance(durations, get_behavior_weights())))
+                os.remove(durations.path)
+                print(f"Flushed the durations of interrupted session {record_id}")
+        if resumed is not None:
+            print(f"Resuming interrupted session {resumed.meta['record_id']} ({len(resumed.students)} students)")
+        return resumed
+
+    def apply_gallery_changes(self):
+        # Only in-memory updates here; the watcher thread has already read everything from the database
+        from gallery_watch import apply_changes
+        with tracer.span('gallery_apply', 'gallery'):
+            apply_changes(self.gallery_watcher, self.gallery, self.gallery_students)
+        self.window.after(GALLERY_APPLY_MS, self.apply_gallery_changes)
 
     def display_class_details(self):
         try:
@@ -138,9 +202,16 @@ class CombinedApp:
             tk.Label(self.details_frame, text=f"Error retrieving class details: {e}", font=("Helvetica", 14)).pack(pady=10)
 
     def start_camera(self):
+        if self.running:
+            return  # already started; resuming now would pick up this session's own checkpoint
         self.running = True
         self.paused = False
-        self.record_id = save_record(db, self.class_id, self.created_by)  # Save the record when starting the camera
+        resumed = self.restore_checkpoint()
+        if resumed is not None:
+            self.record_id, self.durations = ObjectId(resumed.meta["record_id"]), resumed
+        else:
+            self.record_id = self.journal.create_record(self.class_id, self.created_by)  # Save the record when starting the camera
+        self.events = SessionEvents()
         self.update() 
         
     def pause_camera(self):
@@ -152,22 +223,36 @@ class CombinedApp:
 
     def stop_camera(self):
         self.running = False
+        self.gallery_watcher.stop()
         self.cap.release()
+        self.close_recorder()
+        self.inference.close()
+        print(gate.summary())
 
-        self.save_all_to_db()
-        self.calculate_overall_performance()  # Calculate overall performance
+        self.finish_session()
+        self.journal.close()
+        tracer.save()
         self.window.destroy()
         
         # Run the main_page script
         main_page.main_page(self.created_by)
+
+    def finish_session(self):
+        # Flushes the session's durations, performance and events to the journal and drops its checkpoint,
+        # so only a session that crashed is resumed
+        if self.record_id is None:
+            return
+        self.save_all_to_db()
+        self.calculate_overall_performance()  # Calculate overall performance
+        if os.path.exists(self.checkpoint_path()):
+            os.remove(self.checkpoint_path())  # flushed to the journal
+        if self.events is not None:
+            self.events.save(self.journal, self.record_id, self.class_id)
     
     def save_all_to_db(self):
-        for student_id, emotions in self.emotion_history.items():
-            for emotion, timestamp in emotions.items():
-                save_emotion_to_db(db, student_id, emotion, self.class_id, self.record_id)
-        for student_id, behaviors in self.behavior_history.items():
-            for behavior, timestamp in behaviors.items():
-                save_behavior_to_db(db, student_id, behavior, self.class_id, self.record_id)
+        # Every label each student showed, with its seconds and episodes, in one journal transaction
+        with tracer.span('db_flush', 'db', students=len(self.durations.students)):
+            self.journal.append_many(duration_events(self.record_id, self.durations))
 
 
 
@@ -175,273 +260,238 @@ class CombinedApp:
           # Get weights for each behavior from the behavior collection
         behavior_weights = get_behavior_weights()
         
-        total_weight = 0
-        total_behaviors = 0
-
-        for student_id, behaviors in self.behavior_history.items():
-            for behavior in behaviors:
-                total_weight += behavior_weights.get(behavior, 0)
-                total_behaviors += 1
-
-        overall_performance = (total_weight / (total_behaviors * 20)) * 100 if total_behaviors > 0 else 0
-
         # Update the record with the overall performance
-        db['records'].update_one(
-            {"_id": ObjectId(self.record_id)},
-            {"$set": {"overall_performance": overall_performance}}
-        )
+        self.journal.append('performance', self.record_id, value=str(overall_performance(self.durations, behavior_weights)))
 
     def update(self):
         if self.running and not self.paused:
+            if self.next_update_at is not None:
+                tracer.wait('tk_event_loop', self.next_update_at)
             start_time = time.time()
-            ret, frame = self.cap.read()
+            self.frame_index += 1
+            with tracer.span('read', frame=self.frame_index, streams=len(self.cap)):
+                ret, frames = self.cap.read()
+            if ret:
+                for recorder, frame in zip(self.recorders, frames):
+                    recorder.write(frame, start_time)
+            elif not self.cap.isOpened() and any(isinstance(cap, ReplayCapture) for cap in self.cap.captures):
+                print("Replay finished")
+                self.stop_camera()
+                return
             if ret:
-                # Face detection and recognition
-                if self.face_var.get():
-                    try:
-                        frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                        test_face_encodings = detect_and_encode(frame_rgb)
-                        print(f"Detected {len(test_face_encodings)} faces")
-
-                        if test_face_encodings:
-                            for test_encoding, box in zip(test_face_encodings, mtcnn.detect(frame_rgb)[0]):
-                                student_id, student_name = self.get_student_info(test_encoding, "face")
-                                print(f"Student ID: {student_id}, Student Name: {student_name}")
-                                if student_id and student_name and box is not None:
-                                    (x1, y1, x2, y2) = map(int, box)
-                                    cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
-                                    cv2.putText(frame, student_name, (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2, cv2.LINE_AA)
-
-                                    # Save the student information based on the detected name
-                                    if student_name:
-                                        detected_student_id, detected_student_name = self.get_student_info(test_encoding, "face")
-                                        if detected_student_id and detected_student_name:
-                                            # Add logic to save or handle detected student information
-                                            print(f"Detected student for saving: ID={detected_student_id}, name={detected_student_name}")
-                    except Exception as e:
-                        print(f"Face recognition failed: {e}")
-
-
-                # Detect emotions
-                if self.emotion_var.get():
-                    try:
-                        emotions = self.process_emotion_detection(frame)
-                        current_time = time.time()
-                        for emotion, landmarks in emotions:
-                            # Convert landmarks to a format suitable for get_student_info
-                            face_encoding = self.get_face_encoding(frame, landmarks)
-                            print(f"Face encoding shape: {face_encoding.shape}")
-                            print(f"Landmarks shape: {landmarks.shape}")
-                            try:
-                                emotion_student_id, emotion_student_name = self.get_student_info(face_encoding, "emotion")
-                                print(f"Emotion Detection: Student ID: {emotion_student_id}, Student Name: {emotion_student_name}")
-                            except Exception as e:
-                                print(f"Error in get_student_info: {e}")
-                                print(f"Traceback: {traceback.format_exc()}")
-                                continue
-                            
-                            if emotion_student_id and emotion_student_name:
-                                if emotion_student_id not in self.emotion_history:
-                                    self.emotion_history[emotion_student_id] = {}
-                                if emotion not in self.emotion_history[emotion_student_id]:
-                                    self.emotion_history[emotion_student_id][emotion] = current_time
-
-                                # Draw landmarks and emotion label
-                                for (x, y, _) in landmarks:
-                                    cv2.circle(frame, (int(x), int(y)), 1, (0, 255, 0), -1)
-                                
-                                # Use the first landmark for text positioning
-                                text_x, text_y, _ = landmarks[0]
-                                cv2.putText(frame, f'Emotion: {emotion}', (int(text_x), int(text_y) - 10), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2, cv2.LINE_AA)
-                    except Exception as e:
-                        print(f"Emotion detection failed: {e}")
-                        print(f"Traceback: {traceback.format_exc()}")
-
-
-                # Perform YOLOv5 inference for behavior detection
-                if self.behavior_var.get():
-                    try:
-                        results = detect_behavior(frame)
-                        if isinstance(results, list):
-                            print(f"YOLOv5 inference results: {results}")  # Debug statement
-                            current_time = time.time()
-                            for behavior in results:
-                                behavior_label = behavior['name']
-                                xmin, ymin, xmax, ymax = behavior['xmin'], behavior['ymin'], behavior['xmax'], behavior['ymax']
-                                # Here we extract an encoding for the detected region
-                                region = frame[int(ymin):int(ymax), int(xmin):int(xmax)]
-                                region_rgb = cv2.cvtColor(region, cv2.COLOR_BGR2RGB)
-                                test_face_encodings = detect_and_encode(region_rgb)
-                                if test_face_encodings:
-                                    detected_encoding = test_face_encodings[0]
-                                    student_id, student_name = self.get_student_info(detected_encoding, "behavior")
-                                    if student_id and student_name:
-                                        if student_id not in self.behavior_history:
-                                            self.behavior_history[student_id] = {}
-                                        if behavior_label not in self.behavior_history[student_id]:
-                                            self.behavior_history[student_id][behavior_label] = current_time
-                                        else:
-                                            if current_time - self.behavior_history[student_id][behavior_label] >= 10:
-                                                save_behavior_to_db(db, student_id, behavior_label, self.class_id, self.record_id)
-                                                del self.behavior_history[student_id][behavior_label]
-
-                                        # Optionally, draw bounding boxes on the image
-                                        cv2.rectangle(frame, (int(xmin), int(ymin)), (int(xmax), int(ymax)), (0, 0, 255), 2)
-                        else:
-                            print(f"YOLOv5 inference failed: Invalid results object")
-                    except Exception as e:
-                        print(f"YOLOv5 inference failed: {e}")
-
-                # Convert the frame to RGB
-                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-
-                # Convert the frame to a format suitable for Tkinter
-                frame_pil = Image.fromarray(frame)
-                frame_tk = ImageTk.PhotoImage(image=frame_pil)
-
-                # Update the canvas with the new frame
-                self.canvas.create_image(0, 0, anchor=tk.NW, image=frame_tk)
-                self.canvas.image = frame_tk
+                try:
+                    observations = self.process_frames(frames)
+                    self.apply_observations(observations, time.time())
+                    self.draw_observations(frames, observations)
+                except Exception as e:
+                    print(f"Frame processing failed: {e}")
+                    print(f"Traceback: {traceback.format_exc()}")
+
+                with tracer.span('render', frame=self.frame_index):
+                    # Convert the frame to RGB
+                    frame = cv2.cvtColor(self.compose_view(frames), cv2.COLOR_BGR2RGB)
+
+                    # Convert the frame to a format suitable for Tkinter
+                    frame_pil = Image.fromarray(frame)
+                    frame_tk = ImageTk.PhotoImage(image=frame_pil)
+
+                    # Update the canvas with the new frame
+                    self.canvas.create_image(0, 0, anchor=tk.NW, image=frame_tk)
+                    self.canvas.image = frame_tk
 
                 # Calculate and display FPS
                 end_time = time.time()
                 fps = 1 / (end_time - start_time)
                 self.label_fps.config(text=f"FPS: {fps:.2f}")
+                tracer.complete('frame', start_time, end_time - start_time, frame=self.frame_index)
 
+            self.next_update_at = time.time()
             self.window.after(10, self.update)
 
-    def get_student_info(self, detected_encoding, type):
-        if not self.known_face_encodings:
-            return None, None
-
-        print(f"Detected encoding shape: {detected_encoding.shape}")
-        print(f"Known encoding shape: {self.known_face_encodings[0].shape}")
-
-        if detected_encoding.shape != self.known_face_encodings[0].shape:
-            print("Shape mismatch detected. Using alternative comparison method.")
-            
-            from scipy.spatial.distance import cosine
-            distances = [cosine(detected_encoding, known_encoding[:3]) for known_encoding in self.known_face_encodings]
-            print(f"Using cosine similarity distances: {distances}")
-        else:
-            distances = [np.linalg.norm(detected_encoding - known_encoding) for known_encoding in self.known_face_encodings]
-            print(f"Using Euclidean distances: {distances}")
-
-        if not distances:
-            return None, None
-
-        min_distance_index = np.argmin(distances)
-        min_distance = distances[min_distance_index]
-        print(f"Min distance: {min_distance}")
+    def process_frames(self, frames):
+        # Each model runs once per tick on a batch spanning every camera stream.
+        # Faces are detected and matched once and then shared by the emotion and behavior stages.
+        observations = []
+        if not (self.face_var.get() or self.emotion_var.get() or self.behavior_var.get()):
+            return observations
+
+        families = ['face']
+        if self.emotion_var.get():
+            families.append('emotion')
+        if self.behavior_var.get():
+            families.append('behavior')
+        with tracer.span('inference', frame=self.frame_index, families=','.join(families)):
+            outputs = self.inference.run(frames, families)
+
+        with tracer.span('match', frame=self.frame_index):
+            faces = []  # per stream: (box, student_id, student_name, distance)
+            for encodings, boxes in outputs.get('face') or [([], []) for _ in frames]:
+                faces.append([(box, *self.match_student(encoding)) for encoding, box in zip(encodings, boxes)])
+            print(f"Detected {sum(len(stream_faces) for stream_faces in faces)} faces")
+            if self.face_var.get():
+                for stream, stream_faces in enumerate(faces):
+                    for box, student_id, student_name, distance in stream_faces:
+                        if student_id and student_name:
+                            observations.append(Observation('face', student_id, student_name, None, distance, stream, box))
+
+        # Attribute emotions to the matched face they overlap most
+        if outputs.get('emotion'):
+            with tracer.span('emotion_match', frame=self.frame_index):
+                for stream, emotions in enumerate(outputs['emotion']):
+                    for emotion, landmarks, confidence in emotions:
+                        mesh_box = (landmarks[:, 0].min(), landmarks[:, 1].min(), landmarks[:, 0].max(), landmarks[:, 1].max())
+                        face = best_face(faces[stream], lambda box: box_iou(box, mesh_box))
+                        if face is not None:
+                            box, student_id, student_name, distance = face
+                            observations.append(Observation('emotion', student_id, student_name, emotion, distance, stream, landmarks, confidence))
+
+        # Attribute YOLOv5 behaviors to the matched face inside each box
+        if outputs.get('behavior'):
+            with tracer.span('behavior_match', frame=self.frame_index):
+                for stream, results in enumerate(outputs['behavior']):
+                    for behavior in results:
+                        region = (behavior['xmin'], behavior['ymin'], behavior['xmax'], behavior['ymax'])
+                        face = best_face(faces[stream], lambda box: box_inside(box, region))
+                        if face is not None:
+                            box, student_id, student_name, distance = face
+                            observations.append(Observation('behavior', student_id, student_name, behavior['name'], distance, stream, region,
+                                                            behavior['confidence']))
+
+        return dedupe_observations(observations)
+
+    def apply_observations(self, observations, current_time):
+        for obs in observations:
+            if obs.kind == 'face':
+                continue
+            self.durations.add(current_time, obs.student_id, obs.kind, obs.label)
+            if self.events is not None:
+                self.events.add(current_time, obs.student_id, obs.kind, obs.label, obs.confidence)
+
+    def draw_observations(self, frames, observations):
+        for obs in observations:
+            frame = frames[obs.stream]
+            if obs.kind == 'face':
+                (x1, y1, x2, y2) = map(int, obs.geometry)
+                cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
+                cv2.putText(frame, obs.student_name, (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2, cv2.LINE_AA)
+            elif obs.kind == 'emotion':
+                # Draw landmarks and emotion label, using the first landmark for text positioning
+                for (x, y, _) in obs.geometry:
+                    cv2.circle(frame, (int(x), int(y)), 1, (0, 255, 0), -1)
+                text_x, text_y, _ = obs.geometry[0]
+                cv2.putText(frame, f'Emotion: {obs.label}', (int(text_x), int(text_y) - 10), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2, cv2.LINE_AA)
+            elif obs.kind == 'behavior':
+                xmin, ymin, xmax, ymax = map(int, obs.geometry)
+                cv2.rectangle(frame, (xmin, ymin), (xmax, ymax), (0, 0, 255), 2)
+                cv2.putText(frame, obs.label, (xmin, ymax + 25), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2, cv2.LINE_AA)
+
+    def compose_view(self, frames):
+        # A single camera is shown as before, several cameras are tiled onto the canvas
+        if len(frames) == 1:
+            return frames[0]
+        cols = int(np.ceil(np.sqrt(len(frames))))
+        rows = int(np.ceil(len(frames) / cols))
+        cell_w, cell_h = CANVAS_SIZE[0] // cols, CANVAS_SIZE[1] // rows
+        view = np.zeros((CANVAS_SIZE[1], CANVAS_SIZE[0], 3), np.uint8)
+        for i, frame in enumerate(frames):
+            row, col = divmod(i, cols)
+            view[row * cell_h:(row + 1) * cell_h, col * cell_w:(col + 1) * cell_w] = cv2.resize(frame, (cell_w, cell_h))
+        return view
+
+    def match_student(self, detected_encoding):
+        if not len(self.gallery):
+            return None, None, None
+
+        if detected_encoding.shape != (self.gallery.dim,):
+            print("Shape mismatch detected, cannot compare with the gallery.")
+            return None, None, None
+
+        # Matched against the students' templates, and their individual samples when that is ambiguous
+        threshold = 0.7
+        label, min_distance = self.gallery.match(detected_encoding[None], threshold)[0]
+        if label is not None:
+            student_id, student_name = self.gallery_students[label]
+            return student_id, student_name, min_distance
+        return None, None, min_distance
 
-        threshold = 0.3 if detected_encoding.shape != self.known_face_encodings[0].shape else 0.7
-
-        if min_distance < threshold:
-            student_id = self.known_face_ids[min_distance_index]
-            student_name = self.known_face_names[min_distance_index]
+    def get_student_info(self, detected_encoding, type):
+        student_id, student_name, distance = self.match_student(detected_encoding)
+        if student_id is not None:
             print(f"Identified student: ID={student_id}, name={student_name}, type={type}")
-            return student_id, student_name
-        return None, None
+        return student_id, student_name
 
+    def close_recorder(self):
+        for recorder in self.recorders:
+            recorder.close()
+        self.recorders = []
 
     def on_closing(self):
         self.running = False
+        self.gallery_watcher.stop()
         self.cap.release()
+        self.close_recorder()
+        self.inference.close()
+        print(gate.summary())
+        self.finish_session()
+        self.journal.close()
+        tracer.save()
         self.window.destroy()
-        
-    def process_emotion_detection(self, frame):
-        try:
-            emotions = detect_emotion(frame)
-            detected_emotions = []  # List to store detected emotions and their landmarks
-            
-            for emotion, landmarks in emotions:
-                face_encoding = self.get_face_encoding(frame, landmarks)  # Get face encoding using the same method as face recognition
-                print(f"Emotion Detection: Face encoding shape: {face_encoding.shape}")
-                print(f"Emotion Detection: Landmarks shape: {landmarks.shape}")
-                try:
-                    student_id, student_name = self.get_student_info(face_encoding, "emotion")
-                    print(f"Emotion Detection: Student ID: {student_id}, Student Name: {student_name}")
-                except Exception as e:
-                    print(f"Error in get_student_info during emotion detection: {e}")
-                    print(f"Traceback: {traceback.format_exc()}")
-                    continue
-
-                if student_id and student_name:
-                    if student_id not in self.emotion_history:
-                        self.emotion_history[student_id] = {}
-                    if emotion not in self.emotion_history[student_id]:
-                        self.emotion_history[student_id][emotion] = time.time()
-                    detected_emotions.append((emotion, landmarks))
-                    for (x, y, _) in landmarks:
-                        cv2.circle(frame, (int(x), int(y)), 1, (0, 255, 0), -1)
-
-                    text_x, text_y, _ = landmarks[0]
-                    cv2.putText(frame, f'Emotion: {emotion}', (int(text_x), int(text_y) - 10), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2, cv2.LINE_AA)
-                        
-            return detected_emotions
-        except Exception as e:
-            print(f"Emotion detection failed: {e}")
-            print(f"Traceback: {traceback.format_exc()}")
-            return []
-
-    def get_face_encoding(self, frame, landmarks):
-        # Convert landmarks to a format suitable for face_recognition
-        face_encoding = detect_and_encode(frame)  # Use the same method as face recognition
-        if face_encoding:
-            return face_encoding[0]
-        else:
-            return np.zeros((512,))  # Return a zero vector if no encoding is found
-
 
 
-def save_emotion_to_db(db, student_id, emotion_label, class_id, record_id):
-    try:
-        # Check if an entry already exists for the student and record
-        existing_record = db['emotion_history'].find_one({"studentID": student_id, "recordID": record_id})
-        
-        if existing_record:
-            # Update the existing record with the new emotion
-            db['emotion_history'].update_one(
-                {"_id": existing_record["_id"]},
-                {"$addToSet": {"emotions": emotion_label}}  # Use addToSet to avoid duplicates in the list
-            )
-        else:
-            # Insert a new record
-            db['emotion_history'].insert_one({
-                "studentID": student_id,
-                "emotions": [emotion_label],  # Store emotions as a list
-                "recordID": record_id
-            })
-    except Exception as e:
-        print(f"Failed to save emotion {emotion_label} for student {student_id}: {e}")
-
-def save_behavior_to_db(db, student_id, behavior_label, class_id, record_id):
-    try:
-        # Check if an entry already exists for the student and record
-        existing_record = db['behavior_history'].find_one({"studentID": student_id, "recordID": record_id})
-        
-        if existing_record:
-            # Update the existing record with the new behavior
-            db['behavior_history'].update_one(
-                {"_id": existing_record["_id"]},
-                {"$addToSet": {"behaviors": behavior_label}}  # Use addToSet to avoid duplicates in the list
-            )
-        else:
-            # Insert a new record
-            db['behavior_history'].insert_one({
-                "studentID": student_id,
-                "behaviors": [behavior_label],  # Store behaviors as a list
-                "recordID": record_id
-            })
-    except Exception as e:
-        print(f"Failed to save behavior {behavior_label} for student {student_id}: {e}")
+def recording_path(path, stream, streams):
+    # One recording per camera: session.rec becomes session_0.rec, session_1.rec, ...
+    if streams == 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}_{stream}{ext}"
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("class_id", help="class to run the session for")
+    parser.add_argument("username", help="lecturer running the session")
+    parser.add_argument("--trace", metavar="PATH", help="write a Chrome trace-event JSON of the session to PATH")
+    parser.add_argument("--source", nargs="+", default=["0"],
+                        help="cameras (index or stream URL) or recordings to run the session on, all processed together")
+    parser.add_argument("--yolo-size", type=int, default=640, help="long side of the frame YOLO sees")
+    parser.add_argument("--mtcnn-scale", type=float, default=0.5, help="resize factor for MTCNN face detection")
+    parser.add_argument("--mesh-scale", type=float, default=0.5, help="resize factor for the emotion stage's FaceMesh")
+    parser.add_argument("--min-face-px", type=int, default=20, help="smallest face to detect, in full-resolution pixels")
+    parser.add_argument("--back-row-distance", type=float, metavar="METRES",
+                        help="derive --min-face-px from the distance of the back row to the camera")
+    parser.add_argument("--workers", action="store_true",
+                        help="run each detector family in its own process, fed through shared memory")
+    # Off by default: the size term alone scores a 30 px back-row face below 0.3, so a threshold should be
+    # chosen on a recorded replay of the room (the session summary reports how many faces it skipped)
+    parser.add_argument("--quality-threshold", type=float, default=0.0,
+                        help="skip faces whose quality score (size, detection probability, sharpness, yaw) is below this, 0 disables")
+    parser.add_argument("--embedder", choices=list(EMBEDDERS), default="fp32",
+                        help="face embedder variant, int8 needs the model built by embedder.py --build")
+    parser.add_argument("--record", metavar="PATH", help="record the raw camera frames of the session to PATH")
+    parser.add_argument("--codec", choices=list(CODECS), default="jpg", help="png is lossless, jpg is quality 95")
+    parser.add_argument("--replay", metavar="PATH", help="feed a recorded session through the pipeline instead of the webcam")
+    parser.add_argument("--replay-speed", choices=["original", "max"], default="max",
+                        help="pace frames by their capture timestamps or run as fast as possible")
+    return parser.parse_args()
 
 if __name__ == "__main__":
     if len(sys.argv) > 2:
-        class_id = sys.argv[1]
-        username = sys.argv[2]
+        opt = parse_opt()
+        if opt.trace:
+            tracer.start(opt.trace)
+        select_embedder(opt.embedder)
+        scales.yolo_size, scales.mtcnn_scale, scales.mesh_scale = opt.yolo_size, opt.mtcnn_scale, opt.mesh_scale
+        if opt.back_row_distance:
+            # Leave some margin below the expected back-row face size
+            scales.min_face_px = int(0.8 * face_size_at_distance(opt.back_row_distance, 1920))
+        else:
+            scales.min_face_px = opt.min_face_px
+        gate.threshold = opt.quality_threshold
+        sources = [opt.replay] if opt.replay else opt.source
+        captures = [open_source(source, opt.replay_speed) for source in sources]
+        recorders = [FrameRecorder(recording_path(opt.record, i, len(sources)), opt.codec) for i in range(len(sources))] if opt.record else []
+        inference = ProcessInference(slots=2 * len(sources)) if opt.workers else None
         root = tk.Tk()
-        app = CombinedApp(root, "Student Behavior Detection", class_id, username)
+        app = CombinedApp(root, "Student Behavior Detection", opt.class_id, opt.username, captures, recorders, inference)
         root.mainloop()
     else:
         print("Class ID or Username not provided.")
\ No newline at end of file
@@ -0,0 +1,224 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+
+# Face embedder variants. 'fp32' is the eager InceptionResnetV1 from facenet_pytorch; 'int8' is the same
+# network statically quantized to INT8 (FX graph mode, calibrated on our enrollment photos) and saved
+# as a frozen TorchScript module. The variant is chosen at startup with --embedder or FYP_EMBEDDER and
+# is inherited by worker processes, so the gallery and the live faces always use the same one.
+# torch is imported inside the functions so that choosing a variant does not load it.
+#   python embedder.py --build                 (calibrate, save models/inception_resnet_int8.pt, report)
+#   python embedder.py --report int8.json      (report on the cached model)
+# The first --calibration-faces enrollment faces (in student _id order) calibrate the model; the report
+# only uses the faces after them, so its accuracy is measured on faces the model was not calibrated on.
+
+EMBEDDERS = ('fp32', 'int8')
+QUANTIZED_PATH = 'models/inception_resnet_int8.pt'
+# detect.py accepts a match below this distance, so it is where verification is scored
+MATCH_THRESHOLD = 0.7
+# Stored with every embedding; bump a version when the weights or preprocessing of a variant change so
+# that embeddings made by the old model are no longer used and get re-encoded
+MODEL_VERSIONS = {'fp32': 'inception_resnet_v1-vggface2-1', 'int8': 'inception_resnet_v1-vggface2-int8fx-1'}
+
+
+def select_embedder(variant):
+    if variant not in EMBEDDERS:
+        raise ValueError(f"Unknown embedder {variant}, expected one of {EMBEDDERS}")
+    os.environ['FYP_EMBEDDER'] = variant
+
+
+def model_version(variant=None, path=QUANTIZED_PATH):
+    # The version of the model load_embedder(variant) actually loads (int8 falls back to fp32 until built)
+    variant = variant or os.environ.get('FYP_EMBEDDER', 'fp32')
+    if variant == 'int8' and not os.path.exists(path):
+        variant = 'fp32'
+    return MODEL_VERSIONS[variant]
+
+
+def quantized_engine():
+    import torch
+    engines = torch.backends.quantized.supported_engines
+    return 'x86' if 'x86' in engines else 'fbgemm'
+
+
+def load_fp32():
+    from facenet_pytorch import InceptionResnetV1
+    return InceptionResnetV1(pretrained='vggface2').eval()
+
+
+def load_quantized(path=QUANTIZED_PATH):
+    import torch
+    torch.backends.quantized.engine = quantized_engine()
+    return torch.jit.load(path).eval()
+
+
+def load_embedder(variant=None, path=QUANTIZED_PATH):
+    variant = variant or os.environ.get('FYP_EMBEDDER', 'fp32')
+    if variant == 'int8':
+        if os.path.exists(path):
+            return load_quantized(path)
+        print(f"No quantized embedder at {path} (run embedder.py --build), using fp32")
+    return load_fp32()
+
+
+def enrollment_crops(db, limit=None):
+    # One face crop per enrolled student photo, in student _id order: the stored face crop where there is
+    # one, otherwise MTCNN on the photo in GridFS
+    import cv2
+    import gridfs
+    from face_recognition import crop_faces
+    from profile_images import decode_face
+    fs = gridfs.GridFS(db)
+    crops = []
+    for student in db['students'].find({"profile_image_id": {"$exists": True}}, {"profile_image_id": 1, "profile_face_id": 1}).sort("_id", 1):
+        try:
+            if student.get("profile_face_id"):
+                faces = [decode_face(fs.get(student["profile_face_id"]).read())]
+            else:
+                image = cv2.imdecode(np.frombuffer(fs.get(student["profile_image_id"]).read(), np.uint8), cv2.IMREAD_COLOR)
+                faces = crop_faces(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+        except Exception as e:
+            print(f"Skipping photo of student {student['_id']}: {e}")
+            continue
+        if faces:
+            crops.append(faces[0])
+        if limit and len(crops) >= limit:
+            break
+    return crops
+
+
+def build_quantized(crops, path=QUANTIZED_PATH, batch_size=16):
+    import torch
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+    from face_recognition import face_tensor
+    engine = quantized_engine()
+    torch.backends.quantized.engine = engine
+    model = load_fp32()
+    example = face_tensor(crops[:1])
+    # prepare_fx fuses conv + batchnorm + relu and inserts observers; the calibration pass records
+    # activation ranges on real enrollment faces
+    prepared = prepare_fx(model, get_default_qconfig_mapping(engine), (example,))
+    with torch.no_grad():
+        for i in range(0, len(crops), batch_size):
+            prepared(face_tensor(crops[i:i + batch_size]))
+        quantized = convert_fx(prepared)
+        scripted = torch.jit.freeze(torch.jit.trace(quantized, example).eval())
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    torch.jit.save(scripted, path)
+    print(f"Saved INT8 embedder ({engine}, calibrated on {len(crops)} faces) to {path}")
+    return scripted
+
+
+def embed(model, crops, batch_size=32):
+    import torch
+    from face_recognition import face_tensor
+    with torch.no_grad():
+        return np.concatenate([model(face_tensor(crops[i:i + batch_size])).numpy()
+                               for i in range(0, len(crops), batch_size)])
+
+
+def verification(gallery, probes, threshold=MATCH_THRESHOLD):
+    # probe i is a second view of gallery face i: genuine pairs are (i, i), impostor pairs (i, j != i)
+    squared = (np.sum(probes ** 2, axis=1)[:, None] + np.sum(gallery ** 2, axis=1)[None, :]
+               - 2 * probes @ gallery.T)
+    distances = np.sqrt(np.maximum(squared, 0))
+    genuine = np.eye(len(gallery), dtype=bool)
+    accepted = distances < threshold
+    return {
+        "accuracy": float((accepted == genuine).mean()),
+        "true_accept_rate": float(accepted[genuine].mean()),
+        "false_accept_rate": float(accepted[~genuine].mean()) if len(gallery) > 1 else 0.0,
+        "rank1": float((distances.argmin(axis=1) == np.arange(len(gallery))).mean()),
+    }
+
+
+def throughput(model, crops, batch_size, repeats=10):
+    import torch
+    from face_recognition import face_tensor
+    batch = face_tensor([crops[i % len(crops)] for i in range(batch_size)])
+    with torch.no_grad():
+        model(batch)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            model(batch)
+    return batch_size * repeats / (time.perf_counter() - start)
+
+
+def split_crops(crops, calibration_faces):
+    # (calibration faces, held-out faces for the report); one face per student, so no student is in both
+    return crops[:calibration_faces], crops[calibration_faces:]
+
+
+def report(crops, quantized, batch_sizes=(1, 16), threshold=MATCH_THRESHOLD):
+    import torch
+    fp32 = load_fp32()
+    # Mirrored faces stand in for a second photo of each student
+    probes = [np.ascontiguousarray(crop[:, ::-1]) for crop in crops]
+    gallery32, probes32 = embed(fp32, crops), embed(fp32, probes)
+    gallery8, probes8 = embed(quantized, crops), embed(quantized, probes)
+    cosine = np.sum(gallery32 * gallery8, axis=1) / (
+        np.linalg.norm(gallery32, axis=1) * np.linalg.norm(gallery8, axis=1))
+    drift = 1 - cosine
+    speed = {}
+    for n in batch_sizes:
+        fp32_rate, int8_rate = throughput(fp32, crops, n), throughput(quantized, crops, n)
+        speed[n] = {"fp32_faces_per_s": fp32_rate, "int8_faces_per_s": int8_rate, "speedup": int8_rate / fp32_rate}
+    return {
+        "faces": len(crops),
+        "threshold": threshold,
+        "cosine_drift": {"mean": float(drift.mean()), "p99": float(np.percentile(drift, 99)), "max": float(drift.max())},
+        "verification": {"fp32": verification(gallery32, probes32, threshold),
+                         "int8": verification(gallery8, probes8, threshold)},
+        "throughput": speed,
+        "threads": torch.get_num_threads(),
+    }
+
+
+def print_report(result):
+    drift = result["cosine_drift"]
+    print(f"\nINT8 vs fp32 on {result['faces']} held-out enrollment faces "
+          f"({result['calibration_faces']} others used for calibration)")
+    print(f"Cosine drift: mean {drift['mean']:.5f}  p99 {drift['p99']:.5f}  max {drift['max']:.5f}")
+    for variant, stats in result["verification"].items():
+        print(f"{variant:<5} verification @ {result['threshold']}: accuracy {stats['accuracy']:.4f}  "
+              f"TAR {stats['true_accept_rate']:.4f}  FAR {stats['false_accept_rate']:.4f}  rank-1 {stats['rank1']:.4f}")
+    for n, stats in result["throughput"].items():
+        flag = '' if stats['speedup'] >= 2 else '  (below the 2x target)'
+        print(f"batch {n:>3}: fp32 {stats['fp32_faces_per_s']:7.1f}  int8 {stats['int8_faces_per_s']:7.1f} faces/s  "
+              f"x{stats['speedup']:.2f}{flag}")
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--build', action='store_true', help='calibrate and save the INT8 embedder')
+    parser.add_argument('--path', default=QUANTIZED_PATH)
+    parser.add_argument('--calibration-faces', type=int, default=200, help='enrollment photos used to calibrate')
+    parser.add_argument('--eval-faces', type=int, help='held-out enrollment photos used for the report (default: all the rest)')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 16])
+    parser.add_argument('--report', help='also save the report as JSON')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    opt = parse_opt()
+    from conn import get_db
+    crops = enrollment_crops(get_db(), opt.calibration_faces + opt.eval_faces if opt.eval_faces else None)
+    calibration, held_out = split_crops(crops, opt.calibration_faces)
+    if not calibration:
+        raise SystemExit("No enrollment photos with a detectable face")
+    if not held_out:
+        raise SystemExit(f"Only {len(crops)} enrollment faces, none left for the report after "
+                         f"{opt.calibration_faces} calibration faces (lower --calibration-faces)")
+    if opt.build:
+        quantized = build_quantized(calibration, opt.path)
+    else:
+        quantized = load_quantized(opt.path)
+    result = report(held_out, quantized, opt.batch_sizes)
+    result["calibration_faces"] = len(calibration)
+    print_report(result)
+    if opt.report:
+        with open(opt.report, 'w') as f:
+            json.dump(result, f, indent=2)
@@ -0,0 +1,367 @@
+import os
+import json
+import time
+import queue
+import socket
+import struct
+import argparse
+import tempfile
+import threading
+import socketserver
+import numpy as np
+from tracing import tracer
+from embedder import EMBEDDERS, select_embedder, model_version
+
+# Local face-embedding service. One long-lived process keeps MTCNN and InceptionResnetV1 loaded and
+# serves detection sessions and enrollment on the same machine over a UNIX socket. Requests that arrive
+# within a few milliseconds of each other are coalesced into one MTCNN / ResNet batch.
+#
+# The module-level detect_faces, detect_and_encode_batch and encode_faces are what clients call: they
+# use the service when it is running and fall back to the in-process models in face_recognition when
+# it is not (or when the platform has no UNIX sockets).
+#
+#   message := uint32 header length, uint64 payload length, JSON header, payload
+# Request payloads are the raw uint8 images listed in header["shapes"]; response payloads are the
+# float32 embeddings of every face, in order. Requests name the embedder and model version the client
+# expects; the service refuses requests for another model (the client then uses its in-process models)
+# and every response names the model that made it, so stored embeddings are tagged with that one.
+
+SOCKET_PATH = os.environ.get('FYP_EMBEDDING_SOCKET', os.path.join(tempfile.gettempdir(), 'fyp-embeddings.sock'))
+MESSAGE_HEADER = struct.Struct('<IQ')
+EMBEDDING_SIZE = 512
+OPS = ('detect', 'detect_and_encode', 'encode')
+
+
+def recv_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(min(size - len(data), 1 << 20))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data += chunk
+    return bytes(data)
+
+
+def send_message(sock, header, payload=b''):
+    header = json.dumps(header).encode()
+    sock.sendall(MESSAGE_HEADER.pack(len(header), len(payload)) + header)
+    if payload:
+        sock.sendall(payload)
+
+
+def recv_message(sock):
+    header_len, payload_len = MESSAGE_HEADER.unpack(recv_exact(sock, MESSAGE_HEADER.size))
+    header = json.loads(recv_exact(sock, header_len))
+    return header, recv_exact(sock, payload_len)
+
+
+def pack_images(images):
+    images = [np.ascontiguousarray(image, dtype=np.uint8) for image in images]
+    return [list(image.shape) for image in images], b''.join(image.tobytes() for image in images)
+
+
+def unpack_images(shapes, payload):
+    images, offset = [], 0
+    for shape in shapes:
+        size = int(np.prod(shape))
+        images.append(np.frombuffer(payload, np.uint8, size, offset).reshape(shape))
+        offset += size
+    return images
+
+
+def local_model():
+    # The embedder variant and version the in-process models of this process are loaded with
+    return {"embedder": os.environ.get('FYP_EMBEDDER', 'fp32'), "model_version": model_version()}
+
+
+def run_local(op, images, scale=1.0, bgr=False, min_face_size=None, quality=None, skipped=None):
+    # The in-process implementation, used by the server and by clients without a server
+    import face_recognition
+    if op == 'detect':
+        with face_recognition.mtcnn_min_face_size(min_face_size):
+            return face_recognition.detect_faces_batch(images)
+    if op == 'detect_and_encode':
+        return face_recognition.detect_and_encode_batch(images, scale, bgr, min_face_size, quality, skipped)
+    if op == 'encode':
+        return face_recognition.encode_faces(images)
+    raise ValueError(f"Unknown operation {op}")
+
+
+class Request:
+    __slots__ = ('op', 'images', 'key', 'result', 'skipped', 'error', 'done')
+
+    def __init__(self, op, images, key):
+        self.op = op
+        self.images = images
+        self.key = key
+        self.result = None
+        self.skipped = []
+        self.error = None
+        self.done = threading.Event()
+
+
+class Batcher:
+    # Collects requests for up to max_wait seconds (or max_batch images) and runs each group of
+    # compatible requests as one batch on a single model thread
+    def __init__(self, max_batch=32, max_wait=0.005):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.batches = 0
+        self.requests = 0
+        self.thread = threading.Thread(target=self._run, name='Batcher', daemon=True)
+        self.thread.start()
+
+    def submit(self, op, images, scale=1.0, bgr=False, min_face_size=None, quality=None):
+        # Returns (result, faces skipped by the quality gate per image)
+        request = Request(op, images, (op, scale, bgr, min_face_size, quality))
+        self.queue.put(request)
+        request.done.wait()
+        if request.error:
+            raise RuntimeError(request.error)
+        return request.result, request.skipped
+
+    def _gather(self):
+        pending = [self.queue.get()]
+        images = len(pending[0].images)
+        deadline = time.time() + self.max_wait
+        while images < self.max_batch:
+            try:
+                request = self.queue.get(timeout=max(0.0, deadline - time.time()))
+            except queue.Empty:
+                break
+            pending.append(request)
+            images += len(request.images)
+        return pending
+
+    def _run(self):
+        while True:
+            groups = {}
+            for request in self._gather():
+                groups.setdefault(request.key, []).append(request)
+            for (op, scale, bgr, min_face_size, quality), requests in groups.items():
+                images = [image for request in requests for image in request.images]
+                skipped = []
+                try:
+                    with tracer.span(f'batch_{op}', 'service', requests=len(requests), images=len(images)):
+                        results = run_local(op, images, scale, bgr, min_face_size, quality, skipped)
+                    offset = 0
+                    for request in requests:
+                        request.result = results[offset:offset + len(request.images)]
+                        request.skipped = skipped[offset:offset + len(request.images)]
+                        offset += len(request.images)
+                except Exception as e:
+                    for request in requests:
+                        request.error = f"{type(e).__name__}: {e}"
+                self.batches += 1
+                self.requests += len(requests)
+                for request in requests:
+                    request.done.set()
+
+
+def encode_response(op, result, skipped=()):
+    if op == 'encode':
+        embeddings = np.asarray(result, np.float32).reshape(-1, EMBEDDING_SIZE)
+        return {"count": len(embeddings)}, embeddings.tobytes()
+    if op == 'detect':
+        return {"boxes": [None if boxes is None else np.asarray(boxes).tolist() for boxes in result]}, b''
+    embeddings = [np.asarray(e, np.float32) for encodings, _ in result for e in encodings]
+    boxes = [[np.asarray(box).tolist() for box in image_boxes] for _, image_boxes in result]
+    return {"boxes": boxes, "skipped": list(skipped)}, b''.join(e.tobytes() for e in embeddings)
+
+
+def decode_response(op, header, payload):
+    embeddings = np.frombuffer(payload, np.float32).reshape(-1, EMBEDDING_SIZE)
+    if op == 'encode':
+        return embeddings
+    if op == 'detect':
+        return [None if boxes is None else np.asarray(boxes, np.float32) for boxes in header["boxes"]]
+    results, offset = [], 0
+    for image_boxes in header["boxes"]:
+        results.append((list(embeddings[offset:offset + len(image_boxes)]),
+                        [np.asarray(box, np.float32) for box in image_boxes]))
+        offset += len(image_boxes)
+    return results
+
+
+class EmbeddingHandler(socketserver.BaseRequestHandler):
+    # One connection per client, kept open for any number of requests
+    def handle(self):
+        while True:
+            try:
+                header, payload = recv_message(self.request)
+            except (ConnectionError, OSError):
+                return
+            op = header.get("op")
+            served = self.server.model
+            if (header.get("embedder"), header.get("model_version")) != (served["embedder"], served["model_version"]):
+                response = {"error": f"Serving {served['embedder']} {served['model_version']}, not "
+                                     f"{header.get('embedder')} {header.get('model_version')}", "model_mismatch": True, **served}
+                try:
+                    send_message(self.request, response)
+                except OSError:
+                    return
+                continue
+            try:
+                if op not in OPS:
+                    raise ValueError(f"Unknown operation {op}")
+                images = unpack_images(header["shapes"], payload)
+                result, skipped = self.server.batcher.submit(op, images, header.get("scale", 1.0), header.get("bgr", False),
+                                                             header.get("min_face_size"), header.get("quality"))
+                response, data = encode_response(op, result, skipped)
+                response.update(served)
+            except Exception as e:
+                response, data = {"error": f"{type(e).__name__}: {e}"}, b''
+            try:
+                send_message(self.request, response, data)
+            except OSError:
+                return
+
+
+class EmbeddingClient:
+    # Thread-safe client holding one connection. If the service is not reachable, calls return None
+    # and the next attempt to connect is only made after retry_after seconds.
+    def __init__(self, path=SOCKET_PATH, timeout=30, retry_after=10):
+        self.path = path
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.sock = None
+        self.next_attempt = 0
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        if self.sock is not None:
+            return True
+        if not hasattr(socket, 'AF_UNIX') or time.time() < self.next_attempt:
+            return False
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            self.next_attempt = time.time() + self.retry_after
+            return False
+        self.sock = sock
+        return True
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def call(self, op, images, scale=1.0, bgr=False, min_face_size=None, quality=None, skipped=None, model=None):
+        # If model is a dict it receives the embedder and model_version the service used
+        with self.lock:
+            if not self._connect():
+                return None
+            shapes, payload = pack_images(images)
+            try:
+                with tracer.span(f'rpc_{op}', 'ipc', images=len(images)):
+                    send_message(self.sock, {"op": op, "shapes": shapes, "scale": scale, "bgr": bgr,
+                                             "min_face_size": min_face_size, "quality": quality, **local_model()}, payload)
+                    header, data = recv_message(self.sock)
+            except (ConnectionError, OSError) as e:
+                print(f"Embedding service connection lost ({e}), using in-process models")
+                self.close()
+                self.next_attempt = time.time() + self.retry_after
+                return None
+            if header.get("model_mismatch"):
+                print(f"Embedding service: {header['error']}, using in-process models")
+                self.close()
+                self.next_attempt = time.time() + self.retry_after
+                return None
+        if header.get("error"):
+            raise RuntimeError(f"Embedding service error: {header['error']}")
+        if skipped is not None:
+            skipped.extend(header.get("skipped", []))
+        if model is not None:
+            model.update(embedder=header["embedder"], model_version=header["model_version"])
+        return decode_response(op, header, data)
+
+
+client = EmbeddingClient()
+
+
+def detect_faces(images, min_face_size=None):
+    # MTCNN boxes (or None) per image
+    result = client.call('detect', images, min_face_size=min_face_size) if images else []
+    return result if result is not None else run_local('detect', images, min_face_size=min_face_size)
+
+
+def detect_and_encode_batch(images, scale=1.0, bgr=False, min_face_size=None, quality=None, skipped=None, model=None):
+    # Same contract as face_recognition.detect_and_encode_batch; if model is a dict it receives the
+    # embedder and model_version that made the encodings
+    result = client.call('detect_and_encode', images, scale, bgr, min_face_size, quality, skipped, model) if images else []
+    if result is not None:
+        return result
+    if model is not None:
+        model.update(local_model())
+    return run_local('detect_and_encode', images, scale, bgr, min_face_size, quality, skipped)
+
+
+def encode_faces(crops, model=None):
+    if not crops:
+        return np.empty((0, EMBEDDING_SIZE), np.float32)
+    result = client.call('encode', crops, model=model)
+    if result is not None:
+        return result
+    if model is not None:
+        model.update(local_model())
+    return run_local('encode', crops)
+
+
+class EmbeddingServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(path=SOCKET_PATH, max_batch=32, max_wait=0.005):
+    if not hasattr(socket, 'AF_UNIX'):
+        print("UNIX sockets are not available on this platform; clients will use in-process models")
+        return
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            print(f"An embedding service is already listening on {path}")
+            return
+        except OSError:
+            os.unlink(path)  # stale socket left by a crashed service
+        finally:
+            probe.close()
+    print("Loading face models...")
+    run_local('detect_and_encode', [np.zeros((160, 160, 3), np.uint8)])
+    run_local('encode', [np.zeros((160, 160, 3), np.uint8)])
+    server = EmbeddingServer(path, EmbeddingHandler)
+    os.chmod(path, 0o600)  # only the current user may connect
+    server.model = local_model()
+    server.batcher = Batcher(max_batch, max_wait)
+    print(f"Embedding service listening on {path} ({server.model['embedder']} {server.model['model_version']})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+        if server.batcher.batches:
+            print(f"Served {server.batcher.requests} requests in {server.batcher.batches} batches")
+        tracer.save()
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", default=SOCKET_PATH, help="UNIX socket path (or set FYP_EMBEDDING_SOCKET)")
+    parser.add_argument("--max-batch", type=int, default=32, help="most images run as one batch")
+    parser.add_argument("--max-wait-ms", type=float, default=5, help="how long to wait for more requests to batch")
+    parser.add_argument("--embedder", choices=list(EMBEDDERS), default="fp32", help="face embedder variant to serve")
+    parser.add_argument("--trace", help="write a Chrome trace of the batches to this JSON file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    opt = parse_opt()
+    if opt.trace:
+        tracer.start(opt.trace)
+    select_embedder(opt.embedder)
+    serve(opt.socket, opt.max_batch, opt.max_wait_ms / 1000)
@@ -0,0 +1,98 @@
+from datetime import datetime
+import numpy as np
+from bson import Binary
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from embedder import model_version
+
+# Face embeddings kept in MongoDB next to the students they belong to. An enrollment (student, photo,
+# embedder variant) has one document per sample embedding (sample 0, 1, ...) and one for the aggregated
+# template (sample TEMPLATE), each with the float32 vector stored as raw bytes and the version of the model
+# that made it (embedder.model_version). Galleries are built from these documents, so a photo is only
+# encoded once per model; embeddings of another model version are ignored and re-encoded. Enrollment
+# writes the template last, and running sessions pick up templates newer than their last check.
+
+COLLECTION = 'face_embeddings'
+TEMPLATE = -1
+
+
+def to_binary(vector):
+    return Binary(np.asarray(vector, np.float32).tobytes())
+
+
+def from_binary(data):
+    return np.frombuffer(data, np.float32)
+
+
+def ensure_indexes(db):
+    collection = db[COLLECTION]
+    if 'student_id_1_image_id_1_embedder_1' in collection.index_information():
+        collection.drop_index('student_id_1_image_id_1_embedder_1')  # single-sample layout
+    collection.create_index([("student_id", ASCENDING), ("image_id", ASCENDING), ("embedder", ASCENDING),
+                             ("sample", ASCENDING)], unique=True)
+    collection.create_index([("embedder", ASCENDING), ("sample", ASCENDING), ("created_at", DESCENDING)])
+
+
+def embedding_update(student_id, image_id, embedder, sample, vector, version=None):
+    return UpdateOne(
+        {"student_id": student_id, "image_id": image_id, "embedder": embedder, "sample": sample},
+        {"$set": {"embedding": to_binary(vector), "model_version": version or model_version(embedder),
+                  "created_at": datetime.now()}},
+        upsert=True,
+    )
+
+
+def store_enrollments(db, enrollments, embedder, version=None):
+    # enrollments: list of (student_id, image_id, samples, template); all samples and templates are
+    # written with one unordered bulk write, and samples left over from a larger earlier set are removed.
+    # version is the model_version the vectors were made with (by default this process's model)
+    from face_index import make_template
+    if not enrollments:
+        return
+    ensure_indexes(db)
+    version = version or model_version(embedder)
+    samples_written, templates = [], []
+    for student_id, image_id, samples, template in enrollments:
+        samples = np.asarray(samples, np.float32).reshape(len(samples), -1)
+        template = make_template(samples) if template is None else template
+        samples_written += [embedding_update(student_id, image_id, embedder, i, vector, version) for i, vector in enumerate(samples)]
+        templates.append(embedding_update(student_id, image_id, embedder, TEMPLATE, template, version))
+    db[COLLECTION].bulk_write(samples_written, ordered=False)
+    db[COLLECTION].delete_many({"$or": [
+        {"student_id": student_id, "image_id": image_id, "embedder": embedder, "sample": {"$gte": len(samples)}}
+        for student_id, image_id, samples, _ in enrollments]})
+    # Templates go last: a session that sees a new template finds all of its samples
+    db[COLLECTION].bulk_write(templates, ordered=False)
+
+
+def load_enrollments(db, embedder, image_ids=None):
+    # Returns {(student_id, image_id): (samples, template)} for the given embedder, optionally limited
+    # to some photos
+    query = {"embedder": embedder, "model_version": model_version(embedder)}
+    if image_ids is not None:
+        query["image_id"] = {"$in": list(image_ids)}
+    grouped = {}
+    for doc in db[COLLECTION].find(query, {"student_id": 1, "image_id": 1, "sample": 1, "embedding": 1}):
+        grouped.setdefault((doc["student_id"], doc["image_id"]), {})[doc.get("sample", 0)] = from_binary(doc["embedding"])
+    enrollments = {}
+    for key, vectors in grouped.items():
+        samples = [vectors[i] for i in sorted(vectors) if i != TEMPLATE]
+        if samples:
+            enrollments[key] = (np.stack(samples), vectors.get(TEMPLATE))
+    return enrollments
+
+
+def enrollments_since(db, embedder, since):
+    # Enrollments whose template was written after since, as (load_enrollments result, newest write time)
+    templates = list(db[COLLECTION].find(
+        {"embedder": embedder, "sample": TEMPLATE, "created_at": {"$gt": since}, "model_version": model_version(embedder)},
+        {"image_id": 1, "created_at": 1}))
+    if not templates:
+        return {}, since
+    return load_enrollments(db, embedder, [doc["image_id"] for doc in templates]), max(doc["created_at"] for doc in templates)
+
+
+def delete_embeddings(db, student_id, keep_image_ids=()):
+    query = {"student_id": student_id}
+    if keep_image_ids:
+        query["image_id"] = {"$nin": list(keep_image_ids)}
+    return db[COLLECTION].delete_many(query).deleted_count
@@ -4,6 +4,8 @@ import numpy as np
 import mediapipe as mp
 import tensorflow as tf
 from tensorflow.keras.models import load_model
+from scaling import resize
+from face_quality import mesh_quality
 import torch
 
 # Check PyTorch version and CUDA availability
@@ -41,42 +43,65 @@ emotion_model = load_model(emotion_model_path)
 # Emotion labels
 emotion_labels = ['Angry', 'Disgust', 'Fear', 'Happy', 'Sad', 'Surprise', 'Neutral']
 
-def detect_emotion(image):
-    if face_mesh is None or emotion_model is None:
-        return []
+# FaceMesh tracks faces between frames, so each camera stream gets its own instance
+face_meshes = {0: face_mesh}
 
-    rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    result = face_mesh.process(rgb_image)
+def get_face_mesh(stream):
+    if stream not in face_meshes:
+        face_meshes[stream] = mp_face_mesh.FaceMesh(static_image_mode=False, max_num_faces=10, min_detection_confidence=0.2)
+    return face_meshes[stream]
+
+# FaceMesh runs on a copy resized by scale. Its landmarks are normalized, so scaling them by the
+# full-resolution size maps them straight back, and faces are cropped from the full-resolution image.
+# With a quality threshold, faces scoring below it (see face_quality.py) are not classified; if skipped
+# is a list it receives the number of such faces per image. Each image gets a list of
+# (emotion, landmarks, confidence).
+def detect_emotion_batch(images, scale=1.0, quality=None, skipped=None):
+    if face_mesh is None or emotion_model is None:
+        return [[] for _ in images]
+    skipped_faces = [0] * len(images)
 
-    if not result.multi_face_landmarks:
-        return []
+    faces = []  # (image index, landmarks, preprocessed face) across all images
+    for i, image in enumerate(images):
+        rgb_image = cv2.cvtColor(resize(image, scale), cv2.COLOR_BGR2RGB)
+        result = get_face_mesh(i).process(rgb_image)
+        if not result.multi_face_landmarks:
+            continue
 
-    emotions = []
-    for face_landmarks in result.multi_face_landmarks:
-        landmarks = np.array([(lm.x, lm.y, lm.z) for lm in face_landmarks.landmark])
         h, w, _ = image.shape
-        landmarks[:, 0] *= w
-        landmarks[:, 1] *= h
+        for face_landmarks in result.multi_face_landmarks:
+            landmarks = np.array([(lm.x, lm.y, lm.z) for lm in face_landmarks.landmark])
+            landmarks[:, 0] *= w
+            landmarks[:, 1] *= h
+            if quality:
+                x1, y1 = max(0, int(landmarks[:, 0].min())), max(0, int(landmarks[:, 1].min()))
+                if mesh_quality(image[y1:int(landmarks[:, 1].max()), x1:int(landmarks[:, 0].max())], landmarks) < quality:
+                    skipped_faces[i] += 1
+                    continue
+            preprocessed_image = preprocess_face_image(image, landmarks)
+            if preprocessed_image is not None:
+                faces.append((i, landmarks, preprocessed_image))
+            else:
+                print("Preprocessed image is None")
 
-        # Debug statements to print shapes
-        print(f"Landmarks shape: {landmarks.shape}")
-        preprocessed_image = preprocess_face_image(image, landmarks)
-        
-        if preprocessed_image is not None:
-            # Check the shape of preprocessed image
-            print(f"Preprocessed image shape: {preprocessed_image.shape}")
-            # Ensure the prediction runs on GPU
-            with tf.device('/GPU:0'):
-                emotion_prediction = emotion_model.predict(np.expand_dims(preprocessed_image, axis=0))
-            print(f"Emotion prediction shape: {emotion_prediction.shape}")
-            emotion_index = np.argmax(emotion_prediction)
-            emotion = emotion_labels[emotion_index]
-            emotions.append((emotion, landmarks))
-        else:
-            print("Preprocessed image is None")
+    if skipped is not None:
+        skipped.extend(skipped_faces)
+    emotions = [[] for _ in images]
+    if not faces:
+        return emotions
 
+    # Classify every face from every image in one batch
+    with tf.device('/GPU:0'):
+        emotion_predictions = emotion_model.predict(np.stack([face for _, _, face in faces]), verbose=0)
+    print(f"Emotion prediction shape: {emotion_predictions.shape}")
+    for (i, landmarks, _), emotion_prediction in zip(faces, emotion_predictions):
+        best = int(np.argmax(emotion_prediction))
+        emotions[i].append((emotion_labels[best], landmarks, float(emotion_prediction[best])))
     return emotions
 
+def detect_emotion(image):
+    return detect_emotion_batch([image])[0]
+
 def preprocess_face_image(image, landmarks):
     try:
         x_min = int(min(landmarks[:, 0]))
@@ -0,0 +1,288 @@
+import os
+import json
+import time
+import sqlite3
+import argparse
+import threading
+from datetime import datetime
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import ConnectionFailure, AutoReconnect, ServerSelectionTimeoutError, NetworkTimeout
+from tracing import tracer
+
+# Local, append-only journal of session events, shipped to MongoDB by a background sync worker. The
+# frame loop only ever writes to a SQLite file in WAL mode, so a slow or dropped campus network never
+# stalls it and nothing is lost when Atlas is unreachable: events stay in the journal until shipped.
+#   events(seq, kind, record_id, student_id, label, value, t)
+#     kind 'record'       a session record was created (value: JSON of classID and created_by)
+#     kind 'emotion'      student showed an emotion label in the record (value: optional JSON of its
+#                         seconds and episodes, see label_durations.py)
+#     kind 'behavior'     student showed a behavior label in the record (value: as for emotion)
+#     kind 'performance'  the record's overall performance (value)
+#     kind 'session_events'  the record's time-stamped detections were saved (value: JSON of the local
+#                         NPZ path and classID), uploaded to GridFS by session_events.upload
+#   sync(last_seq)        the last event shipped, so syncing resumes where it stopped after a restart
+#   failed(seq, error)    events that could not be shipped for a reason other than the database being
+#                         unreachable (e.g. a corrupt value or a rejected write); they are set aside so
+#                         the rest keeps syncing
+# Shipping is idempotent (records are upserted with $setOnInsert, labels added with $addToSet, the
+# performance $set, session events uploaded once per record), so a batch that is shipped again after a
+# crash changes nothing.
+#   python event_journal.py                  ship whatever is pending and report the sync lag
+#   python event_journal.py --retry-failed   also try the set-aside events again
+
+JOURNAL_PATH = 'journal/events.sqlite3'
+# Shipped events older than this are removed when the journal is opened
+RETENTION_DAYS = 30
+
+EVENT_COLUMNS = 'seq, kind, record_id, student_id, label, value, t'
+# Errors that mean the database cannot be reached right now; the batch is retried later. Any other error,
+# write errors and oversized documents included, is a problem with the events themselves.
+TRANSIENT_ERRORS = (ConnectionFailure, AutoReconnect, ServerSelectionTimeoutError, NetworkTimeout)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    record_id TEXT NOT NULL,
+    student_id TEXT,
+    label TEXT,
+    value TEXT,
+    t REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sync (id INTEGER PRIMARY KEY CHECK (id = 0), last_seq INTEGER NOT NULL, synced_at REAL);
+INSERT OR IGNORE INTO sync (id, last_seq, synced_at) VALUES (0, 0, NULL);
+CREATE TABLE IF NOT EXISTS failed (seq INTEGER PRIMARY KEY, error TEXT NOT NULL, t REAL NOT NULL);
+"""
+
+
+def connect(path):
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')  # durable across application crashes, fsync only at checkpoints
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def to_id(value):
+    return str(value) if value is not None else None
+
+
+def from_id(value):
+    return ObjectId(value) if value and ObjectId.is_valid(value) else value
+
+
+class EventJournal:
+    def __init__(self, db, path=JOURNAL_PATH, batch_size=1000, interval=2.0, sync=True):
+        # sync=False leaves shipping to the caller (ship_pending), e.g. to time it
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.db = db
+        self.path = path
+        self.batch_size = batch_size
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.conn = connect(path)
+        with self.conn:
+            self.conn.execute("DELETE FROM events WHERE seq <= (SELECT last_seq FROM sync) AND t < ? "
+                              "AND seq NOT IN (SELECT seq FROM failed)", (time.time() - RETENTION_DAYS * 86400,))
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='JournalSync', daemon=True)
+        if sync:
+            self.thread.start()
+
+    def append_many(self, events):
+        # events: (kind, record_id, student_id, label, value); one transaction for all of them
+        now = time.time()
+        with tracer.span('journal_append', 'journal', events=len(events)), self.lock, self.conn:
+            self.conn.executemany("INSERT INTO events (kind, record_id, student_id, label, value, t) VALUES (?, ?, ?, ?, ?, ?)",
+                                  [(kind, to_id(record_id), to_id(student_id), label, value, now)
+                                   for kind, record_id, student_id, label, value in events])
+
+    def append(self, kind, record_id, student_id=None, label=None, value=None):
+        self.append_many([(kind, record_id, student_id, label, value)])
+
+    def create_record(self, class_id, created_by):
+        # The record's _id is made here, so events can refer to it before it reaches MongoDB
+        record_id = ObjectId()
+        self.append('record', record_id, value=json.dumps({"classID": class_id, "created_by": created_by}))
+        return record_id
+
+    def lag(self):
+        # (events not yet shipped, age in seconds of the oldest of them, seconds since the last successful sync)
+        with self.lock:
+            pending, oldest = self.conn.execute(
+                "SELECT COUNT(*), MIN(t) FROM events WHERE seq > (SELECT last_seq FROM sync)").fetchone()
+            synced_at = self.conn.execute("SELECT synced_at FROM sync").fetchone()[0]
+        now = time.time()
+        return pending, now - oldest if oldest else 0.0, now - synced_at if synced_at else None
+
+    def failed(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM failed").fetchone()[0]
+
+    def lag_summary(self):
+        pending, oldest, since_sync = self.lag()
+        last = f"last sync {since_sync:.0f}s ago" if since_sync is not None else "never synced"
+        failed = self.failed()
+        set_aside = f", {failed} set aside as failed (event_journal.py --retry-failed)" if failed else ""
+        return f"Journal: {pending} events pending sync, oldest {oldest:.0f}s ({last}){set_aside}"
+
+    def close(self, timeout=10.0):
+        # Gives the sync worker up to timeout seconds to ship what is left; anything still pending is
+        # shipped by the next session (or by running this module)
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join(timeout)
+        print(self.lag_summary())
+        self.conn.close()
+
+    def _run(self):
+        conn = connect(self.path)
+        backoff = self.interval
+        while True:
+            try:
+                shipped = ship_or_set_aside(self.db, conn, self.batch_size)
+                backoff = self.interval
+            except Exception as e:
+                # Database unreachable, or anything unexpected: the thread keeps running and tries again
+                print(f"Journal sync failed ({type(e).__name__}: {e}), retrying in {backoff:.0f}s")
+                if self.stop_event.wait(backoff):
+                    break
+                backoff = min(backoff * 2, 60)
+                continue
+            if shipped == self.batch_size:
+                continue  # more waiting
+            if self.stop_event.is_set():
+                break
+            self.stop_event.wait(self.interval)
+        conn.close()
+
+
+def label_update(field, values):
+    # values: {label: durations or None}; durations go to durations.<label>
+    update = {"$addToSet": {field: {"$each": sorted(values)}}}
+    durations = {f"durations.{label}": value for label, value in values.items() if value}
+    if durations:
+        update["$set"] = durations
+    return update
+
+
+def ship_batch(db, conn, batch_size):
+    # Ships the next batch of events after sync.last_seq; returns how many were shipped
+    last_seq = conn.execute("SELECT last_seq FROM sync").fetchone()[0]
+    rows = conn.execute(f"SELECT {EVENT_COLUMNS} FROM events WHERE seq > ? ORDER BY seq LIMIT ?",
+                        (last_seq, batch_size)).fetchall()
+    if not rows:
+        return 0
+    ship_rows(db, rows)
+    with conn:
+        conn.execute("UPDATE sync SET last_seq = ?, synced_at = ?", (rows[-1][0], time.time()))
+    return len(rows)
+
+
+def ship_or_set_aside(db, conn, batch_size):
+    # ship_batch, except that an event failing for a reason other than the database being unreachable is
+    # found by shipping one event at a time and set aside in the failed table, so it does not block every
+    # later event
+    try:
+        return ship_batch(db, conn, batch_size)
+    except TRANSIENT_ERRORS:
+        raise
+    except Exception as e:
+        if batch_size > 1:
+            shipped = 0
+            while shipped < batch_size:
+                n = ship_or_set_aside(db, conn, 1)
+                if not n:
+                    break
+                shipped += n
+            return shipped
+        seq = conn.execute("SELECT seq FROM events WHERE seq > (SELECT last_seq FROM sync) ORDER BY seq LIMIT 1").fetchone()[0]
+        print(f"Journal event {seq} cannot be shipped ({type(e).__name__}: {e}), setting it aside")
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO failed (seq, error, t) VALUES (?, ?, ?)", (seq, f"{type(e).__name__}: {e}", time.time()))
+            conn.execute("UPDATE sync SET last_seq = ?", (seq,))
+        return 1
+
+
+def retry_failed(db, conn):
+    # Ships the set-aside events again one by one; returns how many succeeded
+    shipped = 0
+    for row in conn.execute(f"SELECT {EVENT_COLUMNS} FROM events WHERE seq IN (SELECT seq FROM failed) ORDER BY seq").fetchall():
+        try:
+            ship_rows(db, [row])
+        except TRANSIENT_ERRORS:
+            raise
+        except Exception as e:
+            print(f"Journal event {row[0]} still cannot be shipped ({type(e).__name__}: {e})")
+            continue
+        with conn:
+            conn.execute("DELETE FROM failed WHERE seq = ?", (row[0],))
+        shipped += 1
+    return shipped
+
+
+def ship_rows(db, rows):
+    # Writes journal rows to MongoDB, one bulk write per collection
+    records, labels, uploads = [], {'emotion': {}, 'behavior': {}}, []
+    for seq, kind, record_id, student_id, label, value, t in rows:
+        if kind == 'record':
+            fields = json.loads(value)
+            records.append(UpdateOne({"_id": from_id(record_id)}, {"$setOnInsert": {
+                "classID": fields["classID"], "date": datetime.fromtimestamp(t), "created_by": fields["created_by"],
+                "overall_performance": 0}}, upsert=True))
+        elif kind == 'performance':
+            records.append(UpdateOne({"_id": from_id(record_id)}, {"$set": {"overall_performance": float(value)}}))
+        elif kind in labels:
+            labels[kind].setdefault((student_id, record_id), {})[label] = json.loads(value) if value else None
+        elif kind == 'session_events':
+            uploads.append((from_id(record_id), json.loads(value)))
+    with tracer.span('journal_ship', 'db', events=len(rows)):
+        if records:
+            db['records'].bulk_write(records, ordered=True)  # a record is created before its performance is set
+        for kind, field in (('emotion', 'emotions'), ('behavior', 'behaviors')):
+            if labels[kind]:
+                db[f'{kind}_history'].bulk_write([
+                    UpdateOne({"studentID": from_id(student_id), "recordID": from_id(record_id)},
+                              label_update(field, values), upsert=True)
+                    for (student_id, record_id), values in labels[kind].items()], ordered=False)
+        if uploads:
+            import gridfs
+            import session_events
+            fs = gridfs.GridFS(db)
+            for record_id, fields in uploads:
+                if os.path.exists(fields["path"]):
+                    session_events.upload(db, fs, record_id, fields["classID"], fields["path"])
+                else:
+                    print(f"Session events {fields['path']} missing, not uploaded")
+
+
+def ship_pending(db, conn, batch_size=1000):
+    # Ships batches until nothing is pending; returns how many events were shipped
+    total = 0
+    while True:
+        shipped = ship_or_set_aside(db, conn, batch_size)
+        total += shipped
+        if shipped < batch_size:
+            return total
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', default=JOURNAL_PATH)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--retry-failed', action='store_true', help='ship the events set aside as failed again')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    opt = parse_opt()
+    from conn import get_db
+    db, conn = get_db(), connect(opt.path)
+    start = time.time()
+    total = ship_pending(db, conn, opt.batch_size)
+    if opt.retry_failed:
+        total += retry_failed(db, conn)
+    pending = conn.execute("SELECT COUNT(*) FROM events WHERE seq > (SELECT last_seq FROM sync)").fetchone()[0]
+    failed = conn.execute("SELECT COUNT(*) FROM failed").fetchone()[0]
+    print(f"Shipped {total} events in {time.time() - start:.1f}s, {pending} pending, {failed} set aside as failed")
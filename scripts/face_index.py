@@ -0,0 +1,407 @@
+import os
+import time
+import argparse
+import numpy as np
+
+# Nearest-neighbour indexes over face embeddings. Every index holds (label, vector) pairs, supports
+# incremental add() / remove(), answers search() with Euclidean distances like the original linear
+# matching, and is saved as an .npz file. BruteForceIndex is exact and used for small galleries;
+# IVFIndex clusters the gallery with k-means and only scans the lists nearest to each query, which
+# keeps a campus-wide gallery of ~50k students fast. make_index() picks one by gallery size.
+#   python face_index.py --synthetic 50000    (recall@1 and latency of IVF vs exact search)
+
+GALLERY_INDEX_PATH = 'models/gallery_index.npz'
+# Galleries at least this large get an IVF index
+IVF_MIN_SIZE = 5000
+
+
+def squared_distances(queries, vectors, vector_norms=None):
+    if vector_norms is None:
+        vector_norms = np.sum(vectors ** 2, axis=1)
+    squared = np.sum(queries ** 2, axis=1)[:, None] + vector_norms[None, :] - 2 * queries @ vectors.T
+    return np.maximum(squared, 0)
+
+
+class BruteForceIndex:
+    kind = 'brute'
+
+    def __init__(self, dim=512):
+        self.dim = dim
+        self.labels = []
+        self.positions = {}
+        self.vectors = np.empty((0, dim), np.float32)
+        self.norms = np.empty(0, np.float32)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __contains__(self, label):
+        return label in self.positions
+
+    def items(self):
+        return list(self.labels), self.vectors.copy()
+
+    def add(self, labels, vectors):
+        vectors = np.asarray(vectors, np.float32).reshape(-1, self.dim)
+        for label in labels:
+            if label in self.positions:
+                raise ValueError(f"Label {label} is already in the index")
+        for label in labels:
+            self.positions[label] = len(self.labels)
+            self.labels.append(label)
+        self.vectors = np.concatenate([self.vectors, vectors])
+        self.norms = np.concatenate([self.norms, np.sum(vectors ** 2, axis=1)])
+
+    def remove(self, labels):
+        drop = {self.positions[label] for label in labels if label in self.positions}
+        if not drop:
+            return
+        keep = np.array([i not in drop for i in range(len(self.labels))], dtype=bool)
+        self.labels = [label for i, label in enumerate(self.labels) if keep[i]]
+        self.positions = {label: i for i, label in enumerate(self.labels)}
+        self.vectors, self.norms = self.vectors[keep], self.norms[keep]
+
+    def search(self, queries, k=1):
+        # Returns (distances, labels), both shaped (len(queries), k); missing neighbours are (inf, None)
+        queries = np.asarray(queries, np.float32).reshape(-1, self.dim)
+        distances = np.full((len(queries), k), np.inf, np.float32)
+        labels = np.full((len(queries), k), None, dtype=object)
+        if not self.labels:
+            return distances, labels
+        squared = squared_distances(queries, self.vectors, self.norms)
+        n = min(k, len(self.labels))
+        nearest = np.argpartition(squared, n - 1, axis=1)[:, :n]
+        order = np.take_along_axis(squared, nearest, axis=1).argsort(axis=1)
+        nearest = np.take_along_axis(nearest, order, axis=1)
+        distances[:, :n] = np.sqrt(np.take_along_axis(squared, nearest, axis=1))
+        labels[:, :n] = np.asarray(self.labels, dtype=object)[nearest]
+        return distances, labels
+
+    def state(self):
+        return {}
+
+
+class IVFIndex:
+    # Inverted-file index: vectors are bucketed by their nearest k-means centroid and a query scans the
+    # nprobe nearest buckets exactly. Adds go to the nearest bucket, removes drop the row from its bucket.
+    kind = 'ivf'
+
+    def __init__(self, dim=512, nlist=None, nprobe=8):
+        self.dim = dim
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.centroids = None
+        self.lists = []
+        self.where = {}
+
+    def __len__(self):
+        return len(self.where)
+
+    def __contains__(self, label):
+        return label in self.where
+
+    def items(self):
+        labels = [label for bucket in self.lists for label in bucket.labels]
+        vectors = np.concatenate([bucket.vectors for bucket in self.lists]) if self.lists else np.empty((0, self.dim), np.float32)
+        return labels, vectors
+
+    def train(self, vectors, iterations=10, sample=20000, seed=0):
+        vectors = np.asarray(vectors, np.float32).reshape(-1, self.dim)
+        rng = np.random.default_rng(seed)
+        nlist = self.nlist or max(1, int(4 * np.sqrt(len(vectors))))
+        nlist = min(nlist, len(vectors))
+        if len(vectors) > sample:
+            vectors = vectors[rng.choice(len(vectors), sample, replace=False)]
+        centroids = vectors[rng.choice(len(vectors), nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assignment = squared_distances(vectors, centroids).argmin(axis=1)
+            for c in range(nlist):
+                members = vectors[assignment == c]
+                if len(members):
+                    centroids[c] = members.mean(axis=0)
+        self.centroids = centroids
+        self.nlist = nlist
+        self.lists = [BruteForceIndex(self.dim) for _ in range(nlist)]
+        self.where = {}
+
+    def add(self, labels, vectors):
+        vectors = np.asarray(vectors, np.float32).reshape(-1, self.dim)
+        if self.centroids is None:
+            self.train(vectors)
+        for label in labels:
+            if label in self.where:
+                raise ValueError(f"Label {label} is already in the index")
+        assignment = squared_distances(vectors, self.centroids).argmin(axis=1)
+        for c in np.unique(assignment):
+            rows = np.flatnonzero(assignment == c)
+            self.lists[c].add([labels[i] for i in rows], vectors[rows])
+            for i in rows:
+                self.where[labels[i]] = c
+
+    def remove(self, labels):
+        by_list = {}
+        for label in labels:
+            if label in self.where:
+                by_list.setdefault(self.where.pop(label), []).append(label)
+        for c, bucket_labels in by_list.items():
+            self.lists[c].remove(bucket_labels)
+
+    def search(self, queries, k=1):
+        queries = np.asarray(queries, np.float32).reshape(-1, self.dim)
+        distances = np.full((len(queries), k), np.inf, np.float32)
+        labels = np.full((len(queries), k), None, dtype=object)
+        if not self.where:
+            return distances, labels
+        nprobe = min(self.nprobe, self.nlist)
+        probes = np.argpartition(squared_distances(queries, self.centroids), nprobe - 1, axis=1)[:, :nprobe]
+        for q, query in enumerate(queries):
+            buckets = [self.lists[c] for c in probes[q] if len(self.lists[c])]
+            if not buckets:
+                continue
+            candidates = np.concatenate([bucket.vectors for bucket in buckets])
+            candidate_labels = [label for bucket in buckets for label in bucket.labels]
+            squared = squared_distances(query[None], candidates)[0]
+            n = min(k, len(candidate_labels))
+            nearest = np.argsort(squared)[:n]
+            distances[q, :n] = np.sqrt(squared[nearest])
+            labels[q, :n] = [candidate_labels[i] for i in nearest]
+        return distances, labels
+
+    def state(self):
+        return {"centroids": self.centroids, "nprobe": self.nprobe}
+
+
+def make_index(size, dim=512, kind='auto', nprobe=8):
+    if kind == 'auto':
+        kind = 'ivf' if size >= IVF_MIN_SIZE else 'brute'
+    if kind == 'ivf':
+        return IVFIndex(dim, nprobe=nprobe)
+    if kind == 'brute':
+        return BruteForceIndex(dim)
+    raise ValueError(f"Unknown index kind {kind}")
+
+
+def build_index(labels, vectors, kind='auto', nprobe=8):
+    vectors = np.asarray(vectors, np.float32)
+    index = make_index(len(labels), vectors.shape[1] if vectors.ndim == 2 else 512, kind, nprobe)
+    if len(labels):
+        index.add(list(labels), vectors)
+    return index
+
+
+def save_index(index, path, arrays=None, **meta):
+    # arrays: extra named arrays stored in the same file (a TemplateGallery's samples)
+    labels, vectors = index.items()
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    state = {key: value for key, value in index.state().items() if value is not None}
+    # Written to a temporary file first so a running session never loads a half-written index
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'wb') as f:  # an open file keeps np.savez from appending .npz to the name
+        np.savez(f, kind=index.kind, labels=np.array(labels, dtype=str), vectors=vectors,
+                 meta=np.array([f"{key}={value}" for key, value in meta.items()], dtype=str), **state, **(arrays or {}))
+    os.replace(temp_path, path)
+
+
+def load_index(path):
+    # Returns (index, meta)
+    with np.load(path, allow_pickle=False) as data:
+        kind = str(data['kind'])
+        labels, vectors = [str(label) for label in data['labels']], data['vectors']
+        meta = dict(item.split('=', 1) for item in data['meta'])
+        if kind == 'ivf':
+            index = IVFIndex(vectors.shape[1], nprobe=int(data['nprobe']))
+            index.centroids = data['centroids']
+            index.nlist = len(index.centroids)
+            index.lists = [BruteForceIndex(vectors.shape[1]) for _ in range(index.nlist)]
+        else:
+            index = BruteForceIndex(vectors.shape[1])
+    if labels:
+        index.add(labels, vectors)
+    return index, meta
+
+
+def make_template(samples):
+    # The aggregated template of a student: mean of the unit-length samples, back on the unit sphere
+    samples = np.asarray(samples, np.float32)
+    unit = samples / np.maximum(np.linalg.norm(samples, axis=1, keepdims=True), 1e-12)
+    template = unit.mean(axis=0)
+    return template / max(float(np.linalg.norm(template)), 1e-12)
+
+
+class TemplateGallery:
+    # Multi-sample gallery. Each student label has an aggregated template, searched through a
+    # nearest-neighbour index, and up to MAX_SAMPLES individual samples packed into one matrix
+    # (rows sample_rows[label] = (start, count)). A query is answered from the templates; only when
+    # that is ambiguous are the samples of the few nearest candidates compared, so a lookup never
+    # touches more than candidates * MAX_SAMPLES sample rows.
+    MAX_SAMPLES = 5
+
+    def __init__(self, index, candidates=5, margin=0.1):
+        self.index = index
+        self.dim = index.dim
+        self.candidates = candidates
+        self.margin = margin
+        self.sample_matrix = np.empty((0, self.dim), np.float32)
+        self.sample_rows = {}
+        self.dead_rows = 0
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, label):
+        return label in self.index
+
+    @property
+    def kind(self):
+        return self.index.kind
+
+    def samples(self, label):
+        start, count = self.sample_rows[label]
+        return self.sample_matrix[start:start + count]
+
+    def add(self, labels, sample_sets, templates=None):
+        sample_sets = [np.asarray(samples, np.float32).reshape(-1, self.dim)[:self.MAX_SAMPLES] for samples in sample_sets]
+        if templates is None:
+            templates = [make_template(samples) for samples in sample_sets]
+        self.index.add(list(labels), np.asarray(templates, np.float32).reshape(-1, self.dim))
+        start = len(self.sample_matrix)
+        for label, samples in zip(labels, sample_sets):
+            self.sample_rows[label] = (start, len(samples))
+            start += len(samples)
+        if sample_sets:
+            self.sample_matrix = np.concatenate([self.sample_matrix, *sample_sets])
+
+    def remove(self, labels):
+        labels = [label for label in labels if label in self.sample_rows]
+        self.index.remove(labels)
+        for label in labels:
+            self.dead_rows += self.sample_rows.pop(label)[1]
+        if self.dead_rows > len(self.sample_matrix) // 2:
+            self.compact()
+
+    def compact(self):
+        labels = list(self.sample_rows)
+        sample_sets = [self.samples(label) for label in labels]
+        start = 0
+        for label, samples in zip(labels, sample_sets):
+            self.sample_rows[label] = (start, len(samples))
+            start += len(samples)
+        self.sample_matrix = np.concatenate(sample_sets) if sample_sets else np.empty((0, self.dim), np.float32)
+        self.dead_rows = 0
+
+    def items(self):
+        labels, templates = self.index.items()
+        return labels, templates, [self.samples(label) for label in labels]
+
+    def match(self, queries, threshold):
+        # Returns [(label, distance)] per query; label is None when nothing is within threshold
+        distances, labels = self.index.search(queries, self.candidates)
+        results = []
+        for q, query in enumerate(np.asarray(queries, np.float32).reshape(-1, self.dim)):
+            best, second = distances[q, 0], distances[q, 1] if self.candidates > 1 else np.inf
+            if labels[q, 0] is None:
+                results.append((None, float(best)))
+                continue
+            if best < threshold - self.margin and second - best >= self.margin:
+                results.append((labels[q, 0], float(best)))
+                continue
+            # Ambiguous: compare against the samples of the nearest candidates
+            candidates = [label for label in labels[q] if label is not None]
+            rows = [self.samples(label) for label in candidates]
+            sample_distances = np.sqrt(squared_distances(query[None], np.concatenate(rows))[0])
+            owners = np.repeat(np.arange(len(candidates)), [len(r) for r in rows])
+            nearest = int(np.argmin(sample_distances))
+            candidate = owners[nearest]
+            distance = min(float(sample_distances[nearest]), float(distances[q, candidate]))
+            results.append((candidates[candidate] if distance < threshold else None, distance))
+        return results
+
+    def arrays(self):
+        labels, _, sample_sets = self.items()
+        return {"sample_labels": np.array([label for label, samples in zip(labels, sample_sets) for _ in samples], dtype=str),
+                "sample_vectors": np.concatenate(sample_sets) if sample_sets else np.empty((0, self.dim), np.float32)}
+
+
+def build_gallery(labels, sample_sets, templates=None, kind='auto'):
+    gallery = TemplateGallery(make_index(len(labels), kind=kind))
+    if len(labels):
+        gallery.add(list(labels), sample_sets, templates)
+    return gallery
+
+
+def save_gallery(gallery, path, **meta):
+    save_index(gallery.index, path, gallery.arrays(), **meta)
+
+
+def load_gallery(path):
+    # Returns (gallery, meta); the templates are loaded as an index, the samples regrouped by label
+    index, meta = load_index(path)
+    with np.load(path, allow_pickle=False) as data:
+        sample_labels, sample_vectors = [str(label) for label in data['sample_labels']], data['sample_vectors']
+    grouped = {}
+    for label, vector in zip(sample_labels, sample_vectors):
+        grouped.setdefault(label, []).append(vector)
+    gallery = TemplateGallery(index)
+    labels, templates = index.items()
+    start, sets = 0, []
+    for label, template in zip(labels, templates):
+        samples = grouped.get(label) or [template]
+        gallery.sample_rows[label] = (start, len(samples))
+        start += len(samples)
+        sets.append(np.asarray(samples, np.float32))
+    if sets:
+        gallery.sample_matrix = np.concatenate(sets)
+    return gallery, meta
+
+
+def recall_at_1(index, exact, queries):
+    _, found = index.search(queries, 1)
+    _, expected = exact.search(queries, 1)
+    return float(np.mean(found[:, 0] == expected[:, 0]))
+
+
+def synthetic_gallery(n, dim=512, identities_per_cluster=50, seed=0):
+    # Unit-norm embeddings loosely clustered like real faces, plus a noisy second view of each as queries
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(max(1, n // identities_per_cluster), dim))
+    gallery = centres[rng.integers(len(centres), size=n)] + rng.normal(scale=0.8, size=(n, dim))
+    gallery /= np.linalg.norm(gallery, axis=1, keepdims=True)
+    queries = gallery + rng.normal(scale=0.02, size=(n, dim))
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return gallery.astype(np.float32), queries.astype(np.float32)
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--synthetic', type=int, default=50000, help='size of the synthetic gallery')
+    parser.add_argument('--index', help='report on a saved index instead (queries are its own vectors)')
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[4, 8, 16, 32])
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    opt = parse_opt()
+    if opt.index:
+        index, meta = load_index(opt.index)
+        labels, gallery = index.items()
+        queries = gallery
+        print(f"Loaded {index.kind} index with {len(index)} faces ({meta})")
+    else:
+        gallery, queries = synthetic_gallery(opt.synthetic)
+        labels = [str(i) for i in range(len(gallery))]
+    queries = queries[np.random.default_rng(1).choice(len(queries), min(opt.queries, len(queries)), replace=False)]
+    exact = build_index(labels, gallery, 'brute')
+    start = time.perf_counter()
+    exact.search(queries)
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+    print(f"exact        {len(gallery):>6} faces  {exact_ms:7.3f} ms/query  recall@1 1.0000")
+    start = time.perf_counter()
+    ivf = build_index(labels, gallery, 'ivf')
+    print(f"IVF built with {ivf.nlist} lists in {time.perf_counter() - start:.1f}s")
+    for nprobe in opt.nprobe:
+        ivf.nprobe = nprobe
+        start = time.perf_counter()
+        ivf.search(queries)
+        ms = (time.perf_counter() - start) * 1000 / len(queries)
+        print(f"ivf nprobe {nprobe:<3}{len(gallery):>6} faces  {ms:7.3f} ms/query  recall@1 {recall_at_1(ivf, exact, queries):.4f}")
@@ -0,0 +1,100 @@
+import threading
+import cv2
+import numpy as np
+
+# Cheap face quality score in [0, 1], computed before a face is embedded or classified. It is the
+# product of four terms so that any one of them can veto a face:
+#   size       short side of the box, from MIN_SIZE (0) to GOOD_SIZE (1) full-resolution pixels
+#   detection  MTCNN probability, from MIN_PROB (0) to 1
+#   sharpness  variance of the Laplacian of the 64x64 grey face, relative to SHARP_REFERENCE
+#   yaw        how far the nose sits from the middle of the eyes; profile faces score 0
+# Faces under the gate's threshold are skipped: tiny, blurred or turned-away faces at the back of the
+# room rarely match the gallery and only cost ResNet / emotion CNN time.
+
+MIN_SIZE = 16
+GOOD_SIZE = 64
+MIN_PROB = 0.8
+SHARP_REFERENCE = 120.0
+# Nose offset from the eye midpoint, as a fraction of the eye distance, at which yaw scores 0
+MAX_YAW_OFFSET = 0.35
+
+
+def size_score(box):
+    side = min(box[2] - box[0], box[3] - box[1])
+    return float(np.clip((side - MIN_SIZE) / (GOOD_SIZE - MIN_SIZE), 0, 1))
+
+
+def sharpness_score(face):
+    if face is None or face.size == 0:
+        return 0.0
+    gray = face if face.ndim == 2 else cv2.cvtColor(face, cv2.COLOR_BGR2GRAY)
+    gray = cv2.resize(gray, (64, 64), interpolation=cv2.INTER_AREA)
+    return float(np.clip(cv2.Laplacian(gray, cv2.CV_32F).var() / SHARP_REFERENCE, 0, 1))
+
+
+def yaw_score(left_eye, right_eye, nose):
+    eye_distance = right_eye[0] - left_eye[0]
+    if abs(eye_distance) < 1e-6:
+        return 0.0
+    offset = abs((nose[0] - (left_eye[0] + right_eye[0]) / 2) / eye_distance)
+    return float(np.clip(1 - offset / MAX_YAW_OFFSET, 0, 1))
+
+
+def face_quality(face, box, prob=1.0, left_eye=None, right_eye=None, nose=None):
+    # face is the crop (any channel order; only its grey level is used), box is xyxy in full resolution
+    score = size_score(box) * float(np.clip((prob - MIN_PROB) / (1 - MIN_PROB), 0, 1))
+    if score == 0:
+        return 0.0
+    if left_eye is not None:
+        score *= yaw_score(left_eye, right_eye, nose)
+    return score * sharpness_score(face) if score else 0.0
+
+
+def mtcnn_quality(face, box, prob, points):
+    # MTCNN landmarks are left eye, right eye, nose, left and right mouth corner
+    if points is None:
+        return face_quality(face, box, prob if prob is not None else 1.0)
+    return face_quality(face, box, prob if prob is not None else 1.0, points[0], points[1], points[2])
+
+
+def mesh_quality(face, landmarks):
+    # FaceMesh landmarks: 33 and 263 are the outer eye corners, 1 is the nose tip
+    box = (landmarks[:, 0].min(), landmarks[:, 1].min(), landmarks[:, 0].max(), landmarks[:, 1].max())
+    return face_quality(face, box, 1.0, landmarks[33], landmarks[263], landmarks[1])
+
+
+class QualityGate:
+    # Counts how many faces each detector family saw and skipped; threshold 0 turns the gate off
+    def __init__(self, threshold=0.0):
+        self.threshold = threshold
+        self.seen = {}
+        self.skipped = {}
+        self.lock = threading.Lock()
+
+    def record(self, family, seen, skipped):
+        with self.lock:
+            first = skipped and not self.skipped.get(family)
+            self.seen[family] = self.seen.get(family, 0) + seen
+            self.skipped[family] = self.skipped.get(family, 0) + skipped
+        if first:
+            print(f"Quality gate: skipping {family} faces below {self.threshold} (counts in the session summary)")
+
+    def stats(self):
+        with self.lock:
+            return {"seen": dict(self.seen), "skipped": dict(self.skipped)}
+
+    def merge(self, stats):
+        for family, seen in stats["seen"].items():
+            self.record(family, seen, stats["skipped"].get(family, 0))
+
+    def summary(self):
+        stats = self.stats()
+        if not stats["seen"]:
+            return "Quality gate: no faces seen"
+        parts = [f"{family} {stats['skipped'].get(family, 0)}/{seen} skipped "
+                 f"({stats['skipped'].get(family, 0) / seen:.0%})" for family, seen in stats["seen"].items() if seen]
+        return f"Quality gate (threshold {self.threshold}): " + ", ".join(parts)
+
+
+# Process-wide gate, configured once at startup like scaling.scales
+gate = QualityGate()
@@ -1,44 +1,116 @@
+from contextlib import contextmanager
 import cv2
 import numpy as np
 import torch
-from mtcnn_init import mtcnn, resnet  # Import MTCNN and Resnet from the new module
+import mtcnn_init  # MTCNN and Resnet are loaded on first use
+from scaling import resize, remap_boxes
+from face_quality import mtcnn_quality
+import embedding_store
+
+# Function to detect faces in several images, batching same-sized images (e.g. camera streams) through MTCNN.
+# Returns (boxes, probabilities, landmarks) per image, each None when the image has no face.
+def detect_faces_full(images):
+    if len(images) > 1 and all(image.shape == images[0].shape for image in images):
+        boxes, probs, points = mtcnn_init.mtcnn.detect(np.stack(images), landmarks=True)
+        return list(zip(boxes, probs, points))
+    return [mtcnn_init.mtcnn.detect(image, landmarks=True) for image in images]
+
+# Function to run MTCNN with another minimum face size for the duration of a call. The MTCNN is shared
+# by every caller of the process (the embedding service serves many clients), so the previous size is
+# always put back.
+@contextmanager
+def mtcnn_min_face_size(min_face_size):
+    if not min_face_size:
+        yield
+        return
+    mtcnn = mtcnn_init.mtcnn
+    previous = mtcnn.min_face_size
+    mtcnn.min_face_size = min_face_size
+    try:
+        yield
+    finally:
+        mtcnn.min_face_size = previous
+
+# Function to detect face boxes in several images
+def detect_faces_batch(images):
+    return [boxes for boxes, _, _ in detect_faces_full(images)]
+
+# Function to turn RGB face crops into the NCHW input tensor of the embedder
+def face_tensor(crops):
+    batch = np.stack([cv2.resize(crop, (160, 160)) for crop in crops]).astype(np.float32) / 255.0
+    return torch.from_numpy(np.transpose(batch, (0, 3, 1, 2)))
+
+# Function to encode RGB face crops with a single ResNet forward pass
+def encode_faces(crops):
+    if not crops:
+        return np.empty((0, 512), np.float32)
+    with torch.no_grad():
+        return mtcnn_init.resnet(face_tensor(crops)).numpy()
+
+# Function to crop every face MTCNN finds in an RGB image
+def crop_faces(image):
+    boxes = detect_faces_batch([image])[0]
+    if boxes is None:
+        return []
+    crops = [image[max(0, int(box[1])):int(box[3]), max(0, int(box[0])):int(box[2])] for box in boxes]
+    return [crop for crop in crops if crop.size]
+
+# Function to detect and encode faces across several images, returns (encodings, boxes) per image.
+# MTCNN runs on a copy resized by scale; boxes are returned in full-resolution coordinates and the
+# faces are cropped from the full-resolution image. With bgr=True only the small copy and the crops
+# are color converted, never the full frame. min_face_size, if given, is MTCNN's minimum face size.
+# With a quality threshold, faces scoring below it (see face_quality.py) are not encoded; if skipped is
+# a list it receives the number of such faces per image.
+def detect_and_encode_batch(images, scale=1.0, bgr=False, min_face_size=None, quality=None, skipped=None):
+    results = [([], []) for _ in images]
+    skipped_faces = [0] * len(images)
+    crops, owners = [], []
+    detection_images = [resize(image, scale) for image in images]
+    if bgr:
+        detection_images = [cv2.cvtColor(image, cv2.COLOR_BGR2RGB) for image in detection_images]
+    with mtcnn_min_face_size(min_face_size):
+        detections = detect_faces_full(detection_images)
+    for i, (image, (boxes, probs, points)) in enumerate(zip(images, detections)):
+        if boxes is None:
+            continue
+        points = remap_boxes(points, scale) if points is not None else [None] * len(boxes)
+        for box, prob, landmarks in zip(remap_boxes(boxes, scale), probs, points):
+            face = image[max(0, int(box[1])):int(box[3]), max(0, int(box[0])):int(box[2])]
+            if face.size == 0:
+                continue
+            if quality and mtcnn_quality(face, box, prob, landmarks) < quality:
+                skipped_faces[i] += 1
+                continue
+            crops.append(cv2.cvtColor(face, cv2.COLOR_BGR2RGB) if bgr else face)
+            owners.append((i, box))
+    for (i, box), encoding in zip(owners, encode_faces(crops)):
+        results[i][0].append(encoding)
+        results[i][1].append(box)
+    if skipped is not None:
+        skipped.extend(skipped_faces)
+    return results
 
 # Function to detect and encode faces
 def detect_and_encode(image):
-    with torch.no_grad():
-        boxes, _ = mtcnn.detect(image)
-        if boxes is not None:
-            faces = []
-            for box in boxes:
-                face = image[int(box[1]):int(box[3]), int(box[0]):int(box[2])]
-                if face.size == 0:
-                    continue
-                face = cv2.resize(face, (160, 160))
-                face = np.transpose(face, (2, 0, 1)).astype(np.float32) / 255.0
-                face_tensor = torch.tensor(face).unsqueeze(0)
-                encoding = resnet(face_tensor).detach().numpy().flatten()
-                faces.append(encoding)
-            return faces
-    return []
-
-# Function to recognize faces
+    encodings, _ = detect_and_encode_batch([image])[0]
+    return encodings
+
+# Function to recognize faces, one exact nearest-neighbour search for all test encodings
 def recognize_faces(known_encodings, known_names, test_encodings, threshold=0.6):
-    recognized_names = []
-    for test_encoding in test_encodings:
-        distances = np.linalg.norm(known_encodings - test_encoding, axis=1)
-        if distances.size == 0:
-            recognized_names.append('No match found')
-        else:
-            min_distance_idx = np.argmin(distances)
-            if distances[min_distance_idx] < threshold:
-                recognized_names.append(known_names[min_distance_idx])
-            else:
-                recognized_names.append('Not Recognized')
-    return recognized_names
+    from face_index import build_index
+    if len(known_encodings) == 0:
+        return ['No match found' for _ in test_encodings]
+    if len(test_encodings) == 0:
+        return []
+    index = build_index(list(range(len(known_names))), known_encodings, 'brute')
+    distances, labels = index.search(test_encodings, 1)
+    return [known_names[label] if distance < threshold else 'Not Recognized'
+            for distance, label in zip(distances[:, 0], labels[:, 0])]
 
 # Function to load known faces from MongoDB
 def load_known_faces(db):
     import gridfs
+    import embedding_service
     collection = db['students']
     fs = gridfs.GridFS(db)
     known_face_encodings = []
@@ -53,7 +125,7 @@ def load_known_faces(db):
                 image_np = np.frombuffer(image_data, np.uint8)
                 image = cv2.imdecode(image_np, cv2.IMREAD_COLOR)
                 image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-                encodings = detect_and_encode(image_rgb)
+                encodings, _ = embedding_service.detect_and_encode_batch([image_rgb])[0]
                 if encodings:
                     known_face_encodings.append(encodings[0])
                     known_face_names.append(student["name"])
@@ -65,4 +137,138 @@ def load_known_faces(db):
 
     return known_face_encodings, known_face_names, known_face_ids
 
+# Function to encode the first face of each (key, student id, image id, name) enrollment photo, returns
+# {key: encoding}. Photos with a stored face crop (profile_images.py) are encoded from it in one batch
+# without reading the photo or running MTCNN. The rest are detected one by one (the embedding service
+# batches them with other clients), and their thumbnail and face crop are stored for the next rebuild.
+def encode_enrollment_photos(db, photos, model=None):
+    import gridfs
+    import embedding_service
+    import profile_images
+    fs = gridfs.GridFS(db)
+    face_ids = {s["profile_image_id"]: s.get("profile_face_id") for s in db['students'].find(
+        {"profile_image_id": {"$in": [image_id for _, _, image_id, _ in photos]}}, {"profile_image_id": 1, "profile_face_id": 1})}
+    faces = profile_images.load_face_crops(fs, [face_id for face_id in face_ids.values() if face_id])
+    cropped = [(key, faces[face_ids[image_id]]) for key, _, image_id, _ in photos if face_ids.get(image_id) in faces]
+    encoded = dict(zip([key for key, _ in cropped], embedding_service.encode_faces([face for _, face in cropped], model)))
+    for key, student_id, image_id, name in photos:
+        if key in encoded:
+            continue
+        try:
+            image = cv2.cvtColor(cv2.imdecode(np.frombuffer(fs.get(image_id).read(), np.uint8), cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+            encodings, boxes = embedding_service.detect_and_encode_batch([image], model=model)[0]
+            if encodings:
+                encoded[key] = encodings[0]
+            profile_images.store_derivatives(db, fs, student_id, image, boxes[0] if boxes else None)
+        except Exception as e:
+            print(f"Failed to load or encode image for student {name}: {e}")
+    return encoded
+
+# Index labels are "<student id>:<photo id>", so a recaptured photo replaces the old entry
+def gallery_label(student_id, image_id):
+    return f"{student_id}:{image_id}"
+
+# Function to load the persisted gallery and bring it in line with the students collection: enrollments
+# missing from it come from the embedding store, photos not in the store are encoded (and written back),
+# removed students are dropped. Returns (gallery, students) where students maps each gallery label to
+# (student _id, name).
+def load_gallery_index(db, path=None):
+    import os
+    from face_index import GALLERY_INDEX_PATH, IVF_MIN_SIZE, load_gallery, build_gallery, save_gallery
+    from embedder import model_version
+    path = path or GALLERY_INDEX_PATH
+    embedder = os.environ.get('FYP_EMBEDDER', 'fp32')
+    version = model_version(embedder)
+    gallery = None
+    if os.path.exists(path):
+        try:
+            gallery, meta = load_gallery(path)
+            if meta.get('embedder') != embedder or meta.get('model_version') != version:
+                print(f"Gallery index was built with {meta.get('embedder')} {meta.get('model_version')}, rebuilding for {embedder} {version}")
+                gallery = None
+        except Exception as e:
+            print(f"Failed to load gallery index {path}: {e}")
+            gallery = None
+
+    students, photos = {}, []
+    for student in db['students'].find({"profile_image_id": {"$exists": True}}, {"name": 1, "profile_image_id": 1}):
+        if not student.get("profile_image_id"):
+            continue
+        label = gallery_label(student["_id"], student["profile_image_id"])
+        students[label] = (student["_id"], student["name"])
+        if gallery is None or label not in gallery:
+            photos.append((label, student["_id"], student["profile_image_id"], student["name"]))
+
+    labels, templates, sample_sets = gallery.items() if gallery is not None else ([], [], [])
+    stale = [label for label in labels if label not in students]
+    stored = embedding_store.load_enrollments(db, embedder, [image_id for _, _, image_id, _ in photos]) if photos else {}
+    enrolled = {label: stored[(student_id, image_id)] for label, student_id, image_id, _ in photos
+                if (student_id, image_id) in stored}
+    missing = [photo for photo in photos if photo[0] not in enrolled]
+    model = {}  # the model that encoded them (the embedding service's, when it was used)
+    fresh = encode_enrollment_photos(db, missing, model)
+    embedding_store.store_enrollments(db, [(student_id, image_id, [fresh[label]], None)
+                                           for label, student_id, image_id, _ in missing if label in fresh],
+                                      embedder, model.get("model_version"))
+    enrolled.update({label: (np.asarray([vector]), None) for label, vector in fresh.items()})
+
+    rebuild = gallery is None or (gallery.kind == 'brute') != (len(students) < IVF_MIN_SIZE)
+    if rebuild:
+        # No usable gallery, or it has crossed the size where the other index kind is better
+        keep = [i for i, label in enumerate(labels) if label in students]
+        gallery = build_gallery([labels[i] for i in keep] + list(enrolled),
+                                [sample_sets[i] for i in keep] + [samples for samples, _ in enrolled.values()])
+    else:
+        gallery.remove(stale)
+        if enrolled:
+            gallery.add(list(enrolled), [samples for samples, _ in enrolled.values()],
+                        [template for _, template in enrolled.values()] if all(t is not None for _, t in enrolled.values()) else None)
+    if rebuild or stale or enrolled:
+        save_gallery(gallery, path, embedder=embedder, model_version=version)
+
+    print(f"Loaded {len(gallery)} known faces ({gallery.kind} index, {len(fresh)} newly encoded).")
+    return gallery, {label: students[label] for label in gallery.index.items()[0]}
+
+# Function to store the sample embeddings of a new enrollment (one or more RGB images of the student,
+# the first being the profile photo) and add the student to the persisted gallery. With the face box of
+# each image (e.g. from the capture loop) the faces are encoded directly, without running MTCNN again.
+# Running sessions add the new enrollment to their gallery through gallery_watch.py.
+def index_student_photo(db, student_id, image_id, images_rgb, boxes=None, path=None):
+    import os
+    import embedding_service
+    from face_index import GALLERY_INDEX_PATH, load_gallery, save_gallery
+    from profile_images import face_crop
+    from embedder import model_version
+    path = path or GALLERY_INDEX_PATH
+    embedder = os.environ.get('FYP_EMBEDDER', 'fp32')
+    model = {}
+    if boxes is not None:
+        crops = [face_crop(image, box) for image, box in zip(images_rgb, boxes)]
+        samples = list(embedding_service.encode_faces([crop for crop in crops if crop is not None], model))
+    else:
+        samples = [encodings[0] for encodings, _ in embedding_service.detect_and_encode_batch(images_rgb, model=model) if encodings]
+    version = model.get("model_version") or model_version(embedder)
+    embedding_store.delete_embeddings(db, student_id, keep_image_ids=[image_id])
+    if samples:
+        embedding_store.store_enrollments(db, [(student_id, image_id, samples, None)], embedder, version)
+    if not os.path.exists(path):
+        return len(samples)  # built in full the next time a session starts
+    gallery, meta = load_gallery(path)
+    if meta.get('embedder') == embedder and meta.get('model_version') == version:
+        gallery.remove([label for label in gallery.index.items()[0] if label.startswith(f"{student_id}:")])
+        if samples:
+            gallery.add([gallery_label(student_id, image_id)], [np.asarray(samples, np.float32)])
+        save_gallery(gallery, path, **meta)
+    return len(samples)
 
+# Function to drop a deleted student from the embedding store and the persisted gallery
+def unindex_student(db, student_id, path=None):
+    import os
+    from face_index import GALLERY_INDEX_PATH, load_gallery, save_gallery
+    path = path or GALLERY_INDEX_PATH
+    embedding_store.delete_embeddings(db, student_id)
+    if not os.path.exists(path):
+        return
+    gallery, meta = load_gallery(path)
+    gallery.remove([label for label in gallery.index.items()[0] if label.startswith(f"{student_id}:")])
+    save_gallery(gallery, path, **meta)
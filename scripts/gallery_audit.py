@@ -0,0 +1,133 @@
+import os
+import csv
+import time
+import argparse
+import numpy as np
+
+# Offline audit of the enrolled gallery for duplicate enrollments and swapped or mislabelled photos.
+# All stored templates are compared with each other as blocked all-pairs cosine similarity: the unit
+# vectors are multiplied block by block (block x block similarities at a time), so 50k students need a
+# few hundred MB instead of a 50k x 50k matrix. Pairs of different students that are as similar as the
+# live matcher's threshold are reported, split into same-intake and cross-intake pairs, together with
+# students whose own enrollment samples disagree with each other.
+#   python gallery_audit.py --report audit.csv
+
+# detect.py accepts a match below Euclidean distance 0.7; for unit vectors that is this cosine similarity
+MATCH_SIMILARITY = 1 - 0.7 ** 2 / 2
+# Above this two enrollments are almost certainly the same person
+DUPLICATE_SIMILARITY = 0.9
+
+
+def load_gallery_embeddings(db, embedder):
+    # Templates (and samples) of every student's current enrollment, with the student's details
+    import embedding_store
+    from face_index import make_template
+    students = {s["_id"]: s for s in db["students"].find({"profile_image_id": {"$exists": True}},
+                                                          {"name": 1, "TPNumber": 1, "intake": 1, "profile_image_id": 1})}
+    intakes = {i["_id"]: i.get("intake", "N/A") for i in db["intake"].find({}, {"intake": 1})}
+    enrollments = embedding_store.load_enrollments(db, embedder, [s["profile_image_id"] for s in students.values()])
+    rows, templates, sample_sets = [], [], []
+    for (student_id, image_id), (samples, template) in enrollments.items():
+        student = students.get(student_id)
+        if student is None or student.get("profile_image_id") != image_id:
+            continue
+        rows.append({"id": student_id, "name": student.get("name", "N/A"), "tp_number": student.get("TPNumber", "N/A"),
+                     "intake": intakes.get(student.get("intake"), "N/A")})
+        templates.append(make_template(samples) if template is None else template)
+        sample_sets.append(samples)
+    return rows, np.asarray(templates, np.float32).reshape(-1, 512), sample_sets
+
+
+def normalize(vectors):
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def similar_pairs(vectors, threshold, block=4096, max_per_row=20):
+    # Yields (i, j, similarity) for i < j with cosine similarity >= threshold, computing only the upper
+    # triangle of the similarity matrix one block x block tile at a time
+    unit = normalize(np.asarray(vectors, np.float32))
+    n = len(unit)
+    for start in range(0, n, block):
+        rows = unit[start:start + block]
+        for other in range(start, n, block):
+            tile = rows @ unit[other:other + block].T
+            if other == start:
+                tile = np.triu(tile, k=1)  # same block: each pair once, no self-pairs
+            i, j = np.nonzero(tile >= threshold)
+            if len(i) > max_per_row * len(rows):
+                # A degenerate tile (e.g. many blank photos): keep only the most similar pairs
+                keep = np.argsort(tile[i, j])[::-1][:max_per_row * len(rows)]
+                i, j = i[keep], j[keep]
+            for a, b in zip(i, j):
+                yield start + int(a), other + int(b), float(tile[a, b])
+
+
+def inconsistent_samples(sample_sets, threshold):
+    # Students whose least similar pair of own samples falls below the match similarity
+    for index, samples in enumerate(sample_sets):
+        if len(samples) < 2:
+            continue
+        unit = normalize(np.asarray(samples, np.float32))
+        worst = float((unit @ unit.T).min())
+        if worst < threshold:
+            yield index, worst
+
+
+def audit(rows, templates, sample_sets, threshold=MATCH_SIMILARITY, duplicate=DUPLICATE_SIMILARITY, block=4096):
+    findings = []
+    for i, j, similarity in similar_pairs(templates, threshold, block):
+        a, b = rows[i], rows[j]
+        kind = 'duplicate' if similarity >= duplicate else 'lookalike'
+        scope = 'same_intake' if a["intake"] == b["intake"] else 'cross_intake'
+        findings.append({"kind": kind, "scope": scope, "similarity": round(similarity, 4),
+                         "student_a": f"{a['name']} ({a['tp_number']})", "intake_a": a["intake"],
+                         "student_b": f"{b['name']} ({b['tp_number']})", "intake_b": b["intake"]})
+    for i, similarity in inconsistent_samples(sample_sets, threshold):
+        a = rows[i]
+        findings.append({"kind": 'inconsistent_samples', "scope": 'student', "similarity": round(similarity, 4),
+                         "student_a": f"{a['name']} ({a['tp_number']})", "intake_a": a["intake"],
+                         "student_b": "", "intake_b": ""})
+    findings.sort(key=lambda f: (f["kind"] != 'duplicate', -f["similarity"]))
+    return findings
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threshold', type=float, default=MATCH_SIMILARITY, help='cosine similarity reported as suspicious')
+    parser.add_argument('--duplicate', type=float, default=DUPLICATE_SIMILARITY, help='cosine similarity reported as a duplicate')
+    parser.add_argument('--block', type=int, default=4096, help='rows per block of the all-pairs product')
+    parser.add_argument('--embedder', default=os.environ.get('FYP_EMBEDDER', 'fp32'))
+    parser.add_argument('--synthetic', type=int, help='audit this many random embeddings instead (timing only)')
+    parser.add_argument('--show', type=int, default=50, help='findings to print')
+    parser.add_argument('--report', help='save all findings as CSV')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    opt = parse_opt()
+    start = time.time()
+    if opt.synthetic:
+        from face_index import synthetic_gallery
+        templates, _ = synthetic_gallery(opt.synthetic)
+        rows = [{"id": i, "name": f"student{i}", "tp_number": f"TP{i:06d}", "intake": f"intake{i % 20}"} for i in range(len(templates))]
+        sample_sets = [[] for _ in rows]
+    else:
+        from conn import get_db
+        rows, templates, sample_sets = load_gallery_embeddings(get_db(), opt.embedder)
+    loaded = time.time()
+    findings = audit(rows, templates, sample_sets, opt.threshold, opt.duplicate, opt.block)
+    print(f"Audited {len(rows)} students in {time.time() - loaded:.1f}s (loading took {loaded - start:.1f}s)")
+    counts = {}
+    for finding in findings:
+        key = f"{finding['kind']}/{finding['scope']}"
+        counts[key] = counts.get(key, 0) + 1
+    print(", ".join(f"{count} {key}" for key, count in sorted(counts.items())) or "No suspicious pairs")
+    for finding in findings[:opt.show]:
+        print(f"{finding['kind']:<21} {finding['scope']:<13} {finding['similarity']:.3f}  "
+              f"{finding['student_a']} [{finding['intake_a']}]  {finding['student_b']} [{finding['intake_b']}]")
+    if opt.report:
+        with open(opt.report, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=["kind", "scope", "similarity", "student_a", "intake_a", "student_b", "intake_b"])
+            writer.writeheader()
+            writer.writerows(findings)
+        print(f"Saved report to {opt.report}")
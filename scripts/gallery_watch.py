@@ -0,0 +1,199 @@
+import os
+import queue
+import threading
+from datetime import timedelta
+from bson import ObjectId
+from pymongo.errors import OperationFailure, PyMongoError
+import embedding_store
+from tracing import tracer
+
+# Keeps a running session's gallery in step with enrollments made while it runs. A background thread
+# follows a MongoDB change stream on the students collection and the embedding store (or, where change
+# streams are unavailable, e.g. a standalone local server, polls them) and turns what it sees into
+# changes that are queued for the session:
+#   ('add', student_id, image_id, name, samples, template)   a new or recaptured enrollment
+#   ('rename', student_id, name)
+#   ('remove', student_id)                                   deleted student or removed photo
+# All database reads happen on the watcher thread; the frame loop only drains the queue with
+# apply_changes, which updates the gallery in place. A stream that cannot be resumed from its last
+# resume token (none seen yet, or the oplog has moved past it) is opened afresh and followed by a
+# catch-up, so changes made while it was down still reach the session.
+
+STUDENT_FIELDS = {"name": 1, "profile_image_id": 1}
+# Change stream errors meaning the resume token is no longer usable (history lost, token too old, bad token)
+RESUME_FAILED = (280, 286, 222)
+
+
+class GalleryWatcher:
+    def __init__(self, db, since, embedder=None, poll_interval=5.0):
+        self.db = db
+        self.since = since
+        self.embedder = embedder or os.environ.get('FYP_EMBEDDER', 'fp32')
+        self.poll_interval = poll_interval
+        self.changes = queue.Queue()
+        self.known = {}  # student _id -> (image_id, name) as last reported to the session
+        self.mode = None
+        self.resume_token = None
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='GalleryWatcher', daemon=True)
+
+    def start(self, students):
+        # students: the session's {label: (student _id, name)} the gallery was loaded with
+        for label, (student_id, name) in students.items():
+            self.known[student_id] = (ObjectId(label.split(':', 1)[1]), name)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            try:
+                self._watch(self.resume_token)
+                return
+            except OperationFailure as e:
+                if self.mode is None or e.code in (40573, 136):  # not a replica set / change streams disabled
+                    print(f"Change streams unavailable ({e}), polling for enrollments every {self.poll_interval:.0f}s")
+                    self._poll()
+                    return
+                print(f"Gallery change stream failed: {e}")
+            except PyMongoError as e:
+                print(f"Gallery change stream lost ({e}), reconnecting")
+            self.stop_event.wait(self.poll_interval)
+
+    def _open(self, pipeline, resume_token):
+        # (stream, whether it resumed from resume_token)
+        if resume_token is not None:
+            try:
+                return self.db.watch(pipeline, resume_after=resume_token, max_await_time_ms=1000), True
+            except OperationFailure as e:
+                if e.code not in RESUME_FAILED:
+                    raise
+                print(f"Gallery change stream cannot resume ({e}), catching up instead")
+                self.resume_token = None
+        return self.db.watch(pipeline, max_await_time_ms=1000), False
+
+    def _watch(self, resume_token):
+        pipeline = [{"$match": {"ns.coll": {"$in": ["students", embedding_store.COLLECTION]}}}]
+        stream, resumed = self._open(pipeline, resume_token)
+        with stream:
+            self.mode = 'change_stream'
+            if not resumed:
+                # Changes between loading the gallery (or losing the previous stream) and opening this one
+                with tracer.span('gallery_catch_up', 'db'):
+                    self._catch_up()
+            while not self.stop_event.is_set():
+                event = stream.try_next()
+                if event is None:
+                    continue
+                self.resume_token = stream.resume_token
+                with tracer.span('gallery_change', 'db', op=event["operationType"]):
+                    self._handle(event)
+
+    def _handle(self, event):
+        op, collection = event["operationType"], event["ns"]["coll"]
+        if collection == embedding_store.COLLECTION:
+            if op in ("insert", "update", "replace"):
+                doc = self.db[embedding_store.COLLECTION].find_one(
+                    {"_id": event["documentKey"]["_id"]}, {"student_id": 1, "image_id": 1, "embedder": 1, "sample": 1})
+                if doc and doc["embedder"] == self.embedder and doc.get("sample") == embedding_store.TEMPLATE:
+                    self._enroll([doc["image_id"]])
+        elif op == "delete":
+            self._report_removed(event["documentKey"]["_id"])
+        elif op in ("update", "replace"):
+            fields = event.get("updateDescription", {})
+            touched = set(fields.get("updatedFields", {})) | set(fields.get("removedFields", []))
+            if op == "replace" or touched & set(STUDENT_FIELDS):
+                self._check_student(event["documentKey"]["_id"])
+
+    def _catch_up(self):
+        # New enrollments since the last check, then deleted students, removed photos and renames among
+        # the students in the gallery (one indexed lookup)
+        enrollments, self.since = embedding_store.enrollments_since(self.db, self.embedder, self.since)
+        self._report_enrollments(enrollments)
+        current = {s["_id"]: s for s in self.db["students"].find({"_id": {"$in": list(self.known)}}, STUDENT_FIELDS)}
+        for student_id in list(self.known):
+            self._compare(student_id, current.get(student_id))
+
+    def _poll(self):
+        self.mode = 'poll'
+        while not self.stop_event.wait(self.poll_interval):
+            try:
+                with tracer.span('gallery_poll', 'db'):
+                    self._catch_up()
+            except PyMongoError as e:
+                print(f"Gallery poll failed: {e}")
+
+    def _enroll(self, image_ids):
+        self._report_enrollments(embedding_store.load_enrollments(self.db, self.embedder, image_ids))
+
+    def _report_enrollments(self, enrollments):
+        if not enrollments:
+            return
+        students = {s["_id"]: s for s in self.db["students"].find(
+            {"_id": {"$in": [student_id for student_id, _ in enrollments]}}, STUDENT_FIELDS)}
+        for (student_id, image_id), (samples, template) in enrollments.items():
+            student = students.get(student_id)
+            if student is None or student.get("profile_image_id") != image_id:
+                continue  # deleted, or photographed again since
+            if self.known.get(student_id) == (image_id, student.get("name", "N/A")):
+                continue  # already in the gallery
+            self.known[student_id] = (image_id, student.get("name", "N/A"))
+            self.changes.put(('add', student_id, image_id, student.get("name", "N/A"), samples, template))
+
+    def _check_student(self, student_id):
+        self._compare(student_id, self.db["students"].find_one({"_id": student_id}, STUDENT_FIELDS))
+
+    def _compare(self, student_id, student):
+        if student_id not in self.known:
+            return  # not in the gallery yet; it arrives with its embeddings
+        if student is None or not student.get("profile_image_id"):
+            self._report_removed(student_id)
+            return
+        image_id, name = self.known[student_id]
+        if student["profile_image_id"] != image_id:
+            # New photo: replaced once its embeddings are stored
+            self._enroll([student["profile_image_id"]])
+        elif student.get("name", "N/A") != name:
+            self.known[student_id] = (image_id, student.get("name", "N/A"))
+            self.changes.put(('rename', student_id, student.get("name", "N/A")))
+
+    def _report_removed(self, student_id):
+        if self.known.pop(student_id, None) is not None:
+            self.changes.put(('remove', student_id))
+
+
+def apply_changes(watcher, gallery, students, limit=50):
+    # Applies up to limit queued changes to the gallery and its {label: (student _id, name)} map without
+    # waiting; returns how many were applied
+    from face_recognition import gallery_label
+    applied = 0
+    while applied < limit:
+        try:
+            change = watcher.changes.get_nowait()
+        except queue.Empty:
+            break
+        kind, student_id = change[0], change[1]
+        old = [label for label, (owner, _) in students.items() if owner == student_id]
+        if kind == 'rename':
+            for label in old:
+                students[label] = (student_id, change[2])
+        else:
+            gallery.remove(old)
+            for label in old:
+                del students[label]
+            if kind == 'add':
+                _, _, image_id, name, samples, template = change
+                label = gallery_label(student_id, image_id)
+                gallery.add([label], [samples], [template] if template is not None else None)
+                students[label] = (student_id, name)
+        print(f"Gallery {kind}: student {student_id} ({len(gallery)} known faces)")
+        applied += 1
+    return applied
+
+
+def watch_gallery(db, students, loaded_at, embedder=None, poll_interval=5.0):
+    # Starts a watcher for a gallery loaded at loaded_at; the margin covers clock differences between
+    # enrolling machines and this one (re-reported enrollments are skipped)
+    return GalleryWatcher(db, loaded_at - timedelta(minutes=1), embedder, poll_interval).start(students)
@@ -7,13 +7,49 @@ from PySide6.QtCore import Qt
 import pandas as pd
 import subprocess
 from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError
 from conn import get_db
+from intake_cache import intakes
 
 # Connect to MongoDB
 db = get_db()
 intake_collection = db["intake"]
 student_collection = db["students"]
 
+def import_student_sheet(df, intake_id):
+    # Imports the Name / TP_Number rows of a sheet into an intake with one lookup and one insert.
+    # Returns (inserted students, duplicate entries, TP number conflicts) as lists of (name, TP number).
+    # Rows are classified as the row-by-row importer did: a row whose TP number is already taken, by a
+    # student in the database or by an earlier row of the sheet, is a TP number conflict. That check came
+    # before the one for the same student in this intake, so those rows are conflicts as well.
+    rows = [(str(name).strip(), str(tp_number).strip()) for name, tp_number in
+            df.drop_duplicates(subset=['Name', 'TP_Number'])[['Name', 'TP_Number']].itertuples(index=False, name=None)]
+    rows = [(name, tp_number) for name, tp_number in rows if name and tp_number]  # skip blank details
+
+    taken = {s["TPNumber"] for s in student_collection.find(
+        {"TPNumber": {"$in": list({tp_number for _, tp_number in rows})}}, {"TPNumber": 1})}
+    duplicate_entries, tp_conflicts, students = [], [], []
+    for name, tp_number in rows:
+        if tp_number in taken:
+            tp_conflicts.append((name, tp_number))
+            continue
+        taken.add(tp_number)
+        students.append({"name": name, "TPNumber": tp_number, "intake": intake_id, "class_id": []})
+
+    if not students:
+        return [], duplicate_entries, tp_conflicts
+    try:
+        student_collection.insert_many(students, ordered=False)
+        inserted = students
+    except BulkWriteError as e:
+        # TP numbers taken between the lookup and the insert are rejected by the unique index
+        failed = {error["index"] for error in e.details["writeErrors"] if error["code"] == 11000}
+        tp_conflicts += [(students[i]["name"], students[i]["TPNumber"]) for i in sorted(failed)]
+        if len(failed) != len(e.details["writeErrors"]):
+            raise
+        inserted = [student for i, student in enumerate(students) if i not in failed]
+    return inserted, duplicate_entries, tp_conflicts
+
 class IntakeManager(QMainWindow):
     def __init__(self, username):
         super().__init__()
@@ -133,6 +169,7 @@ class IntakeManager(QMainWindow):
             selected_row = selected_items[0].row()
             intake_id = self.table.item(selected_row, 0).data(Qt.UserRole)
             intake_collection.delete_one({"_id": ObjectId(intake_id)})
+            intakes.invalidate()
             self.load_data()
             self.student_tree.clear()
             QMessageBox.information(self, "Success", "Intake deleted successfully!")
@@ -147,45 +184,7 @@ class IntakeManager(QMainWindow):
         intake_id = self.table.item(selected_row, 0).data(Qt.UserRole)
         file_path, _ = QFileDialog.getOpenFileName(self, "Open Excel File", "", "Excel Files (*.xlsx *.xls)")
         if file_path:
-            df = pd.read_excel(file_path).drop_duplicates(subset=['Name', 'TP_Number'])
-            unique_entries = set()
-            duplicate_entries = []
-            tp_conflicts = []
-
-            for _, row in df.iterrows():
-                student_name = str(row['Name']).strip()
-                tp_number = str(row['TP_Number']).strip()
-
-                # Skip rows with missing or blank details
-                if not all([student_name, tp_number]):
-                    continue
-
-                # Check for existing students with the same TP number
-                tp_conflict = student_collection.find_one({"TPNumber": tp_number})
-                if tp_conflict:
-                    tp_conflicts.append((student_name, tp_number))
-                    continue
-
-                # Check for existing students with the same name, TP number, and intake
-                existing_student = student_collection.find_one({
-                    "name": student_name,
-                    "TPNumber": tp_number,
-                    "intake": ObjectId(intake_id)
-                })
-
-                if existing_student:
-                    duplicate_entries.append((student_name, tp_number))
-                else:
-                    unique_key = (student_name, tp_number)
-                    if unique_key not in unique_entries:
-                        unique_entries.add(unique_key)
-                        student_doc = {
-                            "name": student_name,
-                            "TPNumber": tp_number,
-                            "intake": ObjectId(intake_id),
-                            "class_id": []  # Initialize with an empty list
-                        }
-                        student_collection.insert_one(student_doc)
+            imported, duplicate_entries, tp_conflicts = import_student_sheet(pd.read_excel(file_path), ObjectId(intake_id))
 
             self.load_students_in_intake()
             if tp_conflicts:
@@ -195,7 +194,7 @@ class IntakeManager(QMainWindow):
                 duplicates_str = "\n".join([f"Name: {name}, TP Number: {tp}" for name, tp in duplicate_entries])
                 QMessageBox.warning(self, "Duplicate Entries Found", f"The following entries already exist and were not imported:\n{duplicates_str}")
             if not tp_conflicts and not duplicate_entries:
-                QMessageBox.information(self, "Success", f"Imported {len(unique_entries)} students.")
+                QMessageBox.information(self, "Success", f"Imported {len(imported)} students.")
 
     def load_students_in_intake(self):
         self.student_tree.clear()
@@ -262,6 +261,7 @@ class IntakeDialog(QDialog):
         else:
             intake_collection.insert_one(intake_data)
             QMessageBox.information(self, "Success", "Intake added successfully!")
+        intakes.invalidate()
 
         self.accept()
         self.parent().load_data()  # Reload data after saving
@@ -0,0 +1,32 @@
+import time
+import threading
+
+# Intake id -> name for the whole session, loaded with one query the first time a listing needs it, so
+# class and student listings resolve intake names without a query per row. Intake edits call
+# invalidate(); other processes' edits are picked up after max_age seconds.
+
+
+class IntakeCache:
+    def __init__(self, max_age=60):
+        self.max_age = max_age
+        self.names = None
+        self.loaded_at = 0
+        self.lock = threading.Lock()
+
+    def load(self, db):
+        with self.lock:
+            if self.names is None or time.time() - self.loaded_at > self.max_age:
+                self.names = {intake["_id"]: intake.get("intake", "N/A") for intake in db["intake"].find({}, {"intake": 1})}
+                self.loaded_at = time.time()
+            return self.names
+
+    def name(self, db, intake_id, default="Unknown"):
+        return self.load(db).get(intake_id, default)
+
+    def invalidate(self):
+        with self.lock:
+            self.names = None
+
+
+# Process-wide cache; each page runs in its own process, so this lives for one page session
+intakes = IntakeCache()
@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import numpy as np
+
+# Per-student label totals of a live session, in (students x labels) arrays updated in place:
+#   seconds    how long the student was seen showing the label
+#   episodes   how many separate times (sightings more than EPISODE_GAP seconds apart start a new one)
+#   last_seen  epoch time of the latest sighting (NaN if never)
+# A detection is one dict lookup per index and three array writes. Rows and columns are added by
+# doubling when a student or label first appears, so memory is bounded by the gallery and label set.
+# The frame loop checkpoints the arrays to disk periodically and flushes them to the journal once at
+# the end of the session. After a crash, the next session of the same class and user started within
+# a short time resumes from the checkpoint; older checkpoints are flushed as they are.
+
+EPISODE_GAP = 2.0
+FIELDS = ('seconds', 'episodes', 'last_seen')
+CHECKPOINT_SUFFIX = '_durations.npz'
+
+
+class LabelDurations:
+    def __init__(self, students=64, labels=16):
+        self.seconds = np.zeros((students, labels), np.float64)
+        self.episodes = np.zeros((students, labels), np.int32)
+        self.last_seen = np.full((students, labels), np.nan)
+        self.students, self.student_index = [], {}
+        self.labels, self.label_index = [], {}
+        # Set when loaded from a checkpoint: what it was saved with, when and where
+        self.meta, self.saved_at, self.path = {}, None, None
+
+    def _grow(self, rows, cols):
+        old_rows, old_cols = self.seconds.shape
+        if rows <= old_rows and cols <= old_cols:
+            return
+        shape = (max(rows, 2 * old_rows) if rows > old_rows else old_rows,
+                 max(cols, 2 * old_cols) if cols > old_cols else old_cols)
+        for field, fill in (('seconds', 0), ('episodes', 0), ('last_seen', np.nan)):
+            old = getattr(self, field)
+            new = np.full(shape, fill, old.dtype)
+            new[:old_rows, :old_cols] = old
+            setattr(self, field, new)
+
+    def index(self, student_id, kind, label):
+        i = self.student_index.get(student_id)
+        if i is None:
+            i = self.student_index[student_id] = len(self.students)
+            self.students.append(student_id)
+        j = self.label_index.get((kind, label))
+        if j is None:
+            j = self.label_index[(kind, label)] = len(self.labels)
+            self.labels.append((kind, label))
+        self._grow(len(self.students), len(self.labels))
+        return i, j
+
+    def add(self, t, student_id, kind, label):
+        i, j = self.index(student_id, kind, label)
+        gap = t - self.last_seen[i, j]
+        if gap <= EPISODE_GAP:  # False for NaN, i.e. a first sighting
+            self.seconds[i, j] += gap
+        else:
+            self.episodes[i, j] += 1
+        self.last_seen[i, j] = t
+
+    def columns(self, kind):
+        # Label names of one kind and their column indices
+        return [label for k, label in self.labels if k == kind], [j for j, (k, _) in enumerate(self.labels) if k == kind]
+
+    def seen(self, kind):
+        # {student_id: {label: (seconds, episodes)}} of the labels of one kind each student showed
+        names, cols = self.columns(kind)
+        n = len(self.students)
+        episodes, seconds = self.episodes[:n, cols], self.seconds[:n, cols]
+        return {self.students[i]: {names[c]: (float(seconds[i, c]), int(episodes[i, c])) for c in np.flatnonzero(episodes[i])}
+                for i in np.flatnonzero(episodes.any(axis=1))}
+
+    def weighted_score(self, kind, weights):
+        # (sum of weights, count) over every (student, label) of a kind that was seen
+        names, cols = self.columns(kind)
+        seen = self.episodes[:len(self.students), cols] > 0
+        w = np.array([weights.get(name, 0) for name in names], np.float64)
+        counts = seen.sum(axis=0)
+        return float(counts @ w), int(counts.sum())
+
+    def save(self, path, **meta):
+        # Atomic checkpoint: a crash mid-write leaves the previous one. meta (JSON) identifies the session.
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        n, m = len(self.students), len(self.labels)
+        tmp = f"{path}.tmp"
+        with open(tmp, 'wb') as f:
+            np.savez(f, saved_at=np.float64(time.time()), meta=np.array(json.dumps(meta)),
+                     students=np.array([str(s) for s in self.students]),
+                     kinds=np.array([k for k, _ in self.labels]), labels=np.array([l for _, l in self.labels]),
+                     **{field: getattr(self, field)[:n, :m] for field in FIELDS})
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        from bson import ObjectId
+        with np.load(path) as npz:
+            durations = cls(max(1, len(npz['students'])), max(1, len(npz['labels'])))
+            for s in npz['students']:
+                student_id = ObjectId(s) if ObjectId.is_valid(s) else s
+                durations.student_index[student_id] = len(durations.students)
+                durations.students.append(student_id)
+            for kind, label in zip(npz['kinds'].tolist(), npz['labels'].tolist()):
+                durations.label_index[(kind, label)] = len(durations.labels)
+                durations.labels.append((kind, label))
+            n, m = len(durations.students), len(durations.labels)
+            for field in FIELDS:
+                getattr(durations, field)[:n, :m] = npz[field]
+            durations.meta, durations.saved_at, durations.path = json.loads(str(npz['meta'])), float(npz['saved_at']), path
+        return durations
+
+
+def checkpoint_path(directory, record_id):
+    return os.path.join(directory, f"{record_id}{CHECKPOINT_SUFFIX}")
+
+
+def load_checkpoints(directory):
+    # Every readable checkpoint left in directory, oldest first
+    checkpoints = []
+    for name in sorted(os.listdir(directory)) if os.path.isdir(directory) else []:
+        if name.endswith(CHECKPOINT_SUFFIX):
+            try:
+                checkpoints.append(LabelDurations.load(os.path.join(directory, name)))
+            except Exception as e:
+                print(f"Skipping unreadable checkpoint {name}: {e}")
+    return sorted(checkpoints, key=lambda durations: durations.saved_at)
+
+
+def resumable(checkpoints, max_age, now=None, **meta):
+    # The newest checkpoint saved less than max_age seconds ago whose meta matches, or None
+    now = now or time.time()
+    matching = [durations for durations in checkpoints
+                if now - durations.saved_at <= max_age and all(durations.meta.get(k) == v for k, v in meta.items())]
+    return matching[-1] if matching else None
@@ -4,6 +4,7 @@ from PySide6.QtGui import QFont
 from PySide6.QtCore import Qt
 import subprocess
 from conn import get_db  # Make sure this import works with your project structure
+from db_indexes import ensure_indexes
 
 class LoginWindow(QWidget):
     def __init__(self):
@@ -115,6 +116,8 @@ class LoginWindow(QWidget):
         subprocess.Popen(["python", "F:/FYP/scripts/forgot_password.py"])
 
 if __name__ == '__main__':
+    # Indexes the pages rely on are created once per start of the application (or with db_indexes.py)
+    ensure_indexes(get_db())
     app = QApplication(sys.argv)
     ex = LoginWindow()
     ex.show()
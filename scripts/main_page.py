@@ -4,6 +4,7 @@ from PySide6.QtGui import QFont
 from PySide6.QtCore import Qt
 import subprocess
 from conn import get_db
+from intake_cache import intakes
 
 class MainWindow(QWidget):
     def __init__(self, username):
@@ -101,8 +102,7 @@ class MainWindow(QWidget):
             self.class_dropdown.addItem("No class available")
         else:
             for class_ in classes:
-                intake_info = self.intake_collection.find_one({"_id": class_["intake"]})
-                intake_name = intake_info["intake"] if intake_info else "Unknown"
+                intake_name = intakes.name(self.db, class_["intake"])
                 class_option = f"{class_['name']} - {class_['type']} on {class_['weekday']} ({intake_name})"
                 self.class_dropdown.addItem(class_option)
 
@@ -118,8 +118,7 @@ class MainWindow(QWidget):
         class_selected = self.class_dropdown.currentText().split(" - ")[0]
         class_info = self.collection.find_one({"name": class_selected, "createdBy": self.username})
         if class_info:
-            intake_info = self.intake_collection.find_one({"_id": class_info["intake"]})
-            intake_name = intake_info["intake"] if intake_info else "Unknown"
+            intake_name = intakes.name(self.db, class_info["intake"])
             details = (
                 f"Class Type & Date: {class_info['type']} on {class_info['weekday']}\n"
                 f"Class Time: {class_info['time']}\n"
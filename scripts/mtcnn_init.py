@@ -1,5 +1,22 @@
-from facenet_pytorch import InceptionResnetV1, MTCNN
+import threading
 
-# Initialize MTCNN and InceptionResnetV1
-mtcnn = MTCNN(keep_all=True)
-resnet = InceptionResnetV1(pretrained='vggface2').eval()
+# MTCNN and InceptionResnetV1 are built on first access (mtcnn_init.mtcnn / mtcnn_init.resnet), so
+# processes that get their embeddings from the embedding service never load them
+_lock = threading.Lock()
+
+
+def _build(name):
+    if name == 'mtcnn':
+        from facenet_pytorch import MTCNN
+        return MTCNN(keep_all=True)
+    from embedder import load_embedder  # fp32 or the quantized variant, see embedder.py
+    return load_embedder()
+
+
+def __getattr__(name):
+    if name not in ('mtcnn', 'resnet'):
+        raise AttributeError(f"module {__name__} has no attribute {name}")
+    with _lock:
+        if name not in globals():
+            globals()[name] = _build(name)
+    return globals()[name]
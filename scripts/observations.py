@@ -0,0 +1,39 @@
+# Identified detections of one tick across every camera stream, and how they are combined
+
+
+class Observation:
+    # One identified detection: kind is 'face', 'emotion' or 'behavior', geometry is the box or landmarks to draw
+    __slots__ = ('kind', 'student_id', 'student_name', 'label', 'distance', 'stream', 'geometry', 'confidence')
+
+    def __init__(self, kind, student_id, student_name, label, distance, stream, geometry, confidence=1.0):
+        self.kind = kind
+        self.student_id = student_id
+        self.student_name = student_name
+        self.label = label
+        self.distance = distance
+        self.stream = stream
+        self.geometry = geometry
+        self.confidence = confidence
+
+
+def dedupe_observations(observations):
+    # Overlapping cameras can see the same student showing the same label; keep the view whose face matched
+    # the gallery best. Different labels of one student (two behaviors in one frame) are all kept.
+    best = {}
+    for obs in observations:
+        key = (obs.kind, obs.student_id, obs.label)
+        if key not in best or obs.distance < best[key].distance:
+            best[key] = obs
+    return list(best.values())
+
+
+def best_face(stream_faces, score):
+    # Identified face with the highest positive score against a region, or None
+    best, best_score = None, 0
+    for face in stream_faces:
+        if face[1] is None:
+            continue
+        face_score = score(face[0])
+        if face_score > best_score:
+            best, best_score = face, face_score
+    return best
@@ -0,0 +1,115 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+
+# Small derivatives of a student's profile photo, stored in GridFS next to the full-resolution original
+# and referenced from the student document:
+#   profile_thumbnail_id  JPEG whose longer side is THUMBNAIL_SIZE, for lists and previews
+#   profile_face_id       PNG of the face box resized to FACE_SIZE x FACE_SIZE, exactly the input the
+#                         embedder sees (face_recognition.face_tensor), so galleries are rebuilt from it
+#                         without decoding the photo or running MTCNN
+# Photos enrolled before the derivatives existed get them the first time a gallery rebuild encodes them.
+
+THUMBNAIL_SIZE = 96
+FACE_SIZE = 160
+DERIVATIVES = ("profile_thumbnail_id", "profile_face_id")
+
+
+def thumbnail_bytes(image_bgr, size=THUMBNAIL_SIZE):
+    h, w = image_bgr.shape[:2]
+    scale = min(1.0, size / max(h, w))
+    small = cv2.resize(image_bgr, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+    return cv2.imencode('.jpg', small, [cv2.IMWRITE_JPEG_QUALITY, 85])[1].tobytes()
+
+
+def face_crop(image_rgb, box, size=FACE_SIZE):
+    # The face box cut from the full-resolution RGB image and resized like face_tensor does
+    crop = image_rgb[max(0, int(box[1])):int(box[3]), max(0, int(box[0])):int(box[2])]
+    return cv2.resize(crop, (size, size)) if crop.size else None
+
+
+def face_bytes(face_rgb):
+    return cv2.imencode('.png', cv2.cvtColor(face_rgb, cv2.COLOR_RGB2BGR))[1].tobytes()
+
+
+def decode_face(data):
+    return cv2.cvtColor(cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+
+
+def store_derivatives(db, fs, student_id, image_rgb, box):
+    # Stores the thumbnail and (if a face box is known) the face crop of a profile photo, replacing the
+    # student's previous ones. Returns the new {field: GridFS id}.
+    delete_derivatives(db, fs, student_id)
+    ids = {"profile_thumbnail_id": fs.put(thumbnail_bytes(cv2.cvtColor(image_rgb, cv2.COLOR_RGB2BGR)),
+                                          filename=f"{student_id}_profile_thumbnail")}
+    face = face_crop(image_rgb, box) if box is not None else None
+    if face is not None:
+        ids["profile_face_id"] = fs.put(face_bytes(face), filename=f"{student_id}_profile_face")
+    db["students"].update_one({"_id": student_id}, {"$set": ids})
+    return ids
+
+
+def delete_derivatives(db, fs, student_id, student=None):
+    student = student or db["students"].find_one({"_id": student_id}, dict.fromkeys(DERIVATIVES, 1)) or {}
+    for field in DERIVATIVES:
+        if student.get(field):
+            fs.delete(student[field])
+    db["students"].update_one({"_id": student_id}, {"$unset": dict.fromkeys(DERIVATIVES, "")})
+
+
+def load_face_crops(fs, face_ids):
+    # {face id: RGB crop} for the stored face crops that can be read
+    crops = {}
+    for face_id in face_ids:
+        try:
+            crops[face_id] = decode_face(fs.get(face_id).read())
+        except Exception as e:
+            print(f"Failed to load face crop {face_id}: {e}")
+    return crops
+
+
+class ThumbnailLoader:
+    # Reads thumbnails from GridFS on a small thread pool and keeps the most recently used ones in memory.
+    # get() returns a cached image at once, or None after queueing the read; on_loaded(image_id, image)
+    # is then called from a pool thread, so UI code should hand it to the UI thread (e.g. with a Signal).
+    def __init__(self, fs, decode=bytes, on_loaded=None, max_items=500, workers=4):
+        self.fs = fs
+        self.decode = decode
+        self.on_loaded = on_loaded
+        self.max_items = max_items
+        self.items = OrderedDict()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(workers)
+
+    def get(self, image_id):
+        if image_id is None:
+            return None
+        with self.lock:
+            if image_id in self.items:
+                self.items.move_to_end(image_id)
+                return self.items[image_id]
+            if image_id not in self.pending:
+                self.pending.add(image_id)
+                self.pool.submit(self.load, image_id)
+        return None
+
+    def load(self, image_id):
+        try:
+            image = self.decode(self.fs.get(image_id).read())
+        except Exception as e:
+            print(f"Failed to load thumbnail {image_id}: {e}")
+            image = None
+        with self.lock:
+            self.pending.discard(image_id)
+            if image is not None:
+                self.items[image_id] = image
+                if len(self.items) > self.max_items:
+                    self.items.popitem(last=False)
+        if image is not None and self.on_loaded:
+            self.on_loaded(image_id, image)
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,200 @@
+import json
+import queue
+import struct
+import threading
+import time
+import cv2
+import numpy as np
+from tracing import tracer
+
+# Session recordings: a header followed by chunks of encoded frames with their capture timestamps.
+#   file  := MAGIC, uint32 header length, JSON header, chunk*
+#   chunk := CHUNK_MAGIC, uint32 frame count, uint64 payload length, (float64 timestamp, uint32 size, bytes)*
+# A chunk is only written once it is complete, so a crashed session loses at most the last chunk.
+
+MAGIC = b'FYPREC01'
+CHUNK_MAGIC = b'CHNK'
+CHUNK_HEADER = struct.Struct('<4sIQ')
+FRAME_HEADER = struct.Struct('<dI')
+CODECS = {
+    'png': ('.png', [cv2.IMWRITE_PNG_COMPRESSION, 1]),  # lossless
+    'jpg': ('.jpg', [cv2.IMWRITE_JPEG_QUALITY, 95]),  # high quality, much smaller
+}
+
+
+class FrameRecorder:
+    # Encodes and writes frames on a background thread so the frame loop only pays for a copy
+    def __init__(self, path, codec='jpg', chunk_frames=30, queue_size=64):
+        if codec not in CODECS:
+            raise ValueError(f"Unknown codec {codec}, expected one of {list(CODECS)}")
+        self.path = path
+        self.codec = codec
+        self.chunk_frames = chunk_frames
+        self.frames_written = 0
+        self.file = open(path, 'wb')
+        header = json.dumps({"codec": codec, "chunk_frames": chunk_frames, "created": time.time()}).encode()
+        self.file.write(MAGIC + struct.pack('<I', len(header)) + header)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self._run, name='FrameRecorder', daemon=True)
+        self.thread.start()
+
+    def write(self, frame, timestamp=None):
+        start = time.time()
+        self.queue.put((timestamp if timestamp is not None else start, frame.copy()))
+        tracer.wait('record_queue_put', start)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+        print(f"Recorded {self.frames_written} frames to {self.path}")
+
+    def _run(self):
+        ext, params = CODECS[self.codec]
+        chunk = []
+        while True:
+            start = time.time()
+            item = self.queue.get()
+            tracer.wait('record_queue_get', start)
+            if item is None:
+                break
+            timestamp, frame = item
+            with tracer.span('record_encode', 'record'):
+                ok, buffer = cv2.imencode(ext, frame, params)
+            if not ok:
+                print("Failed to encode frame for recording")
+                continue
+            chunk.append((timestamp, buffer.tobytes()))
+            if len(chunk) >= self.chunk_frames:
+                self._write_chunk(chunk)
+                chunk = []
+        if chunk:
+            self._write_chunk(chunk)
+
+    def _write_chunk(self, chunk):
+        with tracer.span('record_write', 'record', frames=len(chunk)):
+            payload = b''.join(FRAME_HEADER.pack(timestamp, len(data)) + data for timestamp, data in chunk)
+            self.file.write(CHUNK_HEADER.pack(CHUNK_MAGIC, len(chunk), len(payload)) + payload)
+            self.file.flush()
+        self.frames_written += len(chunk)
+
+
+def is_recording(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except (OSError, TypeError):
+        return False
+
+
+def read_recording(path):
+    # Yields (timestamp, encoded bytes) for every frame of every complete chunk
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a session recording")
+        header_len, = struct.unpack('<I', f.read(4))
+        json.loads(f.read(header_len))
+        while True:
+            raw = f.read(CHUNK_HEADER.size)
+            if len(raw) < CHUNK_HEADER.size:
+                return
+            magic, count, size = CHUNK_HEADER.unpack(raw)
+            payload = f.read(size)
+            if magic != CHUNK_MAGIC or len(payload) < size:
+                print(f"Ignoring truncated chunk at the end of {path}")
+                return
+            offset = 0
+            for _ in range(count):
+                timestamp, length = FRAME_HEADER.unpack_from(payload, offset)
+                offset += FRAME_HEADER.size
+                yield timestamp, payload[offset:offset + length]
+                offset += length
+
+
+class ReplayCapture:
+    # Drop-in replacement for cv2.VideoCapture that plays back a FrameRecorder file.
+    # speed='max' returns every frame as fast as the pipeline asks for them (deterministic);
+    # speed='original' paces frames by their capture timestamps and, like a live camera,
+    # skips frames the pipeline was too slow to pick up.
+    def __init__(self, path, speed='max', prefetch=8):
+        if speed not in ('max', 'original'):
+            raise ValueError("speed must be 'max' or 'original'")
+        self.path = path
+        self.speed = speed
+        self.frames = queue.Queue(maxsize=prefetch)
+        self.opened = True
+        self.position = 0
+        self.shape = None
+        self.start_wall = None
+        self.start_ts = None
+        self.thread = threading.Thread(target=self._decode, name='ReplayDecoder', daemon=True)
+        self.thread.start()
+
+    def _decode(self):
+        try:
+            for timestamp, data in read_recording(self.path):
+                if not self.opened:
+                    return
+                frame = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+                self.frames.put((timestamp, frame))
+        except Exception as e:
+            print(f"Replay of {self.path} failed: {e}")
+        self.frames.put(None)
+
+    def _next(self):
+        start = time.time()
+        item = self.frames.get()
+        tracer.wait('replay_queue_get', start)
+        if item is None:
+            self.opened = False
+        return item
+
+    def isOpened(self):
+        return self.opened
+
+    def read(self):
+        if not self.opened:
+            return False, None
+        item = self._next()
+        if item is None:
+            return False, None
+        timestamp, frame = item
+        if self.speed == 'original':
+            now = time.time()
+            if self.start_wall is None:
+                self.start_wall, self.start_ts = now, timestamp
+            due = self.start_wall + (timestamp - self.start_ts)
+            if due > now:
+                time.sleep(due - now)
+            else:
+                # Behind schedule: move on to the newest frame that is already due
+                while not self.frames.empty():
+                    peek = self.frames.queue[0]
+                    if peek is None or self.start_wall + (peek[0] - self.start_ts) > time.time():
+                        break
+                    timestamp, frame = self._next()
+                    self.position += 1
+        self.position += 1
+        self.shape = frame.shape
+        return True, frame
+
+    def set(self, prop, value):
+        return False  # a recording's resolution is fixed
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return self.position
+        if self.shape is not None and prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.shape[1]
+        if self.shape is not None and prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.shape[0]
+        return 0
+
+    def release(self):
+        self.opened = False
+        # Unblock the decoder if it is waiting on a full queue
+        while not self.frames.empty():
+            try:
+                self.frames.get_nowait()
+            except queue.Empty:
+                break
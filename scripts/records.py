@@ -2,10 +2,11 @@ import sys
 import requests
 import threading
 import time
+from collections import OrderedDict
 from PySide6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, 
-                               QLabel, QLineEdit, QPushButton, QComboBox, QTableWidget, 
-                               QTableWidgetItem, QHeaderView, QMessageBox, QTextEdit)
-from PySide6.QtCore import Qt, QTimer, QMetaObject, Q_ARG
+                               QLabel, QLineEdit, QPushButton, QComboBox, QTableView, 
+                               QHeaderView, QMessageBox, QTextEdit, QAbstractItemView)
+from PySide6.QtCore import Qt, QTimer, QMetaObject, Q_ARG, QAbstractTableModel, QModelIndex
 from pymongo import MongoClient
 from bson import ObjectId
 from conn import get_db
@@ -15,44 +16,37 @@ from api import get_gemini_suggestions  # Import the Gemini API function
 # Connect to MongoDB
 db = get_db()
 
-def fetch_record_details(username):
+# Number of records fetched per page of the records table
+PAGE_SIZE = 50
+
+def fetch_record_page(username, after=None, limit=PAGE_SIZE):
+    # One page of the records list, newest first, with only the fields the table shows. Paging continues
+    # after the (date, _id) of the last row instead of skipping, so later pages cost the same as the first.
+    query = {'created_by': username}
+    if after is not None:
+        query['$or'] = [{'date': {'$lt': after['date']}}, {'date': after['date'], '_id': {'$lt': after['_id']}}]
+    projection = {'classID': 1, 'date': 1, 'created_by': 1, 'overall_performance': 1}
+    records = list(db.records.find(query, projection).sort([('date', -1), ('_id', -1)]).limit(limit))
+
+    # Class names for the whole page in one query
+    class_ids = {ObjectId(record['classID']) for record in records if ObjectId.is_valid(record.get('classID'))}
+    classes = {cls['_id']: cls for cls in db.classes.find({'_id': {'$in': list(class_ids)}}, {'name': 1, 'type': 1})}
+    creator = db.users.find_one({'username': username}, {'username': 1})
+    for record in records:
+        cls = classes.get(ObjectId(record['classID'])) if ObjectId.is_valid(record.get('classID')) else None
+        record['class_name'] = cls.get('name', 'N/A') if cls else 'N/A'
+        record['class_type'] = cls.get('type', 'N/A') if cls else 'N/A'
+        record['creator_name'] = creator['username'] if creator else 'N/A'
+    return records
+
+def fetch_record_details(record_id):
+    # Behaviors and emotions of one record, with the students they belong to. The class and creator are
+    # already on the table row (fetch_record_page), so every lookup here is an equality match on an
+    # indexed field: recordID in the history collections and _id in students (see db_indexes.py).
     pipeline = [
         {
             '$match': {
-                'created_by': username  # Filter records by the username
-            }
-        },
-        {
-            '$addFields': {  # Ensure classID is treated as ObjectId
-                'classID': { '$toObjectId': '$classID' }
-            }
-        },
-        {
-            '$lookup': {
-                'from': 'classes',
-                'localField': 'classID',
-                'foreignField': '_id',
-                'as': 'class_info'
-            }
-        },
-        {
-            '$unwind': {
-                'path': '$class_info',
-                'preserveNullAndEmptyArrays': True
-            }
-        },
-        {
-            '$lookup': {
-                'from': 'users',
-                'localField': 'created_by',
-                'foreignField': 'username',
-                'as': 'creator_info'
-            }
-        },
-        {
-            '$unwind': {
-                'path': '$creator_info',
-                'preserveNullAndEmptyArrays': True
+                '_id': record_id
             }
         },
         {
@@ -72,52 +66,23 @@ def fetch_record_details(username):
             }
         },
         {
-            '$lookup': {
+            '$lookup': {  # localField over an array matches each studentID against students._id
                 'from': 'students',
-                'let': {
-                    'behavior_student_ids': '$behavior_info.studentID',
-                    'emotion_student_ids': '$emotion_info.studentID'
-                },
-                'pipeline': [
-                    {
-                        '$match': {
-                            '$expr': {
-                                '$or': [
-                                    { '$in': ['$_id', '$$behavior_student_ids'] },
-                                    { '$in': ['$_id', '$$emotion_student_ids'] }
-                                ]
-                            }
-                        }
-                    }
-                ],
-                'as': 'students'
+                'localField': 'behavior_info.studentID',
+                'foreignField': '_id',
+                'as': 'behavior_students'
             }
         },
         {
-            '$addFields': {
-                'behavior_students': {
-                    '$filter': {
-                        'input': '$students',
-                        'as': 'student',
-                        'cond': { '$in': ['$$student._id', '$behavior_info.studentID'] }
-                    }
-                },
-                'emotion_students': {
-                    '$filter': {
-                        'input': '$students',
-                        'as': 'student',
-                        'cond': { '$in': ['$$student._id', '$emotion_info.studentID'] }
-                    }
-                }
+            '$lookup': {
+                'from': 'students',
+                'localField': 'emotion_info.studentID',
+                'foreignField': '_id',
+                'as': 'emotion_students'
             }
         },
         {
             '$project': {
-                'class_name': {'$ifNull': ['$class_info.name', 'N/A']},
-                'class_type': {'$ifNull': ['$class_info.type', 'N/A']},
-                'date': 1,
-                'creator_name': {'$ifNull': ['$creator_info.username', 'N/A']},
-                'overall_performance': 1,
                 'behaviors': {
                     '$map': {
                         'input': '$behavior_info',
@@ -164,8 +129,90 @@ def fetch_record_details(username):
         }
     ]
 
-    results = db.records.aggregate(pipeline)
-    return list(results)
+    results = list(db.records.aggregate(pipeline))
+    return results[0] if results else None
+
+class RecordsTableModel(QAbstractTableModel):
+    # Pages through the user's records as the view scrolls (Qt calls fetchMore near the bottom)
+    headers = ["Class", "Date", "Created By", "Overall Performance"]
+
+    def __init__(self, username, parent=None):
+        super().__init__(parent)
+        self.username = username
+        self.records = []
+        self.exhausted = False
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.records)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.headers[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role != Qt.DisplayRole:
+            return None
+        record = self.records[index.row()]
+        column = index.column()
+        if column == 0:
+            return f"{record.get('class_name', 'N/A')} ({record.get('class_type', 'N/A')})"
+        if column == 1:
+            return str(record.get('date', 'N/A'))
+        if column == 2:
+            return str(record.get('creator_name', 'N/A'))
+        return str(record.get('overall_performance', 'N/A'))
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and not self.exhausted
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid() or self.exhausted:
+            return
+        page = fetch_record_page(self.username, self.records[-1] if self.records else None)
+        self.exhausted = len(page) < PAGE_SIZE
+        if page:
+            self.beginInsertRows(QModelIndex(), len(self.records), len(self.records) + len(page) - 1)
+            self.records.extend(page)
+            self.endInsertRows()
+
+    def reload(self):
+        self.beginResetModel()
+        self.records = []
+        self.exhausted = False
+        self.endResetModel()
+        self.fetchMore()
+
+    def record(self, row):
+        return self.records[row]
+
+    def removeRecord(self, row):
+        self.beginRemoveRows(QModelIndex(), row, row)
+        del self.records[row]
+        self.endRemoveRows()
+
+class DetailsCache:
+    # Least-recently-used cache of record details, keyed by record _id
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+
+    def get(self, record_id):
+        if record_id not in self.items:
+            details = fetch_record_details(record_id)
+            if details is None:
+                return None
+            self.items[record_id] = details
+            if len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+        self.items.move_to_end(record_id)
+        return self.items[record_id]
+
+    def discard(self, record_id):
+        self.items.pop(record_id, None)
 
 class ModernRecordDetailsApp(QMainWindow):
     def __init__(self, username):
@@ -189,7 +236,7 @@ class ModernRecordDetailsApp(QMainWindow):
                 border-radius: 3px; 
             }
             QPushButton:hover { background-color: #45a049; }
-            QTableWidget { 
+            QTableView { 
                 border: 1px solid #ddd;
                 gridline-color: #ddd;
             }
@@ -210,9 +257,12 @@ class ModernRecordDetailsApp(QMainWindow):
 
     def setup_ui(self):
         # Table
-        self.table = QTableWidget()
-        self.table.setColumnCount(4)
-        self.table.setHorizontalHeaderLabels(["Class", "Date", "Created By", "Overall Performance"])
+        self.model = RecordsTableModel(self.username, self)
+        self.details_cache = DetailsCache()
+        self.table = QTableView()
+        self.table.setModel(self.model)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.setSelectionMode(QAbstractItemView.SingleSelection)
         self.table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
         self.layout.addWidget(self.table)
 
@@ -245,7 +295,7 @@ class ModernRecordDetailsApp(QMainWindow):
         self.layout.addLayout(buttons_layout)
 
         # Connect signals
-        self.table.itemSelectionChanged.connect(self.show_details)
+        self.table.selectionModel().selectionChanged.connect(self.show_details)
 
         # Animation
         self.timer = QTimer()
@@ -256,31 +306,23 @@ class ModernRecordDetailsApp(QMainWindow):
         self.layout.addWidget(self.loading_text)
 
     def load_data(self):
-        self.table.setRowCount(0)
-        self.records = fetch_record_details(self.username)
-
-        for row, record in enumerate(self.records):
-            self.table.insertRow(row)
-
-            class_name = record.get('class_name', 'N/A')
-            class_type = record.get('class_type', 'N/A')
-            date = record.get('date', 'N/A')
-            creator_name = record.get('creator_name', 'N/A')
-            overall_performance = record.get('overall_performance', 'N/A')
-
-            self.table.setItem(row, 0, QTableWidgetItem(f"{class_name} ({class_type})"))
-            self.table.setItem(row, 1, QTableWidgetItem(str(date)))
-            self.table.setItem(row, 2, QTableWidgetItem(str(creator_name)))
-            self.table.setItem(row, 3, QTableWidgetItem(str(overall_performance)))
+        self.model.reload()
+
+    def selected_record(self):
+        rows = self.table.selectionModel().selectedRows()
+        if not rows:
+            return None, None
+        row = rows[0].row()
+        record = self.model.record(row)
+        # Behaviors and emotions are only aggregated for the selected record
+        details = self.details_cache.get(record['_id']) or {}
+        return row, {**record, **details}
 
     def show_details(self):
-        selected_items = self.table.selectedItems()
-        if not selected_items:
+        row, record = self.selected_record()
+        if record is None:
             return
 
-        row = selected_items[0].row()
-        record = self.records[row]
-
         class_name = record.get('class_name', 'N/A')
         class_type = record.get('class_type', 'N/A')
         date = record.get('date', 'N/A')
@@ -295,7 +337,7 @@ class ModernRecordDetailsApp(QMainWindow):
         
         behaviors = []
         for behavior in record.get('behaviors', []):
-            student_name = behavior.get('student', {}).get('name', 'Unknown')
+            student_name = (behavior.get('student') or {}).get('name', 'Unknown')
             behavior_list = behavior.get('behavior', [])
             behaviors.append({'student': student_name, 'behavior': behavior_list})
             details += f"  - {student_name} ({behavior_list})\n"
@@ -303,7 +345,7 @@ class ModernRecordDetailsApp(QMainWindow):
         details += "\nStudents and their emotions:\n"
         emotions = []
         for emotion in record.get('emotions', []):
-            student_name = emotion.get('student', {}).get('name', 'Unknown')
+            student_name = (emotion.get('student') or {}).get('name', 'Unknown')
             emotion_list = emotion.get('emotions', [])
             emotions.append({'student': student_name, 'emotions': emotion_list})
             details += f"  - {student_name} ({emotion_list})\n"
@@ -311,23 +353,20 @@ class ModernRecordDetailsApp(QMainWindow):
         self.details_text.setPlainText(details)
 
     def generate_suggestions(self):
-        selected_items = self.table.selectedItems()
-        if not selected_items:
+        row, record = self.selected_record()
+        if record is None:
             QMessageBox.warning(self, "Generate Suggestions", "No record selected")
             return
 
-        row = selected_items[0].row()
-        record = self.records[row]
-
         behaviors = []
         for behavior in record.get('behaviors', []):
-            student_name = behavior.get('student', {}).get('name', 'Unknown')
+            student_name = (behavior.get('student') or {}).get('name', 'Unknown')
             behavior_list = behavior.get('behavior', [])
             behaviors.append({'student': student_name, 'behavior': behavior_list})
         
         emotions = []
         for emotion in record.get('emotions', []):
-            student_name = emotion.get('student', {}).get('name', 'Unknown')
+            student_name = (emotion.get('student') or {}).get('name', 'Unknown')
             emotion_list = emotion.get('emotions', [])
             emotions.append({'student': student_name, 'emotions': emotion_list})
 
@@ -359,19 +398,20 @@ class ModernRecordDetailsApp(QMainWindow):
         self.loading_animation_index += 1
 
     def delete_record(self):
-        selected_items = self.table.selectedItems()
-        if not selected_items:
+        rows = self.table.selectionModel().selectedRows()
+        if not rows:
             QMessageBox.warning(self, "Delete Record", "No record selected")
             return
 
-        row = selected_items[0].row()
-        record = self.records[row]
+        row = rows[0].row()
+        record = self.model.record(row)
 
         confirm = QMessageBox.question(self, "Delete Record", "Are you sure you want to delete this record?",
                                        QMessageBox.Yes | QMessageBox.No)
         if confirm == QMessageBox.Yes:
             db.records.delete_one({"_id": record['_id']})
-            self.table.removeRow(row)
+            self.details_cache.discard(record['_id'])
+            self.model.removeRecord(row)
             self.details_text.clear()
             QMessageBox.information(self, "Delete Record", "Record deleted successfully")
 
@@ -0,0 +1,69 @@
+import math
+import cv2
+import numpy as np
+
+# Per-detector input scales. Frames stay at capture resolution; each detector gets a resized copy and
+# every box it returns is mapped back to full-frame coordinates with remap_boxes() before it is used,
+# so face crops and overlays always come from the full-resolution frame.
+
+# Typical face width, used to turn a seat distance into a face size in pixels
+FACE_WIDTH_M = 0.15
+# MTCNN's P-Net cannot find faces smaller than its 12 px window
+MTCNN_MIN_FACE = 12
+
+
+class InputScales:
+    def __init__(self, yolo_size=640, mtcnn_scale=1.0, mesh_scale=1.0, min_face_px=20):
+        self.yolo_size = yolo_size  # long side of the image YOLO sees
+        self.mtcnn_scale = mtcnn_scale  # resize factor for MTCNN
+        self.mesh_scale = mesh_scale  # resize factor for the emotion stage's FaceMesh
+        self.min_face_px = min_face_px  # smallest face to find, in full-resolution pixels
+
+    def mtcnn_min_face_size(self):
+        # The minimum face size MTCNN should search for at its own input scale
+        return max(MTCNN_MIN_FACE, int(self.min_face_px * self.mtcnn_scale))
+
+
+# Process-wide scales, configured once at startup
+scales = InputScales()
+
+
+def face_size_at_distance(distance_m, frame_width, hfov_deg=70):
+    # Expected face width in pixels for a student sitting distance_m from the camera
+    focal_px = (frame_width / 2) / math.tan(math.radians(hfov_deg) / 2)
+    return focal_px * FACE_WIDTH_M / distance_m
+
+
+def resize(image, scale):
+    if scale == 1:
+        return image
+    h, w = image.shape[:2]
+    return cv2.resize(image, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+
+
+def fit_scale(image, long_side):
+    # Scale that brings the image's long side down to long_side (never upscales)
+    return min(1.0, long_side / max(image.shape[:2]))
+
+
+def remap_boxes(boxes, scale):
+    # Map xyxy boxes (or xy points) found on a resized image back to full-frame coordinates
+    if boxes is None or scale == 1:
+        return boxes
+    return np.asarray(boxes, dtype=np.float32) / scale
+
+
+def box_iou(a, b):
+    ix = max(0, min(a[2], b[2]) - max(a[0], b[0]))
+    iy = max(0, min(a[3], b[3]) - max(a[1], b[1]))
+    inter = ix * iy
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0
+
+
+def box_inside(box, region):
+    # Fraction of the box that lies inside the region
+    ix = max(0, min(box[2], region[2]) - max(box[0], region[0]))
+    iy = max(0, min(box[3], region[3]) - max(box[1], region[1]))
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    return ix * iy / area if area > 0 else 0
@@ -0,0 +1,177 @@
+import io
+import os
+import json
+import time
+import argparse
+from datetime import datetime
+import numpy as np
+from pymongo import ASCENDING
+
+# Time-stamped detections of a session, kept as columns instead of documents:
+#   t           uint32   second of the session the label was seen in (seconds since start)
+#   student     uint16   index into the session's student table (ObjectIds)
+#   label       uint8    index into the session's label table ((kind, label) pairs, kind 'emotion'/'behavior')
+#   confidence  float16  highest model confidence for that label in that second
+# A student showing a label is recorded at most once per second, so a session of 40 students costs a few
+# MB at most. At the end of a session the columns are written to an NPZ file next to the journal and a
+# 'session_events' journal event ships it to GridFS; the session_events collection holds one small
+# document per session (record, class, start, file id) so a semester is scanned by date with one indexed
+# query and one blob read per session.
+#   python session_events.py --since 2026-01-05 [--until ...] [--class-id ...]   label seconds per student
+
+COLLECTION = 'session_events'
+EVENTS_DIR = 'journal/sessions'
+COLUMNS = (('t', np.uint32), ('student', np.uint16), ('label', np.uint8), ('confidence', np.float16))
+
+
+class SessionEvents:
+    def __init__(self, start=None, capacity=4096):
+        self.start = start or time.time()
+        self.columns = {name: np.empty(capacity, dtype) for name, dtype in COLUMNS}
+        self.size = 0
+        self.students, self.student_index = [], {}
+        self.labels, self.label_index = [], {}
+        self.last = {}  # (student, label) -> (second, row) of its latest event
+
+    def __len__(self):
+        return self.size
+
+    def add(self, t, student_id, kind, label, confidence=1.0):
+        # O(1) amortized: a label seen again in the same second only raises that row's confidence
+        second = max(0, int(t - self.start))
+        s = self.student_index.get(student_id)
+        if s is None:
+            s = self.student_index[student_id] = len(self.students)
+            self.students.append(student_id)
+        l = self.label_index.get((kind, label))
+        if l is None:
+            l = self.label_index[(kind, label)] = len(self.labels)
+            self.labels.append((kind, label))
+        last = self.last.get((s, l))
+        if last is not None and last[0] == second:
+            row = last[1]
+            self.columns['confidence'][row] = max(self.columns['confidence'][row], confidence)
+            return
+        if self.size == len(self.columns['t']):
+            for name in self.columns:
+                self.columns[name] = np.resize(self.columns[name], 2 * self.size)
+        row = self.size
+        self.columns['t'][row] = second
+        self.columns['student'][row] = s
+        self.columns['label'][row] = l
+        self.columns['confidence'][row] = confidence
+        self.last[(s, l)] = (second, row)
+        self.size += 1
+
+    def arrays(self):
+        return {name: column[:self.size] for name, column in self.columns.items()}
+
+    def to_bytes(self):
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, start=np.float64(self.start), students=np.array([str(s) for s in self.students]),
+                            kinds=np.array([k for k, _ in self.labels]), labels=np.array([l for _, l in self.labels]),
+                            **self.arrays())
+        return buffer.getvalue()
+
+    def save(self, journal, record_id, class_id, directory=EVENTS_DIR):
+        # Writes the NPZ locally and journals its upload, so it reaches GridFS whenever the database is reachable
+        if not self.size:
+            return None
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{record_id}.npz")
+        with open(path, 'wb') as f:
+            f.write(self.to_bytes())
+        journal.append('session_events', record_id, value=json.dumps({"path": path, "classID": class_id}))
+        return path
+
+
+def load_bytes(data):
+    # (start, students, labels, columns) of a stored session
+    from bson import ObjectId
+    with np.load(io.BytesIO(data)) as npz:
+        students = [ObjectId(s) if ObjectId.is_valid(s) else s for s in npz['students']]
+        labels = list(zip(npz['kinds'].tolist(), npz['labels'].tolist()))
+        return float(npz['start']), students, labels, {name: npz[name] for name, _ in COLUMNS}
+
+
+def ensure_indexes(db):
+    db[COLLECTION].create_index([("record_id", ASCENDING)], unique=True)
+    db[COLLECTION].create_index([("start", ASCENDING), ("class_id", ASCENDING)])
+
+
+def upload(db, fs, record_id, class_id, path):
+    # Stores a session's NPZ in GridFS once and removes the local file; shipping the same journal event
+    # again changes nothing
+    if db[COLLECTION].find_one({"record_id": record_id}, {"_id": 1}):
+        return
+    ensure_indexes(db)
+    with open(path, 'rb') as f:
+        data = f.read()
+    start, students, labels, columns = load_bytes(data)
+    file_id = fs.put(data, filename=f"{record_id}_events.npz")
+    db[COLLECTION].update_one({"record_id": record_id}, {"$setOnInsert": {
+        "class_id": class_id, "start": datetime.fromtimestamp(start), "file_id": file_id,
+        "events": len(columns['t']), "students": len(students), "duration": int(columns['t'].max()) + 1}}, upsert=True)
+    if db[COLLECTION].find_one({"record_id": record_id}, {"file_id": 1})["file_id"] != file_id:
+        fs.delete(file_id)  # another shipper stored it first
+    os.remove(path)
+
+
+def scan(db, fs, since, until=None, class_id=None):
+    # Every event of the sessions started in [since, until), as one set of columns plus 'session' (index into
+    # the returned record ids) and 'time' (float64 epoch seconds). Student and label indices refer to the
+    # returned combined tables.
+    query = {"start": {"$gte": since, **({"$lt": until} if until else {})}}
+    if class_id is not None:
+        query["class_id"] = class_id
+    record_ids, student_index, label_index, parts = [], {}, {}, []
+    for doc in db[COLLECTION].find(query, {"record_id": 1, "file_id": 1}).sort("start", ASCENDING):
+        start, session_students, session_labels, columns = load_bytes(fs.get(doc["file_id"]).read())
+        # Session-local indices are remapped to the combined tables with one lookup array each
+        student_map = np.array([student_index.setdefault(s, len(student_index)) for s in session_students], np.uint32)
+        label_map = np.array([label_index.setdefault(l, len(label_index)) for l in session_labels], np.uint32)
+        parts.append({
+            'session': np.full(len(columns['t']), len(record_ids), np.uint32),
+            'time': start + columns['t'].astype(np.float64),
+            'student': student_map[columns['student']],
+            'label': label_map[columns['label']],
+            'confidence': columns['confidence'],
+        })
+        record_ids.append(doc["record_id"])
+    students = sorted(student_index, key=student_index.get)
+    labels = sorted(label_index, key=label_index.get)
+    if not parts:
+        return record_ids, students, labels, {}
+    return record_ids, students, labels, {name: np.concatenate([p[name] for p in parts]) for name in parts[0]}
+
+
+def label_seconds(columns, students, labels):
+    # (students x labels) seconds each student was seen showing each label
+    counts = np.zeros((len(students), len(labels)), np.int64)
+    if columns:
+        np.add.at(counts, (columns['student'], columns['label']), 1)
+    return counts
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--since', required=True, type=datetime.fromisoformat)
+    parser.add_argument('--until', type=datetime.fromisoformat)
+    parser.add_argument('--class-id', default=None)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    opt = parse_opt()
+    import gridfs
+    from conn import get_db
+    db = get_db()
+    started = time.time()
+    record_ids, students, labels, columns = scan(db, gridfs.GridFS(db), opt.since, opt.until, opt.class_id)
+    counts = label_seconds(columns, students, labels)
+    print(f"{len(record_ids)} sessions, {len(columns.get('time', []))} events, "
+          f"{len(students)} students in {time.time() - started:.2f}s")
+    names = {s["_id"]: s.get("name", "N/A") for s in db["students"].find({"_id": {"$in": students}}, {"name": 1})}
+    for i, student_id in enumerate(students):
+        seen = ', '.join(f"{label} {counts[i, j]}s" for j, (_, label) in enumerate(labels) if counts[i, j])
+        print(f"{names.get(student_id, student_id)}: {seen}")
@@ -0,0 +1,75 @@
+import threading
+import time
+import cv2
+from recording import ReplayCapture, is_recording
+
+
+def open_source(source, replay_speed='max', width=1920, height=1080):
+    # A source is a webcam index, a video file or stream URL, or a session recording
+    if is_recording(source):
+        return ReplayCapture(source, replay_speed)
+    cap = cv2.VideoCapture(int(source) if str(source).isnumeric() else source)
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+    return cap
+
+
+class MultiCapture:
+    # Reads several cameras together. Like yolov5 LoadStreams, each live camera has a thread that keeps
+    # grabbing so read() always returns the latest frame of every stream without waiting on the slowest one.
+    # Recordings are read on demand instead so replays stay frame-exact.
+    def __init__(self, captures):
+        self.captures = list(captures)
+        self.imgs = [None] * len(self.captures)
+        self.threads = [None] * len(self.captures)
+        self.running = True
+        for i, cap in enumerate(self.captures):
+            if isinstance(cap, ReplayCapture) or not cap.isOpened():
+                continue
+            _, self.imgs[i] = cap.read()  # guarantee first frame
+            self.threads[i] = threading.Thread(target=self.update, args=(i, cap), name=f'Camera{i}', daemon=True)
+            self.threads[i].start()
+
+    def __len__(self):
+        return len(self.captures)
+
+    def update(self, i, cap):
+        while self.running and cap.isOpened():
+            success = cap.grab()
+            if success:
+                success, im = cap.retrieve()
+            if success:
+                self.imgs[i] = im
+            else:
+                print(f"Camera {i} unresponsive, retrying")
+                time.sleep(0.1)
+
+    def isOpened(self):
+        return all(cap.isOpened() for cap in self.captures)
+
+    def read(self):
+        frames = []
+        for i, cap in enumerate(self.captures):
+            if self.threads[i] is None:
+                ret, frame = cap.read()
+            else:
+                # Copy, since the overlay is drawn on the frame while the grab thread may hand it out again
+                frame = self.imgs[i]
+                ret = frame is not None
+                if ret:
+                    frame = frame.copy()
+            if not ret:
+                return False, None
+            frames.append(frame)
+        return True, frames
+
+    def set(self, prop, value):
+        return all(cap.set(prop, value) for cap in self.captures)
+
+    def release(self):
+        self.running = False
+        for thread in self.threads:
+            if thread is not None:
+                thread.join(timeout=1)
+        for cap in self.captures:
+            cap.release()
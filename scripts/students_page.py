@@ -1,16 +1,20 @@
 import re
 import subprocess
 import sys
+import time
 import gridfs
 import cv2
-from PySide6.QtWidgets import QApplication, QWidget, QVBoxLayout, QHBoxLayout, QLabel, QLineEdit, QPushButton, QTreeWidget, QTreeWidgetItem, QMessageBox, QScrollArea, QDialog, QFormLayout, QComboBox
-from PySide6.QtGui import QFont
-from PySide6.QtCore import Qt
+from PySide6.QtWidgets import QApplication, QWidget, QVBoxLayout, QHBoxLayout, QLabel, QLineEdit, QPushButton, QTreeView, QMessageBox, QScrollArea, QDialog, QFormLayout, QComboBox
+from PySide6.QtGui import QFont, QImage
+from PySide6.QtCore import Qt, QTimer, QAbstractItemModel, QModelIndex, QObject, QSize, Signal
 from PIL import Image
 from io import BytesIO
 from bson import ObjectId
 from conn import get_db
-from mtcnn_init import mtcnn  # Ensure this is correctly imported
+from intake_cache import intakes
+from db_indexes import STUDENT_NAME_COLLATION
+import profile_images
+from embedding_service import detect_faces  # shared embedding service, or in-process MTCNN
 
 # Connect to MongoDB
 db = get_db()
@@ -19,6 +23,157 @@ intake_collection = db["intake"]
 class_collection = db["classes"]
 fs = gridfs.GridFS(db)
 
+# Students fetched per intake expansion / scroll, and at most this many search matches
+BATCH_SIZE = 200
+SEARCH_LIMIT = 500
+
+def fetch_students(intake_id, after=None, limit=BATCH_SIZE):
+    # One batch of an intake's students by name, continuing after the (name, _id) of the last one. The
+    # query and sort use the case-insensitive collation of the (intake, name, _id) index.
+    query = {"intake": intake_id}
+    if after is not None:
+        query["$or"] = [{"name": {"$gt": after["name"]}}, {"name": after["name"], "_id": {"$gt": after["_id"]}}]
+    cursor = student_collection.find(query, {"name": 1, "TPNumber": 1, "profile_thumbnail_id": 1}).collation(STUDENT_NAME_COLLATION)
+    return list(cursor.sort([("name", 1), ("_id", 1)]).limit(limit).batch_size(limit))
+
+def search_students(intake_ids, text, limit=SEARCH_LIMIT):
+    # Students whose name (case-insensitive) or TP number starts with the text, as two indexed range queries
+    by_name = student_collection.find(
+        {"intake": {"$in": intake_ids}, "name": {"$gte": text, "$lt": text + "\uffff"}},
+        {"name": 1, "TPNumber": 1, "intake": 1, "profile_thumbnail_id": 1}).collation(STUDENT_NAME_COLLATION).limit(limit)
+    by_tp = student_collection.find(
+        {"TPNumber": {"$regex": "^" + re.escape(text.upper())}, "intake": {"$in": intake_ids}},
+        {"name": 1, "TPNumber": 1, "intake": 1, "profile_thumbnail_id": 1}).limit(limit)
+    students = {}
+    for student in list(by_name) + list(by_tp):
+        students.setdefault(student["_id"], student)
+    return sorted(students.values(), key=lambda s: (s.get("name", "").lower(), s["_id"]))[:limit]
+
+class IntakeNode:
+    def __init__(self, row, intake_id, name, students=None):
+        self.row = row
+        self.intake_id = intake_id
+        self.name = name
+        self.students = students or []
+        self.exhausted = students is not None
+
+class ThumbnailSignals(QObject):
+    # Emitted from the thumbnail pool; Qt delivers it on the UI thread
+    loaded = Signal(object)
+
+class StudentTreeModel(QAbstractItemModel):
+    # Intakes at the top level; an intake's students are fetched in batches when it is expanded and as
+    # the view scrolls through it (Qt calls canFetchMore / fetchMore), or all at once for a search
+    headers = ["Name", "TP Number"]
+
+    def __init__(self, username, parent=None):
+        super().__init__(parent)
+        self.username = username
+        self.nodes = []
+        self.search = ""
+        # Thumbnails are read in the background as rows become visible; rows waiting for one are repainted when it arrives
+        self.signals = ThumbnailSignals()
+        self.signals.loaded.connect(self.thumbnail_loaded)
+        self.thumbnails = profile_images.ThumbnailLoader(fs, QImage.fromData, lambda image_id, _: self.signals.loaded.emit(image_id))
+        self.waiting = {}
+
+    def reload(self, search=None):
+        if search is not None:
+            self.search = search.strip()
+        self.beginResetModel()
+        self.waiting = {}
+        user_intakes = list(intake_collection.find({"created_by": self.username}, {"intake": 1}).sort("intake"))
+        if self.search:
+            matches = {}
+            for student in search_students([intake["_id"] for intake in user_intakes], self.search):
+                matches.setdefault(student["intake"], []).append(student)
+            user_intakes = [intake for intake in user_intakes if intake["_id"] in matches]
+            self.nodes = [IntakeNode(row, intake["_id"], intake.get("intake", "N/A"), matches[intake["_id"]])
+                          for row, intake in enumerate(user_intakes)]
+        else:
+            self.nodes = [IntakeNode(row, intake["_id"], intake.get("intake", "N/A"))
+                          for row, intake in enumerate(user_intakes)]
+        self.endResetModel()
+
+    def index(self, row, column, parent=QModelIndex()):
+        if not self.hasIndex(row, column, parent):
+            return QModelIndex()
+        if not parent.isValid():
+            return self.createIndex(row, column)
+        return self.createIndex(row, column, self.nodes[parent.row()])
+
+    def parent(self, index=QModelIndex()):
+        node = index.internalPointer() if index.isValid() else None
+        return self.createIndex(node.row, 0) if node is not None else QModelIndex()
+
+    def rowCount(self, parent=QModelIndex()):
+        if not parent.isValid():
+            return len(self.nodes)
+        if parent.internalPointer() is None:
+            return len(self.nodes[parent.row()].students)
+        return 0
+
+    def columnCount(self, parent=QModelIndex()):
+        return len(self.headers)
+
+    def hasChildren(self, parent=QModelIndex()):
+        if not parent.isValid():
+            return bool(self.nodes)
+        if parent.internalPointer() is None:
+            node = self.nodes[parent.row()]
+            return bool(node.students) or not node.exhausted
+        return False
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return parent.isValid() and parent.internalPointer() is None and not self.nodes[parent.row()].exhausted
+
+    def fetchMore(self, parent=QModelIndex()):
+        if not self.canFetchMore(parent):
+            return
+        node = self.nodes[parent.row()]
+        batch = fetch_students(node.intake_id, node.students[-1] if node.students else None)
+        node.exhausted = len(batch) < BATCH_SIZE
+        if batch:
+            self.beginInsertRows(parent, len(node.students), len(node.students) + len(batch) - 1)
+            node.students.extend(batch)
+            self.endInsertRows()
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        node = index.internalPointer()
+        if node is None:
+            if role == Qt.DisplayRole and index.column() == 0:
+                return self.nodes[index.row()].name
+            if role == Qt.FontRole:
+                font = QFont()
+                font.setPointSize(12)  # Smaller font size for intake items
+                return font
+            return None
+        student = node.students[index.row()]
+        if role == Qt.DisplayRole:
+            return student.get("name", "N/A") if index.column() == 0 else student.get("TPNumber", "N/A")
+        if role == Qt.UserRole:
+            return str(student["_id"])
+        if role == Qt.DecorationRole and index.column() == 0:
+            thumbnail_id = student.get("profile_thumbnail_id")
+            image = self.thumbnails.get(thumbnail_id)
+            if image is None and thumbnail_id:
+                self.waiting.setdefault(thumbnail_id, set()).add((node.row, index.row()))
+            return image
+        return None
+
+    def thumbnail_loaded(self, thumbnail_id):
+        for node_row, row in self.waiting.pop(thumbnail_id, ()):
+            if node_row < len(self.nodes) and row < len(self.nodes[node_row].students):
+                index = self.createIndex(row, 0, self.nodes[node_row])
+                self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.headers[section]
+        return None
+
 class StudentsPage(QWidget):
     def __init__(self, username):
         super().__init__()
@@ -54,7 +209,7 @@ class StudentsPage(QWidget):
             QPushButton:hover {
                 background-color: #2980b9;
             }
-            QTreeWidget {
+            QTreeView {
                 border: 2px solid #ddd;
                 border-radius: 5px;
             }
@@ -72,9 +227,22 @@ class StudentsPage(QWidget):
         title.setFont(QFont('Arial', 24, QFont.Bold))
         scroll_layout.addWidget(title)
 
+        # Search, run on the server once typing pauses
+        self.search_input = QLineEdit()
+        self.search_input.setPlaceholderText("Search by name or TP number")
+        scroll_layout.addWidget(self.search_input)
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(300)
+        self.search_input.textChanged.connect(self.search_timer.start)
+        self.search_timer.timeout.connect(self.load_students)
+
         # Student Tree
-        self.student_tree = QTreeWidget()
-        self.student_tree.setHeaderLabels(["Name", "TP Number"])
+        self.student_model = StudentTreeModel(self.username, self)
+        self.student_tree = QTreeView()
+        self.student_tree.setModel(self.student_model)
+        self.student_tree.setUniformRowHeights(True)
+        self.student_tree.setIconSize(QSize(32, 32))
         scroll_layout.addWidget(self.student_tree)
         self.load_students()
 
@@ -100,42 +268,16 @@ class StudentsPage(QWidget):
         main_layout.addWidget(scroll_area)
 
     def load_students(self):
-        self.student_tree.clear()
-
-        # Find all intakes created by the user
-        user_intakes = list(intake_collection.find({"created_by": self.username}))
-        user_intake_ids = [intake["_id"] for intake in user_intakes]
+        self.student_model.reload(self.search_input.text())
+        if self.student_model.search:
+            self.student_tree.expandAll()
 
-        # Find all students whose intake is in the user's intakes
-        students = student_collection.find({"intake": {"$in": user_intake_ids}})
-        
-        # Group students by intake
-        intake_groups = {}
-        for student in students:
-            intake_id = student.get('intake')
-            if intake_id:
-                intake = next((item for item in user_intakes if item['_id'] == intake_id), None)
-                intake_name = intake['intake'] if intake else 'N/A'
-            else:
-                intake_name = 'N/A'
-            
-            if intake_name not in intake_groups:
-                intake_groups[intake_name] = []
-            intake_groups[intake_name].append(student)
-
-        # Display students under their respective intake categories
-        for intake_name, students in intake_groups.items():
-            intake_item = QTreeWidgetItem(self.student_tree)
-            intake_item.setText(0, intake_name)
-            font = intake_item.font(0)
-            font.setPointSize(12)  # Smaller font size for intake items
-            intake_item.setFont(0, font)
-
-            for student in students:
-                student_item = QTreeWidgetItem(intake_item)
-                student_item.setText(0, student.get('name', 'N/A'))
-                student_item.setText(1, student.get('TPNumber', 'N/A'))
-                student_item.setData(0, Qt.UserRole, str(student['_id']))
+    def selected_student_id(self):
+        # The _id of the selected student row, or None if nothing or an intake is selected
+        index = self.student_tree.currentIndex()
+        if not index.isValid() or not index.parent().isValid():
+            return None
+        return self.student_model.data(index.siblingAtColumn(0), Qt.UserRole)
 
     def add_student(self):
         dialog = QDialog(self)
@@ -157,8 +299,7 @@ class StudentsPage(QWidget):
         # Get the list of classes created by the user
         user_classes = list(class_collection.find({"createdBy": self.username}))
         for cls in user_classes:
-            intake = intake_collection.find_one({"_id": cls["intake"]})
-            intake_name = intake["intake"] if intake else "N/A"
+            intake_name = intakes.name(db, cls["intake"], "N/A")
             display_text = f"{cls['name']} ({cls['type']}, {cls['weekday']}, {cls['time']}, {intake_name})"
             class_combo.addItem(display_text, cls["_id"])
         
@@ -214,16 +355,18 @@ class StudentsPage(QWidget):
         self.load_students()  # Refresh the students list after adding
 
     def delete_student(self):
-        selected_item = self.student_tree.currentItem()
-        if selected_item and selected_item.parent():
-            student_id = selected_item.data(0, Qt.UserRole)
+        student_id = self.selected_student_id()
+        if student_id:
             student = student_collection.find_one({"_id": ObjectId(student_id)})
             if student:
                 class_id = student['class_id'][0]
                 reply = QMessageBox.question(self, 'Delete Student', 'Are you sure you want to delete this student?', QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
                 if reply == QMessageBox.Yes:
+                    profile_images.delete_derivatives(db, fs, ObjectId(student_id), student)
                     student_collection.delete_one({"_id": ObjectId(student_id)})
-                    
+                    from face_recognition import unindex_student
+                    unindex_student(db, ObjectId(student_id))
+
                     # Update class summary
                     class_collection.update_one(
                         {"_id": class_id},
@@ -234,13 +377,11 @@ class StudentsPage(QWidget):
             QMessageBox.warning(self, "Selection Error", "Please select a student to delete.")
 
     def capture_and_upload_image(self):
-        selected_item = self.student_tree.currentItem()
-        if not selected_item or not selected_item.parent():
+        student_id = self.selected_student_id()
+        if not student_id:
             QMessageBox.warning(self, "Selection Error", "Please select a student.")
             return
         
-        student_id = selected_item.data(0, Qt.UserRole)
-        
         # Check if the student already has an image
         existing_image = student_collection.find_one({"_id": ObjectId(student_id), "profile_image_id": {"$exists": True}})
         if existing_image:
@@ -258,21 +399,23 @@ class StudentsPage(QWidget):
             if not ret:
                 break
 
-            boxes, _ = mtcnn.detect(frame)
+            boxes = detect_faces([frame])[0]
+            display = frame.copy()  # drawn on, so the stored photo and face crops stay clean
             if boxes is not None and len(boxes) > 1:
-                cv2.putText(frame, "Multiple faces detected. Please ensure only one face is visible.", (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2, cv2.LINE_AA)
+                cv2.putText(display, "Multiple faces detected. Please ensure only one face is visible.", (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2, cv2.LINE_AA)
             elif boxes is not None and len(boxes) == 1:
                 for box in boxes:
                     x1, y1, x2, y2 = map(int, box)
-                    cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
+                    cv2.rectangle(display, (x1, y1), (x2, y2), (0, 255, 0), 2)
 
-            cv2.imshow('Press Space to capture or ESC to exit', frame)
+            cv2.imshow('Press Space to capture or ESC to exit', display)
 
             key = cv2.waitKey(1)
             if key % 256 == 32:  # Space key pressed
                 if boxes is not None and len(boxes) == 1:
                     img_name = "captured_image.png"
                     cv2.imwrite(img_name, frame)
+                    samples, sample_boxes = self.capture_samples(cap, frame, boxes[0])
                     break
                 else:
                     QMessageBox.warning(self, "Face Detection Error", "Please ensure only one face is visible.")
@@ -298,11 +441,36 @@ class StudentsPage(QWidget):
 
         # Store the image in MongoDB using GridFS
         try:
-            self.store_image_in_mongo(img_binary, student_id)
+            image_id = self.store_image_in_mongo(img_binary, student_id)
+            profile_images.store_derivatives(db, fs, ObjectId(student_id), frame_rgb, boxes[0])
+            from face_recognition import index_student_photo
+            # The boxes found while capturing are reused, so the samples are embedded without another MTCNN pass
+            index_student_photo(db, ObjectId(student_id), image_id, [cv2.cvtColor(sample, cv2.COLOR_BGR2RGB) for sample in samples],
+                                sample_boxes)
             QMessageBox.information(self, "Success", "Image captured and uploaded successfully.")
         except Exception as e:
             QMessageBox.critical(self, "Error", f"Failed to upload image: {str(e)}")
 
+    def capture_samples(self, cap, first_frame, first_box, count=5, interval=0.4, timeout=4):
+        # Keep reading for a few seconds and collect frames with exactly one face as extra enrollment
+        # samples, so the student's template covers small changes of pose and expression. Returns the
+        # frames and the face box of each.
+        samples, sample_boxes = [first_frame.copy()], [first_box]
+        start = last = time.time()
+        while len(samples) < count and time.time() - start < timeout:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            boxes = detect_faces([frame])[0]
+            if boxes is not None and len(boxes) == 1 and time.time() - last >= interval:
+                samples.append(frame.copy())
+                sample_boxes.append(boxes[0])
+                last = time.time()
+            cv2.putText(frame, f"Hold still... {len(samples)}/{count}", (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2, cv2.LINE_AA)
+            cv2.imshow('Press Space to capture or ESC to exit', frame)
+            cv2.waitKey(1)
+        return samples, sample_boxes
+
     def store_image_in_mongo(self, img_binary, student_id):
         # Validate image
         try:
@@ -325,6 +493,7 @@ class StudentsPage(QWidget):
             {"_id": ObjectId(student_id)},
             {"$set": {"profile_image_id": image_id}}
         )
+        return image_id
 
     def go_back(self):
         self.close()
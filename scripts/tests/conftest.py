@@ -0,0 +1,22 @@
+import os
+import sys
+import pytest
+
+# The scripts are flat modules that connect to MongoDB on import; tests import them with conn.get_db
+# pointed at an in-memory mongomock database
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def db(monkeypatch):
+    mongomock = pytest.importorskip('mongomock')
+    import conn
+    # pymongo 4.9+ passes sort to the bulk builder for UpdateOne/ReplaceOne, which mongomock does not take yet
+    builder = mongomock.collection.BulkOperationBuilder
+    for name in ('add_update', 'add_replace'):
+        original = getattr(builder, name)
+        monkeypatch.setattr(builder, name, lambda self, *args, sort=None, _original=original, **kwargs:
+                            _original(self, *args, **kwargs))
+    database = mongomock.MongoClient()['FYP_db']
+    monkeypatch.setattr(conn, 'get_db', lambda: database)
+    return database
@@ -0,0 +1,56 @@
+import json
+import pytest
+from bson import ObjectId
+from pymongo.errors import AutoReconnect
+
+import event_journal
+from event_journal import EventJournal, connect, ship_pending, retry_failed
+
+
+@pytest.fixture
+def journal(db, tmp_path):
+    journal = EventJournal(db, path=str(tmp_path / 'events.sqlite3'), sync=False)
+    yield journal
+    journal.close()
+
+
+def test_rejected_write_is_set_aside_and_later_events_ship(db, journal):
+    # The database rejects the second record (a duplicate key stands in for any permanent write error)
+    db['records'].create_index('created_by', unique=True)
+    first = journal.create_record('class-a', 'lecturer')
+    poisoned = journal.create_record('class-b', 'lecturer')
+    later, student_id = journal.create_record('class-c', 'tutor'), ObjectId()
+    journal.append('behavior', later, student_id, 'focus', json.dumps({"seconds": 3.0, "episodes": 1}))
+    journal.append('performance', later, value='50.0')
+
+    conn = connect(journal.path)
+    ship_pending(db, conn, batch_size=10)
+
+    assert [seq for seq, in conn.execute("SELECT seq FROM failed")] == [2]
+    assert journal.lag()[0] == 0
+    assert db['records'].find_one({"_id": first}) is not None
+    assert db['records'].find_one({"_id": poisoned}) is None
+    assert db['records'].find_one({"_id": later})["overall_performance"] == 50.0
+    assert db['behavior_history'].find_one({"studentID": student_id, "recordID": later})["behaviors"] == ['focus']
+
+    # Once the database accepts it, retrying ships the set-aside event
+    db['records'].drop_indexes()
+    assert retry_failed(db, conn) == 1
+    assert db['records'].find_one({"_id": poisoned}) is not None
+    assert conn.execute("SELECT COUNT(*) FROM failed").fetchone()[0] == 0
+    conn.close()
+
+
+def test_unreachable_database_keeps_events_pending(db, journal, monkeypatch):
+    journal.create_record('class-a', 'lecturer')
+
+    def unreachable(db, rows):
+        raise AutoReconnect('connection reset')
+    monkeypatch.setattr(event_journal, 'ship_rows', unreachable)
+
+    conn = connect(journal.path)
+    with pytest.raises(AutoReconnect):
+        ship_pending(db, conn)
+    assert journal.lag()[0] == 1
+    assert conn.execute("SELECT COUNT(*) FROM failed").fetchone()[0] == 0
+    conn.close()
@@ -0,0 +1,115 @@
+from datetime import datetime, timedelta
+import pytest
+
+np = pytest.importorskip('numpy')
+from bson import ObjectId
+from pymongo.errors import AutoReconnect, OperationFailure
+
+import embedding_store
+from embedder import model_version
+from gallery_watch import GalleryWatcher
+
+
+class Stream:
+    # A change stream with no events that stops the watcher once it has been read from
+    def __init__(self, watcher, error=None):
+        self.watcher = watcher
+        self.error = error
+        self.resume_token = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def try_next(self):
+        if self.error:
+            raise self.error
+        self.watcher.stop()
+        return None
+
+
+class WatchedDb:
+    # mongomock database whose watch() opens the scripted streams in turn
+    def __init__(self, db):
+        self.db = db
+        self.streams = []
+        self.resumed_from = []
+
+    def __getitem__(self, name):
+        return self.db[name]
+
+    def watch(self, pipeline, resume_after=None, max_await_time_ms=None):
+        self.resumed_from.append(resume_after)
+        stream = self.streams.pop(0)
+        if isinstance(stream, Exception):
+            raise stream
+        return stream
+
+
+def enroll(db, name):
+    student_id, image_id = ObjectId(), ObjectId()
+    db['students'].insert_one({"_id": student_id, "name": name, "profile_image_id": image_id})
+    vector = embedding_store.to_binary(np.ones(512, np.float32))
+    db[embedding_store.COLLECTION].insert_many([
+        {"student_id": student_id, "image_id": image_id, "embedder": "fp32", "sample": sample, "embedding": vector,
+         "model_version": model_version('fp32'), "created_at": datetime.now()}
+        for sample in (0, embedding_store.TEMPLATE)])
+    return student_id, image_id
+
+
+def start(db, since):
+    watched = WatchedDb(db)
+    watcher = GalleryWatcher(watched, since, 'fp32', poll_interval=0.01)
+    return watched, watcher
+
+
+def added(watcher):
+    changes = []
+    while not watcher.changes.empty():
+        changes.append(watcher.changes.get_nowait())
+    return [(change[0], change[1]) for change in changes]
+
+
+def test_reconnect_without_token_catches_up(db):
+    watched, watcher = start(db, datetime.now() - timedelta(minutes=1))
+    # The first stream is lost before any event (no resume token); a student is enrolled meanwhile
+    lost = Stream(watcher, AutoReconnect("connection lost"))
+    watched.streams = [lost, Stream(watcher)]
+    original_try_next = lost.try_next
+
+    def enroll_then_fail():
+        enroll_then_fail.student = enroll(db, "Bob")
+        return original_try_next()
+    lost.try_next = enroll_then_fail
+
+    watcher.start({})
+    watcher.thread.join(5)
+    assert watched.resumed_from == [None, None]
+    student_id, _ = enroll_then_fail.student
+    assert added(watcher) == [('add', student_id)]
+
+
+def test_unusable_resume_token_catches_up(db):
+    watched, watcher = start(db, datetime.now() - timedelta(minutes=1))
+    watcher.mode, watcher.resume_token = 'change_stream', {"_data": "expired"}
+    student_id, _ = enroll(db, "Carol")
+    watched.streams = [OperationFailure("history lost", code=286), Stream(watcher)]
+
+    watcher.start({})
+    watcher.thread.join(5)
+    assert watched.resumed_from == [{"_data": "expired"}, None]
+    assert watcher.resume_token is None
+    assert added(watcher) == [('add', student_id)]
+
+
+def test_catch_up_reports_removed_students(db):
+    student_id, image_id = enroll(db, "Dan")
+    watched, watcher = start(db, datetime.now())
+    db['students'].delete_one({"_id": student_id})
+    watched.streams = [Stream(watcher)]
+
+    watcher.start({f"{student_id}:{image_id}": (student_id, "Dan")})
+    watcher.thread.join(5)
+    assert added(watcher) == [('remove', student_id)]
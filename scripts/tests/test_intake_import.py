@@ -0,0 +1,59 @@
+import pytest
+from bson import ObjectId
+
+pd = pytest.importorskip('pandas')
+pytest.importorskip('PySide6')
+
+
+def baseline_import(collection, df, intake_id):
+    # The row-by-row importer import_student_sheet replaced (IntakeManager.import_students)
+    df = df.drop_duplicates(subset=['Name', 'TP_Number'])
+    unique_entries, duplicate_entries, tp_conflicts = set(), [], []
+    for _, row in df.iterrows():
+        student_name = str(row['Name']).strip()
+        tp_number = str(row['TP_Number']).strip()
+        if not all([student_name, tp_number]):
+            continue
+        if collection.find_one({"TPNumber": tp_number}):
+            tp_conflicts.append((student_name, tp_number))
+            continue
+        if collection.find_one({"name": student_name, "TPNumber": tp_number, "intake": intake_id}):
+            duplicate_entries.append((student_name, tp_number))
+        elif (student_name, tp_number) not in unique_entries:
+            unique_entries.add((student_name, tp_number))
+            collection.insert_one({"name": student_name, "TPNumber": tp_number, "intake": intake_id, "class_id": []})
+    return sorted(unique_entries), duplicate_entries, tp_conflicts
+
+
+SHEET = pd.DataFrame({
+    'Name': ['Alice', 'Bob', 'Bob', ' Carol ', 'Dan', 'Eve', '', 'Frank', 'Alice', 'Grace', None],
+    'TP_Number': ['TP001', 'TP002', 'TP002', 'TP003', 'TP004', 'TP004', 'TP005', ' ', 'TP006', 'TP010', 'TP011'],
+})
+EXISTING = [
+    {"name": "Alice", "TPNumber": "TP001"},   # the same student, same intake
+    {"name": "Zed", "TPNumber": "TP003"},     # the TP number belongs to someone else
+    {"name": "Grace", "TPNumber": "TP010"},   # the same student in another intake
+]
+
+
+def seed(collection, intake_id, other_intake):
+    for student in EXISTING:
+        collection.insert_one({**student, "intake": other_intake if student["name"] == "Grace" else intake_id, "class_id": []})
+
+
+def test_import_reports_match_baseline(db, monkeypatch):
+    import intake
+    intake_id, other_intake = ObjectId(), ObjectId()
+
+    seed(db['baseline'], intake_id, other_intake)
+    expected_inserted, expected_duplicates, expected_conflicts = baseline_import(db['baseline'], SHEET, intake_id)
+
+    seed(db['students'], intake_id, other_intake)
+    monkeypatch.setattr(intake, 'student_collection', db['students'])
+    inserted, duplicates, conflicts = intake.import_student_sheet(SHEET, intake_id)
+
+    assert sorted((s["name"], s["TPNumber"]) for s in inserted) == expected_inserted
+    assert duplicates == expected_duplicates
+    assert conflicts == expected_conflicts
+    strip = {"_id": 0}
+    assert sorted(map(str, db['students'].find({}, strip))) == sorted(map(str, db['baseline'].find({}, strip)))
@@ -0,0 +1,44 @@
+import time
+import pytest
+
+np = pytest.importorskip('numpy')
+from bson import ObjectId
+
+from label_durations import LabelDurations, checkpoint_path, load_checkpoints, resumable
+
+
+def sightings(durations, student_ids, start):
+    for t in np.arange(start, start + 5, 0.5):
+        for student_id in student_ids:
+            durations.add(t, student_id, 'behavior', 'focus')
+            durations.add(t, student_id, 'emotion', 'Happy')
+    durations.add(start + 20, student_ids[0], 'behavior', 'focus')  # a second episode
+
+
+def test_resume_after_crash(tmp_path):
+    class_id, record_id = str(ObjectId()), str(ObjectId())
+    students = [ObjectId() for _ in range(3)]
+    live = LabelDurations(students=2, labels=1)  # grows while the session runs
+    sightings(live, students, 1000.0)
+    live.save(checkpoint_path(tmp_path, record_id), record_id=record_id, class_id=class_id, created_by='lecturer')
+    del live  # the session crashes
+
+    checkpoints = load_checkpoints(tmp_path)
+    assert resumable(checkpoints, 60, class_id=str(ObjectId()), created_by='lecturer') is None
+    assert resumable(checkpoints, 60, now=time.time() + 120, class_id=class_id, created_by='lecturer') is None
+    resumed = resumable(checkpoints, 60, class_id=class_id, created_by='lecturer')
+    assert resumed is not None and resumed.meta["record_id"] == record_id
+
+    # The resumed session continues where the crashed one stopped
+    expected = LabelDurations()
+    sightings(expected, students, 1000.0)
+    sightings(expected, students, 2000.0)
+    sightings(resumed, students, 2000.0)
+    for kind in ('behavior', 'emotion'):
+        assert resumed.seen(kind) == expected.seen(kind)
+    assert resumed.seen('behavior')[students[0]] == {'focus': (9.0, 4)}
+    assert resumed.weighted_score('behavior', {'focus': 10}) == (30.0, 3)
+
+
+def test_empty_directory_has_no_checkpoints(tmp_path):
+    assert load_checkpoints(tmp_path / 'missing') == []
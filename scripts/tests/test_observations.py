@@ -0,0 +1,24 @@
+from bson import ObjectId
+
+from observations import Observation, dedupe_observations
+
+
+def behavior(student_id, label, distance, stream):
+    return Observation('behavior', student_id, 'Alice', label, distance, stream, (0, 0, 10, 10), 0.9)
+
+
+def test_two_behaviors_of_one_student_on_one_stream_are_kept():
+    student_id = ObjectId()
+    # Both boxes contain the same face, so both share its distance
+    observations = [behavior(student_id, 'focus', 0.3, 0), behavior(student_id, 'writing', 0.3, 0)]
+    assert sorted(obs.label for obs in dedupe_observations(observations)) == ['focus', 'writing']
+
+
+def test_same_behavior_on_two_streams_keeps_the_best_match():
+    student_id, other_id = ObjectId(), ObjectId()
+    observations = [behavior(student_id, 'focus', 0.5, 0), behavior(student_id, 'focus', 0.2, 1),
+                    behavior(other_id, 'focus', 0.4, 0)]
+    kept = dedupe_observations(observations)
+    assert len(kept) == 2
+    mine = [obs for obs in kept if obs.student_id == student_id]
+    assert len(mine) == 1 and mine[0].stream == 1
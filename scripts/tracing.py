@@ -0,0 +1,128 @@
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import nullcontext
+
+# Reuse the YOLOv5 Profile timer (it also synchronizes CUDA before reading the clock)
+YOLOV5_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'yolov5')
+if YOLOV5_DIR not in sys.path:
+    sys.path.append(YOLOV5_DIR)
+try:
+    from utils.general import Profile
+except Exception as e:
+    print(f"YOLOv5 Profile unavailable ({e}), using a plain timer")
+    import contextlib
+
+    class Profile(contextlib.ContextDecorator):
+        def __init__(self, t=0.0, device=None):
+            self.t = t
+            self.device = device
+
+        def __enter__(self):
+            self.start = self.time()
+            return self
+
+        def __exit__(self, type, value, traceback):
+            self.dt = self.time() - self.start
+            self.t += self.dt
+
+        def time(self):
+            return time.time()
+
+# Shared no-op context returned by every span() call while tracing is disabled
+NULL_SPAN = nullcontext()
+
+
+class TraceSpan(Profile):
+    def __init__(self, tracer, name, cat, args):
+        super().__init__()
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __exit__(self, type, value, traceback):
+        super().__exit__(type, value, traceback)
+        self.tracer.complete(self.name, self.start, self.dt, self.cat, **self.args)
+
+
+class Tracer:
+    # Collects Chrome trace-event records (open the saved JSON in Perfetto or chrome://tracing)
+    def __init__(self):
+        self.path = None
+        self.enabled = False
+        self.events = []
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.t0 = time.time()
+        self.thread_names = {}
+
+    def start(self, path):
+        self.path = path
+        self.events = []
+        self.thread_names = {}
+        self.t0 = time.time()
+        self.enabled = True
+        print(f"Tracing enabled, writing to {path}")
+
+    def span(self, name, cat='stage', **args):
+        if not self.enabled:
+            return NULL_SPAN
+        return TraceSpan(self, name, cat, args)
+
+    def complete(self, name, start, dur, cat='stage', **args):
+        # start is a time.time() timestamp and dur is in seconds, like Profile.start / Profile.dt
+        if not self.enabled:
+            return
+        self._add({
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": (start - self.t0) * 1e6,
+            "dur": dur * 1e6,
+            "args": args,
+        })
+
+    def wait(self, name, start, **args):
+        # Record the time a thread spent blocked on a queue or the event loop since start
+        self.complete(name, start, time.time() - start, 'wait', **args)
+
+    def instant(self, name, cat='event', **args):
+        if not self.enabled:
+            return
+        self._add({"name": name, "cat": cat, "ph": "i", "s": "t", "ts": (time.time() - self.t0) * 1e6, "args": args})
+
+    def counter(self, name, **values):
+        if not self.enabled:
+            return
+        self._add({"name": name, "ph": "C", "ts": (time.time() - self.t0) * 1e6, "args": values})
+
+    def _add(self, event):
+        thread = threading.current_thread()
+        event["pid"] = self.pid
+        event["tid"] = thread.ident
+        with self.lock:
+            self.thread_names.setdefault(thread.ident, thread.name)
+            self.events.append(event)
+
+    def save(self):
+        if not self.enabled:
+            return
+        with self.lock:
+            metadata = [
+                {"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid, "args": {"name": name}}
+                for tid, name in self.thread_names.items()
+            ]
+            events = metadata + self.events
+        try:
+            with open(self.path, 'w') as f:
+                json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+            print(f"Saved {len(events)} trace events to {self.path}")
+        except Exception as e:
+            print(f"Failed to save trace to {self.path}: {e}")
+
+
+# Process-wide tracer, disabled until start() is called
+tracer = Tracer()
@@ -0,0 +1,266 @@
+import os
+import time
+import queue
+import traceback
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+from scaling import scales
+from face_quality import gate
+from tracing import tracer
+
+# Inference backends for the detection session. LocalInference runs every detector family in the
+# calling process. ProcessInference gives each family (torch face models, TensorFlow/MediaPipe emotion,
+# torch YOLO) its own worker process with a fixed thread budget, so they stop competing for the GIL and
+# for intra-op threads. Frames reach the workers through a shared-memory ring of preallocated 1080p
+# slots and are never pickled; only the small per-face results come back over a queue.
+
+FAMILIES = ('face', 'emotion', 'behavior')
+FRAME_SHAPE = (1080, 1920, 3)
+# Share of the machine's cores given to each family
+CORE_SHARES = {'face': 0.375, 'emotion': 0.25, 'behavior': 0.375}
+
+
+def scale_options():
+    return {"yolo_size": scales.yolo_size, "mtcnn_scale": scales.mtcnn_scale,
+            "mesh_scale": scales.mesh_scale, "min_face_px": scales.min_face_px,
+            "quality_threshold": gate.threshold}
+
+
+def configure_family(family, options):
+    for key, value in options.items():
+        if key == 'quality_threshold':
+            gate.threshold = value
+        else:
+            setattr(scales, key, value)
+
+
+def run_family(family, frames):
+    # Models are imported on first use so that only the process running a family loads it
+    # Faces under the quality gate's threshold are skipped and counted in gate
+    skipped = []
+    if family == 'face':
+        # Goes to the embedding service when it is running, otherwise loads the face models here
+        from embedding_service import detect_and_encode_batch
+        results = detect_and_encode_batch(frames, scales.mtcnn_scale, bgr=True, min_face_size=scales.mtcnn_min_face_size(),
+                                          quality=gate.threshold or None, skipped=skipped)
+        gate.record(family, sum(len(encodings) for encodings, _ in results) + sum(skipped), sum(skipped))
+        return results
+    if family == 'emotion':
+        from emotions import detect_emotion_batch
+        results = detect_emotion_batch(frames, scales.mesh_scale, gate.threshold or None, skipped)
+        gate.record(family, sum(len(emotions) for emotions in results) + sum(skipped), sum(skipped))
+        return results
+    if family == 'behavior':
+        from behavior_detection import detect_behavior_batch
+        return detect_behavior_batch(frames, scales.yolo_size, render=False)
+    raise ValueError(f"Unknown detector family {family}")
+
+
+class LocalInference:
+    def __init__(self):
+        self.configured = set()
+
+    def run(self, frames, families):
+        outputs = {}
+        for family in families:
+            if family not in self.configured:
+                configure_family(family, scale_options())
+                self.configured.add(family)
+            with tracer.span(family):
+                outputs[family] = run_family(family, frames)
+        return outputs
+
+    def close(self):
+        pass
+
+
+class FrameRing:
+    # Fixed number of frame slots in one shared-memory block. The creating process owns the block and
+    # hands out slots; workers attach by name and read frames in place.
+    def __init__(self, slots, frame_shape=FRAME_SHAPE, name=None):
+        size = slots * int(np.prod(frame_shape))
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+        self.owner = name is None
+        self.array = np.ndarray((slots, *frame_shape), np.uint8, buffer=self.shm.buf)
+        self.free = list(range(slots))
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def put(self, frame):
+        h, w = frame.shape[:2]
+        if h > self.array.shape[1] or w > self.array.shape[2]:
+            raise ValueError(f"Frame {w}x{h} does not fit the {self.array.shape[2]}x{self.array.shape[1]} ring slots")
+        if not self.free:
+            raise RuntimeError("No free frame slots")
+        slot = self.free.pop()
+        self.array[slot, :h, :w] = frame
+        return slot, h, w
+
+    def view(self, slot, h, w):
+        frame = self.array[slot, :h, :w]
+        # Full-size frames are contiguous views; smaller ones are copied out for OpenCV
+        return frame if frame.flags['C_CONTIGUOUS'] else np.ascontiguousarray(frame)
+
+    def release(self, slots):
+        self.free.extend(slot for slot, _, _ in slots)
+
+    def close(self):
+        del self.array
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def worker_main(family, ring_name, slots, frame_shape, tasks, results, threads, cores, options):
+    # Thread budgets have to be in place before torch / TensorFlow start their pools
+    for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS'):
+        os.environ[var] = str(threads)
+    os.environ['TF_NUM_INTEROP_THREADS'] = '1'
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    import torch
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+    if family == 'emotion':
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    ring = FrameRing(slots, frame_shape, name=ring_name)
+    try:
+        configure_family(family, options)
+        run_family(family, [np.zeros((64, 64, 3), np.uint8)])  # load the models and warm up
+        results.put((0, family, None, None))
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            tick, frame_slots = task
+            if tick < 0:
+                results.put((tick, family, gate.stats(), None))  # quality gate counts for the session report
+                continue
+            try:
+                result = run_family(family, [ring.view(*slot) for slot in frame_slots])
+                results.put((tick, family, result, None))
+            except Exception:
+                results.put((tick, family, None, traceback.format_exc()))
+    finally:
+        del ring.array
+        ring.shm.close()
+
+
+class ProcessInference:
+    def __init__(self, families=FAMILIES, slots=8, frame_shape=FRAME_SHAPE, threads=None, timeout=30):
+        ctx = mp.get_context('spawn')
+        cpus = os.cpu_count() or 1
+        threads = threads or {family: max(1, int(cpus * CORE_SHARES[family])) for family in families}
+        self.families = tuple(families)
+        self.timeout = timeout
+        self.tick = 0
+        self.ring = FrameRing(slots, frame_shape)
+        # tick -> (frame slots, families that have not answered yet); a tick's slots are only released once
+        # every worker it was sent to has answered, so a slow worker never reads a frame being overwritten
+        self.pending = {}
+        self.tasks = {family: ctx.Queue() for family in self.families}
+        self.results = ctx.Queue()
+        self.processes = []
+        first_core = 0
+        for family in self.families:
+            cores = {core % cpus for core in range(first_core, first_core + threads[family])}
+            first_core += threads[family]
+            process = ctx.Process(
+                target=worker_main, name=f'{family}-worker', daemon=True,
+                args=(family, self.ring.name, slots, frame_shape, self.tasks[family], self.results,
+                      threads[family], cores, scale_options()))
+            process.start()
+            self.processes.append(process)
+        print(f"Started inference workers: {', '.join(f'{f} ({threads[f]} threads)' for f in self.families)}")
+        self._collect(0, self.families, timeout=300)  # wait for the models to load
+
+    def run(self, frames, families):
+        dead = set(families) & set(self._drop_dead_workers())
+        if dead:
+            raise RuntimeError(f"Inference workers died: {', '.join(sorted(dead))}")
+        self.tick += 1
+        if len(self.ring.free) < len(frames):
+            self._drain()  # slots still held by ticks that timed out
+        frame_slots = []
+        with tracer.span('ring_put', 'ipc', frames=len(frames)):
+            try:
+                for frame in frames:
+                    frame_slots.append(self.ring.put(frame))
+            except Exception:
+                self.ring.release(frame_slots)  # e.g. an oversized frame from a later camera
+                raise
+        self.pending[self.tick] = (frame_slots, set(families))
+        for family in families:
+            self.tasks[family].put((self.tick, frame_slots))
+        return self._collect(self.tick, families, self.timeout)
+
+    def _answered(self, tick, family):
+        if tick not in self.pending:
+            return
+        frame_slots, waiting = self.pending[tick]
+        waiting.discard(family)
+        if not waiting:
+            del self.pending[tick]
+            self.ring.release(frame_slots)
+
+    def _drop_dead_workers(self):
+        # A worker that died never answers; its ticks stop waiting for it so their slots are released.
+        # Returns the families whose worker has died.
+        dead = [family for family, process in zip(self.families, self.processes) if not process.is_alive()]
+        for family in dead:
+            for tick in list(self.pending):
+                self._answered(tick, family)
+        return dead
+
+    def _drain(self):
+        # Takes the late answers that have already arrived, without waiting
+        while True:
+            try:
+                result_tick, family, _, _ = self.results.get_nowait()
+            except queue.Empty:
+                return
+            self._answered(result_tick, family)
+
+    def _collect(self, tick, families, timeout):
+        outputs = {}
+        deadline = time.time() + timeout
+        while len(outputs) < len(families):
+            start = time.time()
+            try:
+                result_tick, family, result, error = self.results.get(timeout=max(0.0, deadline - start))
+            except queue.Empty:
+                dead = self._drop_dead_workers()
+                raise RuntimeError(f"Inference workers did not answer within {timeout}s "
+                                   f"(waiting for {', '.join(set(families) - set(outputs))}"
+                                   f"{'; died: ' + ', '.join(dead) if dead else ''})")
+            tracer.wait(f'{family}_result', start, tick=tick)
+            self._answered(result_tick, family)
+            if result_tick != tick:
+                continue  # late answer to a tick that already timed out
+            if error:
+                print(f"{family} worker failed: {error}")
+            outputs[family] = result
+        return outputs
+
+    def close(self):
+        try:
+            for family in self.families:
+                self.tasks[family].put((-1, None))
+            for stats in self._collect(-1, self.families, timeout=5).values():
+                if stats:
+                    gate.merge(stats)
+        except RuntimeError as e:
+            print(f"Could not collect quality gate counts: {e}")
+        for family in self.families:
+            self.tasks[family].put(None)
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        self.ring.close()